@@ -19,23 +19,67 @@ The second argument can be given as a single word, or a space-separated list
 """
 import sys
 import logging
-import re
 import hashlib
 import argparse
 import traceback
 import itertools
+import os
+import struct
+import array
+import mmap
+import time
+import tempfile
+import signal
+import datetime
+import threading
+import Queue
+import shlex
+import bisect
+import difflib
+import fnmatch
 
-try:
-    import tweepy
-except ImportError:
-    print "The tweepy module could not be found.\n\
+import sqlite3
+import collections
+import contextlib
+import functools
+import json
+import zlib
+import gzip
+import bz2
+import cStringIO
+import multiprocessing
+import cProfile
+import pstats
+import resource
+import gc
+import fcntl
+
+import poster
+
+# tweepy is only needed to obtain OAuth credentials, so it's imported
+# when it's needed, by load_tweepy()
+tweepy = None
+
+
+def load_tweepy():
+    """ Import tweepy, which is only needed to obtain OAuth credentials,
+    so other runs don't pay for importing it
+    """
+    global tweepy
+    if tweepy is None:
+        try:
+            import tweepy as tweepy_module
+        except ImportError:
+            print "The tweepy module could not be found.\n\
 Please install using e.g. pip, or obtain it from GitHub at \n\
 https://github.com/tweepy/tweepy"
-    raise
+            raise
+        tweepy = tweepy_module
+    return tweepy
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.dialects import sqlite
-from sqlalchemy import Column, Integer, BigInteger, String
+from sqlalchemy import Column, Integer, BigInteger, String, Index
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.types import DateTime
@@ -72,22 +116,42 @@ class AppMixin(object):
     def __tablename__(cls):
         return cls.__name__.lower()
 
-    __mapper_args__ = {'always_refresh': True}
-
     id = Column(BigIntegerType, primary_key=True)
     # the correct function is automatically selected based on the dialect
     # timestamp = Column(DateTime, server_default=utcnow())
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
+# milliseconds to wait for another process to finish writing to the db,
+# before giving up with "database is locked"
+BUSY_TIMEOUT = 30000
+
+
+def configure_sqlite(dbapi_connection):
     """
-    Emit a PRAGMA statement enforcing foreign-key integrity when an Engine
-    instance connects to the DB
+    Set up a sqlite3 connection so that several processes can share the db:
+    foreign-key integrity is enforced, writers wait for each other instead
+    of failing, and WAL journaling lets readers carry on while another
+    process writes
     """
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA busy_timeout=%d" % BUSY_TIMEOUT)
+    # in-memory dbs ignore this, and keep their own journal mode
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # WAL is safe against crashes at this level, and it saves an fsync
+    # per commit
+    cursor.execute("PRAGMA synchronous=NORMAL")
     cursor.close()
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Configure each sqlite connection when an Engine instance connects to
+    the DB
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        configure_sqlite(dbapi_connection)
+
 # boilerplate ends
 
 Base = declarative_base()
@@ -99,13 +163,55 @@ class Position(Base, AppMixin):
     position = Column(Integer)
     displayline = Column(Integer)
     headers = Column(String(field_length))
-    digest = Column(String(field_length))
+    digest = Column(String(field_length), index=True, unique=True)
     conkey = Column(String(field_length))
     consecret =  Column(String(field_length))
     acckey = Column(String(field_length))
     accsecret = Column(String(field_length))
 
 
+class Payload(Base, AppMixin):
+    """stores pre-rendered tweets, and the position following each one"""
+    __table_args__ = (Index('ix_payload_digest_sequence',
+        'digest', 'sequence', unique=True),)
+    digest = Column(String(Position.field_length))
+    sequence = Column(Integer)
+    payload = Column(String)
+    lastline = Column(Integer)
+    displayline = Column(Integer)
+    prefix = Column(String)
+
+
+class Rendering(Base, AppMixin):
+    """records which books have been rendered, and with which headers"""
+    digest = Column(String(Position.field_length), index=True, unique=True)
+    headers = Column(String)
+    count = Column(Integer)
+
+
+class Account(Base, AppMixin):
+    """stores further accounts a book is posted to, and the position
+    following the last line each was sent"""
+    __table_args__ = (Index('ix_account_digest_acckey',
+        'digest', 'acckey', unique=True),)
+    digest = Column(String(Position.field_length))
+    conkey = Column(String(Position.field_length))
+    consecret = Column(String(Position.field_length))
+    acckey = Column(String(Position.field_length))
+    accsecret = Column(String(Position.field_length))
+    position = Column(Integer)
+    failures = Column(Integer)
+
+
+class Filestat(Base, AppMixin):
+    """caches file digests, keyed on the file's stat values"""
+    path = Column(String, index=True)
+    inode = Column(BigInteger)
+    size = Column(BigInteger)
+    mtime_ns = Column(BigInteger)
+    digest = Column(String(Position.field_length))
+
+
 def sync(db_name):
     """
     Connect to the DB, return a usable session
@@ -116,10 +222,88 @@ def sync(db_name):
         encoding="utf8")
     # create the tables by syncing metadata from the models
     Base.metadata.create_all(engine)
+    # create_all doesn't alter existing tables, so upgrade those in place
+    connection = engine.raw_connection()
+    try:
+        migrate(connection)
+    finally:
+        connection.close()
     Session = sessionmaker(bind=engine)
     session = Session()
     return session
 
+# incremented whenever migrate() gains a new step
+SCHEMA_VERSION = 1
+
+
+def migrate(connection):
+    """ Upgrade an existing db in place, using a sqlite3 connection
+
+    The schema version is stored in the db's user_version, and each step
+    is only run once
+    """
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # digest gains a unique index. Older dbs may contain duplicate
+        # digests, so keep the most advanced row for each, and its
+        # credentials
+        removed = connection.execute(
+            """DELETE FROM position WHERE digest IS NOT NULL AND id NOT IN (
+                SELECT (SELECT dupe.id FROM position dupe
+                    WHERE dupe.digest = row.digest
+                    ORDER BY dupe.position DESC, dupe.id LIMIT 1)
+                FROM position row)""").rowcount
+        if removed:
+            logging.warning(
+                "Removed %s duplicate rows while migrating the db", removed)
+        connection.execute(
+            """CREATE UNIQUE INDEX IF NOT EXISTS ix_position_digest
+                ON position (digest)""")
+    if version < SCHEMA_VERSION:
+        connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        logging.info("Migrated db from schema version %s to %s",
+            version, SCHEMA_VERSION)
+    connection.commit()
+
+# byte offsets of non-blank lines are stored as fixed-width records in a
+# sidecar file per digest, alongside the db
+INDEX_DIR = 'tweet_books.idx'
+INDEX_RECORD = struct.Struct('<Q')
+# files modified more recently than this (in seconds) are always re-hashed,
+# since a further edit within the mtime granularity wouldn't be noticed
+RACY_INTERVAL = 2
+# number of payloads inserted at a time when rendering a book
+RENDER_BATCH = 5000
+# number of lines packed into a LineBuffer at a time
+PACK_BATCH = 4096
+# number of tweets claimed at a time by a --count run, unless --commit-every
+# is given, so a crash skips at most this many lines
+CLAIM_BLOCK = 10
+# number of accounts a line is posted to at once, when a book has mirrors
+FANOUT_WORKERS = 8
+# journaled runs write their position to the db every JOURNAL_FOLD tweets
+JOURNAL_FOLD = 256
+# compressed texts are stored alongside their line index as independently
+# compressed blocks of about this many bytes of decompressed text, so any
+# line can be reached by decompressing a single block
+CHECKPOINT_BYTES = 1 << 20
+# texts are also split into chunks of lines, each ending with a line whose
+# checksum has all the bits of CHUNK_MASK set, so that an edit only changes
+# the chunks around it. Chunks are 64 lines long on average, and kept
+# between CHUNK_MIN and CHUNK_MAX lines
+CHUNK_MASK = 63
+CHUNK_MIN = 16
+CHUNK_MAX = 256
+# first line, number of lines, and SHA1 digest of each chunk
+CHUNK_RECORD = struct.Struct('<QQ20s')
+# the CRC of each line, so that lines can be matched within edited chunks
+CHECKSUM_RECORD = struct.Struct('<I')
+# an edited file is only treated as a new version of the same book if at
+# least this fraction of its chunks are unchanged, or of its lines, if
+# either version has fewer than REMAP_MIN_CHUNKS chunks
+REMAP_SIMILARITY = 0.5
+REMAP_MIN_CHUNKS = 8
+
 # logging stuff
 # could also do: LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG,
@@ -141,18 +325,281 @@ class MatchError(Exception):
         return repr(self.error)
 
 
+class PositionConflict(Exception):
+    """ Raised if a book's position has been moved on by another process
+    since it was read, so the line has already been claimed, or if another
+    process holds the book's journal (when expected is None)
+    """
+
+    def __init__(self, digest, expected):
+        Exception.__init__(self)
+        self.digest = digest
+        self.expected = expected
+
+    def __str__(self):
+        if self.expected is None:
+            return "%s is being emitted by another process" % self.digest
+        return "Position of %s is no longer %s" % (self.digest, self.expected)
+
+
+class Finished(Exception):
+    """ Reported for a book which has no more lines to tweet
+    """
+
+    def __init__(self, digest):
+        Exception.__init__(self)
+        self.digest = digest
+
+    def __str__(self):
+        return "%s has no more lines to tweet" % self.digest
+
+
+class StageTimer(object):
+    """ Record the time taken by each stage of a run.
+
+    Use as a context manager, e.g. with TIMER('post'): ..., or decorate
+    functions with timed('post'). Each completed stage is logged as a JSON
+    record, and totals are kept so they can be exported for Prometheus.
+    Nested uses of the same stage are only counted once, and timings from
+    several threads are combined
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """ Discard all recorded timings """
+        with self.lock:
+            self.totals = collections.OrderedDict()
+
+    def merge(self, totals):
+        """ Add the (stage, [seconds, calls]) totals recorded by another
+        timer, e.g. in a worker process
+        """
+        with self.lock:
+            for stage, (seconds, calls) in totals:
+                total = self.totals.setdefault(stage, [0.0, 0])
+                total[0] += seconds
+                total[1] += calls
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        active = self.local.__dict__.setdefault('active', set())
+        if stage in active:
+            yield
+            return
+        active.add(stage)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            active.discard(stage)
+            with self.lock:
+                total = self.totals.setdefault(stage, [0.0, 0])
+                total[0] += elapsed
+                total[1] += 1
+            logging.info("timing %s", json.dumps(
+                {"stage": stage, "seconds": round(elapsed, 6)}))
+
+    def write_prometheus(self, path):
+        """ Write the totals to path in Prometheus' text format, for the
+        node exporter's textfile collector. The file is replaced atomically
+        """
+        lines = [
+            "# HELP plowman_stage_seconds Time spent in each stage of the "
+            "last run.",
+            "# TYPE plowman_stage_seconds gauge"]
+        with self.lock:
+            totals = self.totals.items()
+        lines.extend('plowman_stage_seconds{stage="%s"} %.6f' % (stage, total[0])
+            for stage, total in totals)
+        lines.extend([
+            "# HELP plowman_stage_calls Number of times each stage ran in "
+            "the last run.",
+            "# TYPE plowman_stage_calls gauge"])
+        lines.extend('plowman_stage_calls{stage="%s"} %d' % (stage, total[1])
+            for stage, total in totals)
+        lines.extend([
+            "# HELP plowman_last_run_timestamp_seconds When the last run "
+            "finished.",
+            "# TYPE plowman_last_run_timestamp_seconds gauge",
+            "plowman_last_run_timestamp_seconds %.3f" % time.time()])
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        with os.fdopen(handle, 'w') as got_file:
+            got_file.write("\n".join(lines) + "\n")
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+
+
+TIMER = StageTimer()
+
+
+def timed(stage):
+    """ Decorator which records the time taken by a function as stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TIMER(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# time the signing of each request, which is the client's OAuth work
+poster.POOL.options['sign'] = timed('auth')(poster.sign_request)
+
+
+# columns of the position table, in order
+POSITION_FIELDS = ('id', 'position', 'displayline', 'headers', 'digest',
+    'conkey', 'consecret', 'acckey', 'accsecret')
+StoredRow = collections.namedtuple('StoredRow', POSITION_FIELDS)
+
+
+class SqliteStore(object):
+    """ A lightweight alternative to a SQLAlchemy session, for dry runs.
+
+    Reads and writes the same position and filestat tables as the models
+    above, using the sqlite3 module directly, and creates and migrates them
+    if necessary. Can be passed to get_row(), write_vals(), get_digest()
+    and BookFromTextFile.get_db() in place of a session.
+    """
+    schema = (
+        """CREATE TABLE IF NOT EXISTS position (
+            id INTEGER NOT NULL,
+            position INTEGER,
+            displayline INTEGER,
+            headers VARCHAR(50),
+            digest VARCHAR(50),
+            conkey VARCHAR(50),
+            consecret VARCHAR(50),
+            acckey VARCHAR(50),
+            accsecret VARCHAR(50),
+            PRIMARY KEY (id))""",
+        """CREATE TABLE IF NOT EXISTS filestat (
+            id INTEGER NOT NULL,
+            path VARCHAR,
+            inode BIGINT,
+            size BIGINT,
+            mtime_ns BIGINT,
+            digest VARCHAR(50),
+            PRIMARY KEY (id))""",
+        """CREATE INDEX IF NOT EXISTS ix_filestat_path
+            ON filestat (path)""",
+        """CREATE TABLE IF NOT EXISTS account (
+            id INTEGER NOT NULL,
+            digest VARCHAR(50),
+            conkey VARCHAR(50),
+            consecret VARCHAR(50),
+            acckey VARCHAR(50),
+            accsecret VARCHAR(50),
+            position INTEGER,
+            failures INTEGER,
+            PRIMARY KEY (id))""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS ix_account_digest_acckey
+            ON account (digest, acckey)""",
+    )
+
+    def __init__(self, location):
+        self.connection = sqlite3.connect(location)
+        configure_sqlite(self.connection)
+        for statement in self.schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+        migrate(self.connection)
+
+    def get_row(self, digest):
+        """ Return the position row for digest, or None
+        """
+        row = self.connection.execute(
+            "SELECT %s FROM position WHERE digest = ?"
+            % ", ".join(POSITION_FIELDS), (digest,)).fetchone()
+        if row is None:
+            return None
+        return StoredRow(*row)
+
+    def add_row(self, values):
+        """ Insert a position row from a dict of its values
+        """
+        fields = [field for field in POSITION_FIELDS if field in values]
+        self.connection.execute(
+            "INSERT INTO position (%s) VALUES (%s)"
+            % (", ".join(fields), ", ".join("?" * len(fields))),
+            [values[field] for field in fields])
+
+    def write_vals(self, digest, last_l, disp_l, prefix, expected=None):
+        """ Update the position row for digest, provided its position is
+        still expected, if that's given. Returns the number of rows updated
+        """
+        query = "UPDATE position SET position = ?, displayline = ?, " \
+            "headers = ? WHERE digest = ?"
+        values = [last_l, disp_l, prefix, digest]
+        if expected is not None:
+            query += " AND position = ?"
+            values.append(expected)
+        return self.connection.execute(query, values).rowcount
+
+    def get_filestat(self, path):
+        """ Return the cached (inode, size, mtime_ns, digest) for path,
+        or None
+        """
+        return self.connection.execute(
+            "SELECT inode, size, mtime_ns, digest FROM filestat "
+            "WHERE path = ?", (path,)).fetchone()
+
+    def put_filestat(self, path, inode, size, mtime_ns, digest):
+        """ Cache the stat values and digest of path
+        """
+        updated = self.connection.execute(
+            "UPDATE filestat SET inode = ?, size = ?, mtime_ns = ?, "
+            "digest = ? WHERE path = ?",
+            (inode, size, mtime_ns, digest, path)).rowcount
+        if not updated:
+            self.connection.execute(
+                "INSERT INTO filestat (path, inode, size, mtime_ns, digest) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, inode, size, mtime_ns, digest))
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def flush(self):
+        pass
+
+
+def find_row(sess, digest):
+    """ Return the row for digest, or None if there isn't one
+    """
+    if isinstance(sess, SqliteStore):
+        return sess.get_row(digest)
+    return sess.query(Position).filter_by(digest=digest).first()
+
+
+@timed('fetch')
 def get_row(sess, digest):
     """ Select a row based on the input file SHA1 hash, or create a new
     entry, and new OAuth credentials
     """
     # try to select the correct row, based on the SHA1 digest
-    try:
-        row = sess.query(Position).filter_by(digest=digest).one()
-    except NoResultFound:
+    if isinstance(sess, SqliteStore):
+        row = sess.get_row(digest)
+    else:
+        try:
+            row = sess.query(Position).filter_by(digest=digest).one()
+        except NoResultFound:
+            row = None
+    if row is None:
         logging.info(
             "New file found, inserting row.\nSHA1: %s", str(digest))
         oavals = create_oauth(sess, digest)
-        row = Position(
+        values = dict(
             position=0,
             displayline=0,
             headers='',
@@ -162,6 +609,11 @@ def get_row(sess, digest):
             acckey=oavals.get('acckey'),
             accsecret=oavals.get('accsecret')
         )
+        if isinstance(sess, SqliteStore):
+            sess.add_row(values)
+            sess.commit()
+            return sess.get_row(digest)
+        row = Position(**values)
         sess.add(row)
         # try to catch an insertion error here
         sess.commit()
@@ -170,6 +622,7 @@ def get_row(sess, digest):
 def create_oauth(sess, digest):
     """ Obtain OAuth creds from Twitter, using the Tweepy lib
     """
+    tweepy = load_tweepy()
     try:
         # attempt to create OAuth credentials
         import getOAuth
@@ -190,66 +643,397 @@ Error was: %s" % (digest, err)
         raise
     return oav
 
-def write_vals(sess, digest, last_l, disp_l, prefix):
+@timed('commit')
+def write_vals(sess, digest, last_l, disp_l, prefix, commit=True,
+    expected=None):
     """ Write new line and header values to the db
+
+    Pass commit=False to batch several updates into a single transaction.
+    If expected is given, the row is only updated if its position is still
+    expected, so that two processes can't both advance a book from the same
+    line; PositionConflict is raised if it isn't
     """
-    sess.query(Position).filter(Position.digest == digest).update({
-        'position':last_l,
-        'displayline':disp_l,
-        'headers':prefix,
-        'digest':digest})
-    sess.commit()
+    if isinstance(sess, SqliteStore):
+        updated = sess.write_vals(digest, last_l, disp_l, prefix, expected)
+    else:
+        query = sess.query(Position).filter(Position.digest == digest)
+        if expected is not None:
+            query = query.filter(Position.position == expected)
+        updated = query.update({
+            'position':last_l,
+            'displayline':disp_l,
+            'headers':prefix,
+            'digest':digest})
+    if expected is not None and not updated:
+        logging.warning("Position of %s was moved on by another process",
+            digest)
+        # don't hold the write lock until the next commit
+        if commit:
+            sess.rollback()
+        raise PositionConflict(digest, expected)
+    if commit:
+        sess.commit()
 
 
 class BookFromTextFile(object):
     """ Create a book object from a text file.
 
-    Accepts two arguments:
+    Accepts four arguments:
     1. a filename, from which text will be read
     2. a list object used to identify header lines
+    3. an optional directory in which line indexes are stored
+    4. an optional db session, used to look up a cached digest for the file
     A sqlite3 connection object is created, and an attempt is made to
     retrieve a row from a db matching the filename which was
     passed. If no db is found, a new db, table, row and OAuth credentials
-    are created.
+    are created. Files on disk are read using a line index, so only the
+    lines which are to be tweeted are read on each run.
     """
 
-    def __init__(self, fname = None, hid = None):
+    def __init__(self, fname = None, hid = None, index_dir = INDEX_DIR,
+        sess = None):
         self.headers = hid
         self.database = None
         self.oavals = None
         self.position = None
-        self.lines = gimme_lines(fname, open_file, imp_file)
-        # try to get hash of returned list
-        self.sha = get_hash(self.lines)
+        # the position last read from or written to the db
+        self.saved = None
+        self.index_dir = index_dir
+        self.offsets = None
+        self.text = None
+        self.queued = None
+        self.api = None
+        self.matcher = None
+        self.section_table = None
+        # the digest of the file before it was edited, if it has been
+        self.previous = None
+        # (id, credentials) of further accounts to post to, the position
+        # each has reached, and the outcomes of posts not yet recorded
+        self.mirrors = []
+        self.mirrored = {}
+        self.sent = []
+        # the book's emission journal, while it's being journaled
+        self.journal = None
+        self.fname = file_path(fname)
+        if self.fname:
+            stat = os.stat(self.fname)
+            self.stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+            # reuse a cached digest if the file is unchanged, otherwise
+            # stream it once, noting where each non-blank line begins
+            if sess is not None:
+                previous = cached_digest(sess, self.fname)
+                self.sha, self.offsets = get_digest(
+                    sess, self.fname, self.scan)
+                # the file has been edited since it was last seen
+                if previous != self.sha:
+                    self.previous = previous
+            else:
+                self.sha, self.offsets = self.scan(self.fname)
+            self.lines = None
+        else:
+            # keep the text compactly, rather than as a unicode object per
+            # line
+            self.text = gimme_lines(fname, read_packed, pack_lines)
+            self.lines = None
+            # try to get hash of returned list
+            self.sha = get_hash(self.text.iter_raw())
 
-    def get_db(self, sess):
+    def get_db(self, sess, queued=False, journaled=False):
         """ Open/create a db, and retrieve/insert a row based on SHA1 hash
+
+        If queued is set, the book is rendered in full the first time it's
+        seen, and the next payload is fetched from the db instead of being
+        formatted from the text.
+        If journaled is set, the book's journal is locked until close() is
+        called, and tweets are recorded in it rather than saved to the db
+        one at a time. Otherwise, any tweets left in the journal by an
+        earlier journaled run are saved to the db first. Either way,
+        PositionConflict is raised if another process is journaling the book
         """
 
         # try to open a db connection
         self.database = sess
+        if not journaled:
+            self.close()
+            fold_journal(sess, self.index_dir, self.sha)
+        if self.previous is not None and find_row(sess, self.sha) is None:
+            self.remap(sess)
         # self.database.get_row()
         self.row = get_row(self.database, self.sha)
+        # so that the book can be remapped if it's edited later
+        if self.fname and not os.path.exists(
+            chunk_path(self.index_dir, self.sha)):
+            self.chunks()
         # set instance attrs from the db
         self.position = {
             "lastline": self.row.position,
             "displayline": self.row.displayline,
             "prefix": self.row.headers
             }
+        self.saved = self.row.position
+        if journaled:
+            if self.journal is None:
+                journal = Journal(self.index_dir, self.sha)
+                journal.acquire()
+                self.journal = journal
+            # the journal is ahead of the db, until it's folded into it
+            if self.journal.last is not None:
+                self.position = dict((key, self.journal.last[key])
+                    for key in ("lastline", "displayline", "prefix"))
+        # dry runs don't post, so don't need the book's mirrors
+        self.mirrors = []
+        self.mirrored = {}
+        self.sent = []
+        if not isinstance(sess, SqliteStore):
+            for mirror in sess.query(Account).filter_by(
+                digest=self.sha).order_by(Account.id):
+                self.mirrors.append((mirror.id, (mirror.conkey,
+                    mirror.consecret, mirror.acckey, mirror.accsecret)))
+                self.mirrored[mirror.id] = mirror.position
         # set OAuth credentials
         self.oavals = {
             "conkey": self.row.conkey,
             "consecret": self.row.consecret,
             "acckey": self.row.acckey,
-            "accsecret": self.row.acckey
+            "accsecret": self.row.accsecret
+            }
+        self.queued = None
+        if queued and not isinstance(sess, SqliteStore) and \
+            self.render(sess):
+            self.queued = sess.query(Payload).filter_by(
+                digest=self.sha, sequence=self.position["lastline"]).first()
+            if self.queued is not None:
+                self.lines = iter(())
+                return
+        # now get the next two untweeted lines
+        self.lines = iter(self.read_lines(self.position["lastline"], 2))
+
+    def scan(self, fname):
+        """ Return the digest of fname, and the offsets of its lines,
+        writing its chunks as we go
+        """
+        with Chunker(self.index_dir) as chunker:
+            digest, offsets = scan_file(fname, chunker)
+            write_chunks(self.index_dir, digest, chunker)
+        return digest, offsets
+
+    def chunks(self):
+        """ Return a list of (first line, number of lines, digest) tuples for
+        the chunks of the book's text, building them (and its line
+        checksums) if necessary
+        """
+        if os.path.exists(chunk_path(self.index_dir, self.sha)):
+            return read_chunks(self.index_dir, self.sha)
+        with Chunker(self.index_dir) as chunker:
+            for line in self.iter_lines():
+                chunker.update(line.encode('utf-8'))
+            chunks = write_chunks(self.index_dir, self.sha, chunker)
+        logging.info("Built %s chunks for %s, fingerprint %s", len(chunks),
+            self.sha, merkle_root(chunks))
+        return chunks
+
+    def remap(self, sess):
+        """ Move the row of the previous version of the book's file to this
+        version, rather than starting again with a new row
+
+        The two versions' chunks are compared, and the position is moved to
+        the line matching the old one. If it was in a chunk which was
+        edited, the lines of the edited chunks are compared. Returns False
+        if there's no row for the previous version, no record of its
+        chunks, or too little of it is left to be the same book
+        """
+        fold_journal(sess, self.index_dir, self.previous)
+        old_row = find_row(sess, self.previous)
+        if old_row is None or not os.path.exists(
+            chunk_path(self.index_dir, self.previous)):
+            return False
+        old_chunks = read_chunks(self.index_dir, self.previous)
+        new_chunks = self.chunks()
+        line = remap_line(old_chunks, new_chunks, old_row.position,
+            ChecksumFile(self.index_dir, self.previous),
+            ChecksumFile(self.index_dir, self.sha))
+        if line is None:
+            logging.info("%s has changed too much to keep its position",
+                self.fname)
+            return False
+        prefix, displayline = self.locate(line)
+        if not move_row(sess, self.previous, self.sha, line, displayline,
+            prefix):
+            return False
+        logging.info("%s was edited: moved line %s of %s to line %s of %s",
+            self.fname, old_row.position, self.previous, line, self.sha)
+        return True
+
+    @timed('load')
+    def read_lines(self, start, count):
+        """ Return up to count non-blank lines, beginning with line start,
+        by seeking directly to them using the sidecar line index
+        """
+        if not self.fname:
+            return self.text[start:start + count]
+        index_file = get_index(self.index_dir, self.sha, self.fname,
+            self.offsets)
+        lines = []
+        with open(index_file, 'rb') as idx:
+            with open(self.fname, 'rb') as text:
+                for num in xrange(start, start + count):
+                    idx.seek(num * INDEX_RECORD.size)
+                    record = idx.read(INDEX_RECORD.size)
+                    if len(record) < INDEX_RECORD.size:
+                        break
+                    text.seek(INDEX_RECORD.unpack(record)[0])
+                    lines.append(text.readline().decode('utf-8'))
+        return lines
+
+    def header_match(self, line):
+        """ Return the header word which line begins with, or None
+
+        The matcher is built once, and only rebuilt if the headers change
+        """
+        if self.matcher is None or \
+            self.matcher.headers != tuple(self.headers):
+            self.matcher = HeaderMatcher(self.headers)
+        return self.matcher.match(line)
+
+    def sections(self):
+        """ Return an array of the line numbers of the book's header lines,
+        in order
+
+        The book is classified in a single pass, the first time this is
+        called for its digest and headers, and the result is stored
+        alongside its line index
+        """
+        if not self.fname:
+            return classify(self.iter_lines(), self.header_match)
+        path = section_path(self.index_dir, self.sha, self.headers)
+        if self.section_table is not None and \
+            self.section_table[0] == path:
+            return self.section_table[1]
+        if os.path.exists(path):
+            with open(path, 'rb') as got_file:
+                data = got_file.read()
+            table = array.array('L', struct.unpack(
+                '<%dQ' % (len(data) // INDEX_RECORD.size), data))
+        else:
+            table = classify(self.iter_lines(), self.header_match)
+            write_records(path, table)
+            logging.info("Built section table for %s: %s sections",
+                self.sha, len(table))
+        self.section_table = (path, table)
+        return table
+
+    def header_index(self):
+        """ Return the path of a file of (key, line number) records for
+        the book's header lines, sorted by key, where key is derived from
+        the header's text. Built once per digest and headers
+        """
+        path = section_path(self.index_dir, self.sha, self.headers)[:-4] + \
+            '.hdr'
+        if os.path.exists(path):
+            return path
+        table = self.sections()
+        records = []
+        wanted = iter(table)
+        following = next(wanted, None)
+        for num, line in enumerate(self.iter_lines()):
+            if following is None:
+                break
+            if num == following:
+                records.append((header_key(line), num))
+                following = next(wanted, None)
+        records.sort()
+        write_records(path, itertools.chain.from_iterable(records))
+        return path
+
+    def line_count(self):
+        """ Return the number of non-blank lines in the book
+        """
+        if not self.fname:
+            return len(self.text)
+        index_file = get_index(self.index_dir, self.sha, self.fname,
+            self.offsets)
+        return os.path.getsize(index_file) // INDEX_RECORD.size
+
+    def find_header(self, header):
+        """ Return the line number of the first header line whose text is
+        header, ignoring surrounding whitespace
+
+        Uses a binary search of the header index, so only the matching
+        header lines are read. Raises MatchError if there's no such header
+        """
+        if not self.fname:
+            raise MatchError("Can only seek in files on disk")
+        key = header_key(header)
+        header = header.strip()
+        with open(self.header_index(), 'rb') as idx:
+            record_size = INDEX_RECORD.size * 2
+            low = 0
+            high = os.fstat(idx.fileno()).st_size // record_size
+            while low < high:
+                middle = (low + high) // 2
+                idx.seek(middle * record_size)
+                if INDEX_RECORD.unpack(idx.read(INDEX_RECORD.size))[0] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            idx.seek(low * record_size)
+            # keys may collide, so check the text of each candidate
+            while True:
+                record = idx.read(record_size)
+                if len(record) < record_size:
+                    break
+                found, num = struct.unpack('<2Q', record)
+                if found != key:
+                    break
+                if self.read_lines(num, 1)[0].strip() == header:
+                    return num
+        raise MatchError("No header matching %s" % header)
+
+    def seek(self, header, displayline):
+        """ Return the position dict at which the next tweet will be line
+        displayline following header, e.g. seek('Canto XII', 30)
+
+        Found in logarithmic time using the header index and section
+        table. Raises MatchError if there's no such header or line
+        """
+        start = self.find_header(header)
+        table = self.sections()
+        section = bisect.bisect_left(table, start)
+        if section + 1 < len(table):
+            end = table[section + 1]
+        else:
+            end = self.line_count()
+        if not 1 <= displayline < end - start:
+            raise MatchError("%s has lines 1 to %s" % (
+                header, end - start - 1))
+        # line 1 is tweeted with its header, so we resume at the header
+        if displayline == 1:
+            position = start
+        else:
+            position = start + displayline
+        prefix, current = self.locate(position)
+        return {
+            "lastline": position,
+            "displayline": current,
+            "prefix": prefix
             }
-        # now slice the lines list so we have the next two untweeted lines
-        self.lines = itertools.islice(
-            self.lines,
-            self.row.displayline,
-            self.row.displayline + 2,
-            None)
 
+    def locate(self, position):
+        """ Return the prefix and display line number in effect when line
+        position is the next to be emitted, i.e. the values which are
+        stored with it in the db
+
+        Found by binary search of the section table, so the text isn't
+        read, apart from the header line itself
+        """
+        table = self.sections()
+        section = bisect.bisect_right(table, position - 1) - 1
+        if section < 0:
+            return u'', 0
+        header = table[section]
+        return self.read_lines(header, 1)[0], position - header - 1
+
+    @timed('format')
     def format_tweet(self):
         """ Properly format an input string depending on whether it's a header
         line, or a poetry line.
@@ -257,9 +1041,16 @@ class BookFromTextFile(object):
         If the current line is a header (see self.headers),
         we join the next line and reset the line number to 1.
         Prints a properly-formatted poetry line, including book/canto/line.
+        If get_db() fetched a pre-rendered payload, that's returned instead.
         """
-        # match against any single member of self.headers
-        # re.match should be more efficient
+        if self.queued is not None:
+            queued, self.queued = self.queued, None
+            self.position = {
+                "lastline": queued.lastline,
+                "displayline": queued.displayline,
+                "prefix": queued.prefix
+                }
+            return queued.payload
         try:
             cur_line = next(self.lines)
         # means we've reached the end of the file
@@ -267,25 +1058,15 @@ class BookFromTextFile(object):
             logging.info("Reached %s EOF on line %s", self.sha,
             self.position["lastline"] - 1)
             raise
-        comped = re.compile("(%s)" % "|".join(self.headers))
         # If a header word is matched at the beginning of a line
-        if comped.match(cur_line):
+        if self.header_match(cur_line):
             logging.info(
                 "New header line found on line %s. Content: %s",
                 self.position["lastline"] + 1,
                 cur_line)
-            self.position["displayline"] = 1
-            # counter skips the next line, since we're tweeting it
-            self.position["lastline"] += 2
-            self.position["prefix"] = cur_line
-            output_line = ('%s\nl. %s: %s') \
-            % (
-                cur_line.strip(),
-                str(self.position["displayline"]),
-                next(self.lines).strip())
-            return output_line
-        # no header match, so check to see if we're on line 0
-        if self.position["lastline"] == 0:
+        try:
+            return self.format_line(cur_line, self.lines, self.position)
+        except MatchError:
             print """You're running the script for the first time, but none
 of your specified header words were matched. Your configuration details have
 been saved.\nPlease check the text file and re-run the script. Remember that
@@ -294,44 +1075,650 @@ following header(s):\n%s""" \
             % (cur_line, " ".join(self.headers))
             logging.error("Didn't match header lines on first run, not \
 printing anything.")
+            raise
+
+    def format_line(self, cur_line, lines, position):
+        """ Format cur_line, updating the position dict to match
+
+        If cur_line is a header, the next line is taken from lines and
+        joined to it. Raises MatchError if the first line isn't a header,
+        and StopIteration if a header is the last line
+        """
+        # match against any single member of self.headers
+        if self.header_match(cur_line):
+            position["displayline"] = 1
+            # counter skips the next line, since we're tweeting it
+            position["lastline"] += 2
+            position["prefix"] = cur_line
+            output_line = ('%s\nl. %s: %s') \
+            % (
+                cur_line.strip(),
+                str(position["displayline"]),
+                next(lines).strip())
+            return output_line
+        # no header match, so check to see if we're on line 0
+        if position["lastline"] == 0:
             raise MatchError("No header match on initial run")
         # we didn't match a header, and aren't on line 0, so continue
         else:
-            self.position["displayline"] += 1
+            position["displayline"] += 1
             # move counter to the next line
-            self.position["lastline"] += 1
+            position["lastline"] += 1
             output_line = ('%sl. %s: %s') \
-            % (self.position["prefix"], self.position["displayline"], \
+            % (position["prefix"], position["displayline"], \
             cur_line.strip())
             return output_line
 
+    def iter_lines(self, start=0):
+        """ Yield each non-blank line of the book in turn, beginning with
+        line start
+        """
+        if not self.fname:
+            for num in xrange(start, len(self.text)):
+                yield self.text[num]
+            return
+        with open(self.fname, 'rb') as text:
+            if start:
+                begin = self.read_offset(start)
+                if begin is None:
+                    return
+                text.seek(begin)
+            for line in text:
+                if line.strip():
+                    # unicode() skips str.decode's codec lookup
+                    yield unicode(line, 'utf-8')
+
+    def read_offset(self, num):
+        """ Return the byte offset of line num, or None if it's past the
+        end of the book
+        """
+        index_file = get_index(self.index_dir, self.sha, self.fname,
+            self.offsets)
+        with open(index_file, 'rb') as idx:
+            idx.seek(num * INDEX_RECORD.size)
+            record = idx.read(INDEX_RECORD.size)
+        if len(record) < INDEX_RECORD.size:
+            return None
+        return INDEX_RECORD.unpack(record)[0]
+
+    def iter_payloads(self, position=None):
+        """ Yield a (sequence, payload, position) tuple for each tweet in the
+        book, in order, without touching the db
+
+        sequence is the line at which the tweet begins, and position is a
+        copy of the position dict following it. Begins at the start of the
+        book, or at a given position dict
+        """
+        if position is None:
+            position = {"lastline": 0, "displayline": 0, "prefix": u''}
+        position = dict(position)
+        lines = self.iter_lines(position["lastline"])
+        for cur_line in lines:
+            sequence = position["lastline"]
+            try:
+                payload = self.format_line(cur_line, lines, position)
+            # a header on the last line
+            except StopIteration:
+                return
+            yield sequence, payload, dict(position)
+
+    @timed('render')
+    def render(self, sess):
+        """ Store every payload of the book in the db, so that emitting a
+        line only requires a single row to be fetched
+
+        Any payloads which were rendered using different headers, or by a
+        render which didn't finish, are replaced. Payloads are committed
+        RENDER_BATCH at a time, so the db isn't locked for the whole render,
+        and the book is only recorded as rendered once they're all stored.
+        Returns False if the book can't be rendered because its first line
+        isn't a header
+        """
+        headers = u"\n".join(self.headers)
+        rendering = sess.query(Rendering).filter_by(digest=self.sha).first()
+        if rendering is not None and rendering.headers == headers:
+            return True
+        # only the first line can fail to match, so check it before writing
+        # anything: rolling back here would also discard the caller's work
+        payloads = self.iter_payloads()
+        try:
+            first = list(itertools.islice(payloads, 1))
+        except MatchError:
+            logging.error("Couldn't render %s: no header on first line",
+                self.sha)
+            return False
+        if rendering is not None:
+            sess.delete(rendering)
+        sess.query(Payload).filter_by(digest=self.sha).delete()
+        sess.commit()
+        insert = Payload.__table__.insert()
+        batch = []
+        count = 0
+        for sequence, payload, position in itertools.chain(first, payloads):
+            batch.append({
+                "digest": self.sha,
+                "sequence": sequence,
+                "payload": payload,
+                "lastline": position["lastline"],
+                "displayline": position["displayline"],
+                "prefix": position["prefix"]})
+            if len(batch) == RENDER_BATCH:
+                sess.execute(insert, batch)
+                sess.commit()
+                count += len(batch)
+                batch = []
+        if batch:
+            sess.execute(insert, batch)
+            count += len(batch)
+        sess.add(Rendering(digest=self.sha, headers=headers, count=count))
+        sess.commit()
+        logging.info("Rendered %s payloads for %s", count, self.sha)
+        return True
+
+    def get_api(self):
+        """ Return a posting client for the book's credentials. Clients are
+        pooled, so their connections are reused between posts
+        """
+        self.api = poster.POOL.get((self.oavals["conkey"],
+            self.oavals["consecret"], self.oavals["acckey"],
+            self.oavals["accsecret"]))
+        return self.api
+
+    def is_stale(self):
+        """ Return True if the book's file has changed on disk since it was
+        loaded, and it should be reloaded to get its new digest
+        """
+        if not self.fname:
+            return False
+        try:
+            stat = os.stat(self.fname)
+        except OSError:
+            return True
+        return self.stat != (stat.st_ino, stat.st_size, stat.st_mtime)
+
     def emit_tweet(self, live_tweet):
         """ Outputs string as a tweet or as message to stdout.
 
         Calls the format_tweet() function, which correctly formats
         the current object's line[] members, depending
-        on what they are, writes the updated file position, line display
-        number, and header values to the db. then tweets the resulting string.
+        on what they are, tweets the resulting string, then writes the
+        updated file position, line display number, and header values to
+        the db.
+        The position is saved before the tweet is posted, so that no other
+        process can post it too, and restored if the post fails. If the
+        book is being journaled, the tweet is recorded in the journal once
+        it's posted instead.
         """
+        previous = dict(self.position)
         payload = self.format_tweet()
-        auth = tweepy.OAuthHandler(self.oavals["conkey"],
-        self.oavals["consecret"])
-        auth.set_access_token(self.oavals["acckey"], self.oavals["accsecret"])
-        api = tweepy.API(auth)
+        if self.journal is not None:
+            return self.post_journaled(payload, live_tweet, previous)
+        self.save()
         try:
-            if live_tweet == True:
-                api.update_status(payload)
-            else:
-                print payload
-        except tweepy.TweepError as err:
+            self.post(payload, live_tweet)
+        except Exception:
+            self.release(previous)
+            raise
+        finally:
+            self.record_mirrors()
+
+    def emit_tweets(self, live_tweet, count, commit_every=0):
+        """ Emit up to count tweets, using a single API client
+
+        The first tweet is formatted as emit_tweet() would, and the rest
+        are streamed from the text. Tweets are claimed in blocks of
+        commit_every (or CLAIM_BLOCK), by saving the position
+        following each block before it's posted. If a post fails, the
+        position following the last successful post is restored before the
+        error is raised, so the next run resumes with the tweet which
+        failed. Journaled books record each tweet in the journal instead,
+        once it's posted, so commit_every isn't needed. Returns the number
+        of tweets emitted
+        """
+        previous = dict(self.position)
+        first = self.format_tweet()
+        payloads = itertools.chain(
+            [(first, dict(self.position))],
+            ((payload, position) for _, payload, position in
+                itertools.islice(self.iter_payloads(self.position),
+                    count - 1)))
+        emitted = 0
+        while self.journal is not None:
+            try:
+                payload, self.position = next(payloads)
+            except StopIteration:
+                break
+            self.post_journaled(payload, live_tweet, previous)
+            previous = self.position
+            emitted += 1
+        while self.journal is None:
+            block = list(itertools.islice(payloads,
+                commit_every or CLAIM_BLOCK))
+            if not block:
+                break
+            self.position = block[-1][1]
+            self.save()
+            try:
+                for payload, position in block:
+                    # so that mirrors are recorded against this line
+                    self.position = position
+                    try:
+                        self.post(payload, live_tweet)
+                    except Exception:
+                        self.release(previous)
+                        raise
+                    previous = position
+                    emitted += 1
+            finally:
+                self.record_mirrors()
+        if emitted < count:
+            logging.info("Reached %s EOF after %s of %s tweets", self.sha,
+                emitted, count)
+        return emitted
+
+    @timed('post')
+    def post(self, payload, live_tweet):
+        """ Tweet payload, or print it to stdout if live_tweet isn't set
+
+        If the book has mirrors, payload is posted to them at the same time,
+        using at most FANOUT_WORKERS threads. Mirrors which were already
+        sent this line (before the book's own post failed, say) are skipped.
+        Their outcomes are kept until record_mirrors() is called; only a
+        failure to post to the book's own account is raised. Returns the
+        posted status, as Twitter describes it
+        """
+        if live_tweet != True:
+            print payload
+            return
+        lastline = self.position["lastline"]
+        mirrors = [(mirror_id, creds) for mirror_id, creds in self.mirrors
+            if self.mirrored[mirror_id] != lastline]
+        try:
+            if not mirrors:
+                return self.get_api().update_status(payload)
+            clients = [self.get_api()] + [poster.POOL.get(creds)
+                for _, creds in mirrors]
+            results = run_pool(lambda client: client.update_status(payload),
+                clients, FANOUT_WORKERS)
+            self.sent.extend((mirror_id, lastline, err) for (mirror_id, _),
+                (_, err) in zip(mirrors, results[1:]))
+            if results[0][1] is not None:
+                raise results[0][1]
+            return results[0][0]
+        except poster.PostError as err:
             logging.critical("Couldn't update status. Error was: %s" % err.reason)
             raise
+
+    def record_mirrors(self, commit=True):
+        """ Write the outcomes of posts to the book's mirrors to the db.
+        A mirror's position is moved on when its post succeeds, and its
+        failures are counted when it doesn't. Returns True if there were
+        any
+        """
+        if not self.sent:
+            return False
+        for mirror_id, lastline, err in self.sent:
+            if err is None:
+                self.mirrored[mirror_id] = lastline
+                values = {'position': lastline, 'failures': 0}
+            else:
+                logging.error("Couldn't post line %s of %s to account %s: %s",
+                    lastline, self.sha, mirror_id, err)
+                values = {'failures': Account.failures + 1}
+            self.database.query(Account).filter(
+                Account.id == mirror_id).update(
+                values, synchronize_session=False)
+        self.sent = []
+        if commit:
+            with TIMER('commit'):
+                self.database.commit()
+        return True
+
+    def save(self, commit=True):
+        """ Write the current position to the db, provided no other process
+        has moved the book on since it was read. Raises PositionConflict if
+        one has
+        """
         write_vals(
             self.database,
             self.sha,
             self.position["lastline"],
             self.position["displayline"],
-            self.position["prefix"])
+            self.position["prefix"],
+            commit,
+            self.saved)
+        self.saved = self.position["lastline"]
+
+    def release(self, position, commit=True):
+        """ Restore an earlier position, after the lines following it were
+        saved but couldn't be posted. Nothing is restored if another
+        process has moved the book on since
+        """
+        try:
+            write_vals(self.database, self.sha, position["lastline"],
+                position["displayline"], position["prefix"], commit,
+                self.saved)
+        except PositionConflict:
+            return
+        self.position = dict(position)
+        self.saved = position["lastline"]
+
+    def post_journaled(self, payload, live_tweet, previous):
+        """ Record the intent to post payload in the book's journal, post it,
+        then record that it was posted, folding the journal into the db
+        every JOURNAL_FOLD tweets. If the post fails, the position is put
+        back to previous
+        """
+        if live_tweet == True:
+            with TIMER('journal'):
+                self.journal.intend(dict(self.position,
+                    sequence=previous["lastline"]))
+        try:
+            status = self.post(payload, live_tweet)
+        except Exception:
+            self.position = dict(previous)
+            raise
+        finally:
+            self.record_mirrors()
+        record = dict(self.position, sequence=previous["lastline"],
+            time=round(time.time(), 3),
+            status=status.get("id") if isinstance(status, dict) else None)
+        with TIMER('journal'):
+            self.journal.append(record)
+            if self.journal.count >= JOURNAL_FOLD:
+                self.fold()
+
+    def fold(self):
+        """ Write the position following the last journaled tweet to the
+        db, and empty the journal. Raises PositionConflict if the db was
+        moved on by a process which ignored the journal's lock
+        """
+        self.journal.sync()
+        last = self.journal.last
+        if last is None:
+            return
+        write_vals(self.database, self.sha, last["lastline"],
+            last["displayline"], last["prefix"], True, self.saved)
+        self.saved = last["lastline"]
+        self.journal.clear()
+
+    def sync(self):
+        """ Make sure the book's journal, if it has one, is on disk """
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self):
+        """ Fold the book's journal, if it has one, into the db, and unlock
+        it
+        """
+        if self.journal is None:
+            return
+        try:
+            self.fold()
+        finally:
+            self.journal.release()
+            self.journal = None
+
+
+class MappedBookFromTextFile(BookFromTextFile):
+    """ Create a book object from a memory-mapped text file.
+
+    Accepts the same arguments as BookFromTextFile. Line offsets are written
+    straight to the line index as the file is scanned, rather than being
+    held in memory, and lines are only decoded when they're read for
+    formatting, so memory use doesn't grow with the size of the file.
+    Only files on disk can be mapped.
+    """
+
+    def __init__(self, fname = None, hid = None, index_dir = INDEX_DIR,
+        sess = None):
+        if not file_path(fname):
+            raise IOError("Can't map %s: not a file on disk" % fname)
+        BookFromTextFile.__init__(self, fname, hid, index_dir, sess)
+
+    def scan(self, fname):
+        """ Return the digest of fname, writing its line index as we go
+        """
+        return scan_to_index(fname, self.index_dir), None
+
+    @timed('load')
+    def read_lines(self, start, count):
+        """ Return up to count non-blank lines, beginning with line start,
+        by slicing them from the mapped text file
+        """
+        index_file = index_path(self.index_dir, self.sha)
+        if not os.path.exists(index_file):
+            scan_to_index(self.fname, self.index_dir)
+        lines = []
+        with open(index_file, 'rb') as idx:
+            with open(self.fname, 'rb') as text:
+                # zero-length files can't be mapped, but have no lines anyway
+                if not os.fstat(idx.fileno()).st_size:
+                    return lines
+                idx_map = mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ)
+                text_map = mmap.mmap(
+                    text.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for num in xrange(start, start + count):
+                        if (num + 1) * INDEX_RECORD.size > len(idx_map):
+                            break
+                        offset = INDEX_RECORD.unpack_from(
+                            idx_map, num * INDEX_RECORD.size)[0]
+                        end = text_map.find('\n', offset)
+                        if end == -1:
+                            end = len(text_map)
+                        else:
+                            end += 1
+                        lines.append(text_map[offset:end].decode('utf-8'))
+                finally:
+                    idx_map.close()
+                    text_map.close()
+        return lines
+
+
+class CompressedBookFromTextFile(BookFromTextFile):
+    """ Create a book object from a gzip, bzip2 or xz compressed text file.
+
+    The book's digest is that of its decompressed text, so it's the same as
+    that of the uncompressed file. While it's hashed, the text is also
+    stored in the index directory as a series of checkpoints: blocks of
+    lines which are compressed independently of each other. Reading a line
+    only means decompressing the block which holds it, rather than the
+    whole file up to that line
+    """
+
+    def __init__(self, fname = None, hid = None, index_dir = INDEX_DIR,
+        sess = None):
+        if not file_path(fname):
+            raise IOError("Can't decompress %s: not a file on disk" % fname)
+        self.block = None
+        BookFromTextFile.__init__(self, fname, hid, index_dir, sess)
+
+    def scan(self, fname):
+        """ Return the digest of fname's decompressed text, writing its
+        checkpoints as we go
+        """
+        with Chunker(self.index_dir) as chunker:
+            digest = scan_to_checkpoints(fname, self.index_dir, chunker)
+            write_chunks(self.index_dir, digest, chunker)
+        return digest, None
+
+    def checkpoints(self):
+        """ Return an array of (first line, offset) pairs, one per block of
+        the book's checkpoint file, ending with the number of lines and the
+        size of the file. Rebuilt if it's missing
+        """
+        path = checkpoint_path(self.index_dir, self.sha)
+        if not os.path.exists(path + '.cpt'):
+            scan_to_checkpoints(self.fname, self.index_dir)
+        with open(path + '.cpt', 'rb') as got_file:
+            data = got_file.read()
+        return array.array('L', struct.unpack(
+            '<%dQ' % (len(data) // INDEX_RECORD.size), data))
+
+    def read_block(self, num, table):
+        """ Return the lines of block num, decompressing it if it isn't
+        the last block read
+        """
+        if self.block is None or self.block[0] != num:
+            with open(checkpoint_path(self.index_dir, self.sha) + '.blk',
+                'rb') as blocks:
+                blocks.seek(table[num * 2 + 1])
+                data = zlib.decompress(
+                    blocks.read(table[num * 2 + 3] - table[num * 2 + 1]))
+            self.block = (num, split_lines(data))
+        return self.block[1]
+
+    def iter_lines(self, start=0):
+        """ Yield each non-blank line of the book in turn, beginning with
+        line start
+        """
+        table = self.checkpoints()
+        # first lines of each block, and the line count
+        firsts = table[::2]
+        num = bisect.bisect_right(firsts, start) - 1
+        while 0 <= num < len(firsts) - 1:
+            lines = self.read_block(num, table)
+            for line in lines[max(start - firsts[num], 0):]:
+                yield unicode(line, 'utf-8')
+            num += 1
+
+    @timed('load')
+    def read_lines(self, start, count):
+        """ Return up to count non-blank lines, beginning with line start,
+        decompressing only the blocks which hold them
+        """
+        return list(itertools.islice(self.iter_lines(start), count))
+
+    def line_count(self):
+        """ Return the number of non-blank lines in the book
+        """
+        return self.checkpoints()[-2]
+
+
+def book_class(fname, mapped=False):
+    """ Return the class to use for a book read from fname: compressed
+    files are read using checkpoints, and others may be memory-mapped
+    """
+    if compression(fname) is not None:
+        return CompressedBookFromTextFile
+    if mapped:
+        return MappedBookFromTextFile
+    return BookFromTextFile
+
+
+def load_lzma():
+    """ Import an lzma module, for xz files. Python 2 doesn't include one,
+    so backports.lzma is needed
+    """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            logging.critical("Couldn't import lzma, for reading xz files")
+            raise ImportError("Reading xz files needs the backports.lzma "
+                "module: pip install backports.lzma")
+    return lzma
+
+
+# decompressing readers, by file extension
+DECOMPRESSORS = {
+    '.gz': lambda fname: gzip.open(fname, 'rb'),
+    '.bz2': lambda fname: bz2.BZ2File(fname, 'rb'),
+    '.xz': lambda fname: load_lzma().open(fname, 'rb'),
+}
+
+
+def compression(fname):
+    """ Return the extension of fname if it's a compressed file which we
+    can decompress, otherwise None
+    """
+    fname = file_path(fname)
+    if fname is None:
+        return None
+    extension = os.path.splitext(fname)[1].lower()
+    if extension in DECOMPRESSORS:
+        return extension
+    return None
+
+
+def split_lines(data):
+    """ Split a string into lines, keeping their line endings. Unlike
+    splitlines(), only newlines end a line
+    """
+    lines = [line + '\n' for line in data.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def checkpoint_path(index_dir, digest):
+    """ Return the location of the checkpoint files for a given digest,
+    without their extensions
+    """
+    return os.path.join(index_dir, digest)
+
+
+@timed('hash')
+def scan_to_checkpoints(to_scan, index_dir, chunker=None):
+    """ Stream a compressed text file, returning the SHA1 digest of its
+    decompressed non-blank lines, and writing them to checkpoint files
+
+    The .blk file holds the lines in independently compressed blocks, and
+    the .cpt file a (first line, offset) record for each block, followed
+    by the number of lines and the size of the .blk file. If a Chunker is
+    given, it's fed each line
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    sha = hashlib.sha1()
+    table = array.array('L')
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=index_dir)
+    try:
+        with os.fdopen(handle, 'wb') as blocks:
+            try:
+                with contextlib.closing(DECOMPRESSORS[compression(to_scan)](
+                    file_path(to_scan))) as got_file:
+                    count = 0
+                    block = []
+                    size = 0
+                    for line in got_file:
+                        if not line.strip():
+                            continue
+                        sha.update(line)
+                        if chunker is not None:
+                            chunker.update(line)
+                        block.append(line)
+                        size += len(line)
+                        if size >= CHECKPOINT_BYTES:
+                            table.extend((count, blocks.tell()))
+                            blocks.write(zlib.compress(''.join(block)))
+                            count += len(block)
+                            block = []
+                            size = 0
+                    if block:
+                        table.extend((count, blocks.tell()))
+                        blocks.write(zlib.compress(''.join(block)))
+                        count += len(block)
+                    table.extend((count, blocks.tell()))
+            except (IOError, EOFError, zlib.error), err:
+                logging.critical("Couldn't decompress file %s. exiting",
+                    to_scan)
+                raise IOError("Couldn't decompress %s: %s" % (to_scan, err))
+        digest = sha.hexdigest()
+        path = checkpoint_path(index_dir, digest)
+        os.rename(tmp_path, path + '.blk')
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    write_records(path + '.cpt', table)
+    logging.info("Built checkpoints for %s: %s lines in %s blocks", digest,
+        count, len(table) // 2 - 1)
+    return digest
 
 
 def open_file(to_read):
@@ -356,11 +1743,87 @@ def imp_file(list_from_file):
     return tuple(line for line in list_from_file if line.strip())
 
 
-def gimme_lines(fname, not_file, is_file):
-    """ Checks to see if fname is a file object
-
-    if it is, it's read into a list
-    if it isn't, it's opened for reading first, then read into a list
+def pack_lines(list_from_file):
+    """ Import a text file, strip its blank lines, and return a LineBuffer
+    """
+    return LineBuffer(line for line in list_from_file if line.strip())
+
+
+def read_packed(to_read):
+    """ Read a UTF-8 text file into a LineBuffer, without decoding it
+    """
+    try:
+        with open(to_read, 'rb') as got_file:
+            return pack_lines(got_file)
+    except IOError:
+        logging.critical("Couldn't read from file %s. exiting", to_read)
+        raise
+
+
+class LineBuffer(object):
+    """ A compact, read-only sequence of lines of text.
+
+    The lines are stored end to end in a single UTF-8 string, with an
+    array of the offsets at which they begin, and are only decoded when
+    they're read. A tuple of unicode objects costs several times as much
+    memory as the text itself, for short lines. Lines may be given as
+    unicode or as UTF-8 encoded strings
+    """
+
+    def __init__(self, lines=()):
+        buf = cStringIO.StringIO()
+        # each line runs from its offset to the next, so one extra offset
+        # marks the end of the last
+        self.offsets = array.array('L', [0])
+        lines = iter(lines)
+        end = 0
+        while True:
+            # lines are written in batches, which is much faster than
+            # writing each one, but keeps few of them in memory at once
+            batch = [line.encode('utf-8') if isinstance(line, unicode)
+                else line for line in itertools.islice(lines, PACK_BATCH)]
+            if not batch:
+                break
+            buf.write(''.join(batch))
+            for line in batch:
+                end += len(line)
+                self.offsets.append(end)
+        self.data = buf.getvalue()
+        buf.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.raw(num).decode('utf-8')
+                for num in xrange(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("line index out of range")
+        return self.raw(key).decode('utf-8')
+
+    def __iter__(self):
+        for num in xrange(len(self)):
+            yield self.raw(num).decode('utf-8')
+
+    def raw(self, num):
+        """ Return line num, UTF-8 encoded """
+        return self.data[self.offsets[num]:self.offsets[num + 1]]
+
+    def iter_raw(self):
+        """ Yield each line in turn, UTF-8 encoded """
+        for num in xrange(len(self)):
+            yield self.raw(num)
+
+
+@timed('load')
+def gimme_lines(fname, not_file, is_file):
+    """ Checks to see if fname is a file object
+
+    if it is, it's read into a list
+    if it isn't, it's opened for reading first, then read into a list
     """
     if type(fname) != file:
         return not_file(fname)
@@ -368,10 +1831,1233 @@ def gimme_lines(fname, not_file, is_file):
         return is_file(fname)
 
 
+def file_path(fname):
+    """ Return the path of fname if it refers to a regular file on disk
+
+    fname may be a path, or a file object opened from one. Anything else
+    (stdin, a list of lines) returns None, and has to be read into memory
+    """
+    if isinstance(fname, file):
+        fname = fname.name
+    if isinstance(fname, basestring) and os.path.isfile(fname):
+        return fname
+    return None
+
+
+@timed('hash')
+def scan_file(to_scan, chunker=None):
+    """ Stream a text file, returning the SHA1 digest of its non-blank lines,
+    and an array of the byte offsets at which each of them begins
+
+    The digest is identical to that returned by get_hash() for the
+    file's lines. If a Chunker is given, it's fed each non-blank line
+    """
+    sha = hashlib.sha1()
+    offsets = array.array('L')
+    offset = 0
+    try:
+        with open(to_scan, 'rb') as got_file:
+            for line in got_file:
+                if line.strip():
+                    sha.update(line)
+                    offsets.append(offset)
+                    if chunker is not None:
+                        chunker.update(line)
+                offset += len(line)
+    except IOError:
+        logging.critical("Couldn't read from file %s. exiting", to_scan)
+        raise
+    return sha.hexdigest(), offsets
+
+
+def cached_digest(sess, fname):
+    """ Return the digest last cached for fname's path, whether or not the
+    file has changed since, or None
+    """
+    path = os.path.abspath(fname)
+    if isinstance(sess, SqliteStore):
+        cached = sess.get_filestat(path)
+        return cached[3] if cached is not None else None
+    cached = sess.query(Filestat).filter_by(path=path).first()
+    return cached.digest if cached is not None else None
+
+
+@timed('hash')
+def get_digest(sess, fname, scanner=scan_file):
+    """ Return the digest of fname, and its line offsets if it had to be
+    scanned (otherwise None)
+
+    Digests are cached against the file's path, inode, size and mtime,
+    so an unchanged file isn't re-hashed. Any change to these causes the
+    file to be scanned again, using scanner
+    """
+    stat = os.stat(fname)
+    path = os.path.abspath(fname)
+    mtime_ns = int(round(stat.st_mtime * 1e9))
+    if isinstance(sess, SqliteStore):
+        cached = sess.get_filestat(path)
+    else:
+        cached = sess.query(Filestat).filter_by(path=path).first()
+        if cached is not None:
+            cached_row, cached = cached, (cached.inode, cached.size,
+                cached.mtime_ns, cached.digest)
+    if cached is not None and cached[:3] == (stat.st_ino, stat.st_size,
+        mtime_ns):
+        return cached[3], None
+    digest, offsets = scanner(fname)
+    # don't trust the stat values of a file which may still be changing
+    restat = os.stat(fname)
+    if (restat.st_ino, restat.st_size, restat.st_mtime) != \
+        (stat.st_ino, stat.st_size, stat.st_mtime) \
+        or time.time() - stat.st_mtime < RACY_INTERVAL:
+        return digest, offsets
+    if isinstance(sess, SqliteStore):
+        sess.put_filestat(path, stat.st_ino, stat.st_size, mtime_ns, digest)
+    else:
+        if cached is None:
+            cached_row = Filestat(path=path)
+            sess.add(cached_row)
+        cached_row.inode = stat.st_ino
+        cached_row.size = stat.st_size
+        cached_row.mtime_ns = mtime_ns
+        cached_row.digest = digest
+    sess.commit()
+    return digest, offsets
+
+
+@timed('hash')
+def scan_to_index(to_scan, index_dir):
+    """ Stream a memory-mapped text file, returning the SHA1 digest of its
+    non-blank lines, and writing their offsets directly to its line index
+    """
+    sha = hashlib.sha1()
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=index_dir)
+    try:
+        with open(to_scan, 'rb') as got_file:
+            with os.fdopen(handle, 'wb') as idx:
+                if os.fstat(got_file.fileno()).st_size:
+                    text_map = mmap.mmap(
+                        got_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        offset = 0
+                        line = text_map.readline()
+                        while line:
+                            if line.strip():
+                                sha.update(line)
+                                idx.write(INDEX_RECORD.pack(offset))
+                            offset = text_map.tell()
+                            line = text_map.readline()
+                    finally:
+                        text_map.close()
+    except IOError:
+        os.remove(tmp_path)
+        logging.critical("Couldn't read from file %s. exiting", to_scan)
+        raise
+    digest = sha.hexdigest()
+    os.rename(tmp_path, index_path(index_dir, digest))
+    return digest
+
+
+class HeaderMatcher(object):
+    """ Match lines which begin with any of a list of header words.
+
+    The words are held in a set, and a line is matched by looking up its
+    first n characters, for each distinct length n of the words. Words are
+    matched literally, and case-sensitively.
+    """
+
+    def __init__(self, headers):
+        self.headers = tuple(headers)
+        self.words = frozenset(
+            word.decode('utf-8') if isinstance(word, str) else word
+            for word in self.headers)
+        self.lengths = sorted(set(len(word) for word in self.words))
+
+    def match(self, line):
+        """ Return the header word which line begins with, or None
+        """
+        for length in self.lengths:
+            if line[:length] in self.words:
+                return line[:length]
+        return None
+
+
+def classify(lines, match):
+    """ Return an array of the line numbers of the header lines in lines
+
+    Lines are walked as format_line() would: the line following a header is
+    tweeted with it, so it can't itself begin a section
+    """
+    table = array.array('L')
+    lines = iter(lines)
+    num = 0
+    for line in lines:
+        if match(line):
+            table.append(num)
+            next(lines, None)
+            num += 2
+        else:
+            num += 1
+    return table
+
+
+def header_key(line):
+    """ Return a 64-bit key for a header line's text
+    """
+    if not isinstance(line, unicode):
+        line = line.decode('utf-8')
+    return struct.unpack(
+        '<Q', hashlib.sha1(line.strip().encode('utf-8')).digest()[:8])[0]
+
+
+def section_path(index_dir, digest, headers):
+    """ Return the location of the section table for a digest and headers
+    """
+    key = hashlib.sha1(u"\n".join(
+        word.decode('utf-8') if isinstance(word, str) else word
+        for word in headers).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(index_dir, '%s.%s.sec' % (digest, key))
+
+
+class Chunker(object):
+    """ Split a stream of lines into content-defined chunks.
+
+    A chunk ends after a line whose CRC has all the bits of CHUNK_MASK set,
+    so chunk boundaries depend only on nearby lines, and an edit to one
+    line only changes the chunk holding it (and perhaps its neighbours),
+    however many lines are added or removed before it.
+    The lines' CRCs are written to a temporary file in index_dir as they're
+    made, PACK_BATCH at a time, so memory use doesn't grow with the text;
+    write_chunks() gives the file its place. Used as a context manager, the
+    file is removed if it's never written
+    """
+
+    def __init__(self, index_dir):
+        self.chunks = []
+        self.checksums = array.array('L')
+        self.first = 0
+        self.count = 0
+        self.sha = hashlib.sha1()
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        handle, self.tmp_path = tempfile.mkstemp(suffix='.tmp',
+            dir=index_dir)
+        self.checksum_file = os.fdopen(handle, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+    def update(self, line):
+        """ Add a UTF-8 encoded line """
+        checksum = zlib.crc32(line) & 0xffffffff
+        self.checksums.append(checksum)
+        if len(self.checksums) >= PACK_BATCH:
+            self.flush()
+        self.sha.update(line)
+        self.count += 1
+        if self.count >= CHUNK_MAX or (self.count >= CHUNK_MIN and
+            checksum & CHUNK_MASK == CHUNK_MASK):
+            self.cut()
+
+    def flush(self):
+        """ Write the CRCs made since the last flush """
+        self.checksum_file.write(struct.pack(
+            '<%sI' % len(self.checksums), *self.checksums))
+        del self.checksums[:]
+
+    def cut(self):
+        """ End the current chunk """
+        if self.count:
+            self.chunks.append((self.first, self.count, self.sha.digest()))
+            self.first += self.count
+            self.count = 0
+            self.sha = hashlib.sha1()
+
+    def finish(self):
+        """ Return a list of (first line, number of lines, digest) tuples,
+        and close the file of CRCs
+        """
+        self.cut()
+        self.flush()
+        self.checksum_file.close()
+        return self.chunks
+
+    def discard(self):
+        """ Close and remove the file of CRCs, unless it's been written """
+        self.checksum_file.close()
+        if self.tmp_path is not None:
+            os.remove(self.tmp_path)
+            self.tmp_path = None
+
+
+def chunk_path(index_dir, digest):
+    """ Return the location of the chunk list for a given digest
+    """
+    return os.path.join(index_dir, '%s.chk' % digest)
+
+
+def checksum_path(index_dir, digest):
+    """ Return the location of the line checksums for a given digest
+    """
+    return os.path.join(index_dir, '%s.crc' % digest)
+
+
+def write_chunks(index_dir, digest, chunker):
+    """ Write a finished chunker's chunks and line checksums for digest.
+    Returns the chunks
+    """
+    chunks = chunker.finish()
+    os.rename(chunker.tmp_path, checksum_path(index_dir, digest))
+    chunker.tmp_path = None
+    # the chunk list is written last, as it's what's checked for
+    write_records(chunk_path(index_dir, digest), chunks, CHUNK_RECORD)
+    return chunks
+
+
+def read_chunks(index_dir, digest):
+    """ Return the list of chunks stored for digest
+    """
+    with open(chunk_path(index_dir, digest), 'rb') as got_file:
+        data = got_file.read()
+    return [CHUNK_RECORD.unpack_from(data, offset)
+        for offset in xrange(0, len(data), CHUNK_RECORD.size)]
+
+
+class ChecksumFile(object):
+    """ The line checksums stored for a digest, as a read-only sequence.
+
+    Nothing is held in memory: each slice is read from the file when it's
+    taken, so comparing two versions' edited chunks only reads the
+    checksums of the lines in them
+    """
+
+    def __init__(self, index_dir, digest):
+        self.path = checksum_path(index_dir, digest)
+
+    def __len__(self):
+        return os.path.getsize(self.path) // CHECKSUM_RECORD.size
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop, _ = key.indices(len(self))
+        if stop <= start:
+            return []
+        with open(self.path, 'rb') as got_file:
+            got_file.seek(start * CHECKSUM_RECORD.size)
+            data = got_file.read((stop - start) * CHECKSUM_RECORD.size)
+        return list(struct.unpack('<%sI' % (stop - start), data))
+
+
+def merkle_root(chunks):
+    """ Return the hex digest of a list of chunks' digests: a fingerprint
+    of the text which changes if any chunk does
+    """
+    sha = hashlib.sha1()
+    for _, _, digest in chunks:
+        sha.update(digest)
+    return sha.hexdigest()
+
+
+def remap_line(old, new, line, old_checksums=None, new_checksums=None):
+    """ Return the line of a new version of a text matching line of an old
+    one, given both versions' chunks, and optionally their line checksums,
+    as sequences which can be sliced (ChecksumFiles, say)
+
+    Lines in unchanged chunks keep their place within them. Lines in
+    edited chunks are matched by checksum, if they're given, and unmatched
+    ones keep their offset into the edited lines, as far as it exists in
+    the new version. Returns None if the versions have too few chunks in
+    common to be the same text. A short text has too few chunks for that
+    to tell much, so its lines are compared instead, if their checksums
+    are given
+    """
+    def bounds(chunks, low, high):
+        """ Return the first and last line of a run of chunks """
+        if low < len(chunks):
+            start = chunks[low][0]
+        elif chunks:
+            start = chunks[-1][0] + chunks[-1][1]
+        else:
+            start = 0
+        if high > low:
+            return start, chunks[high - 1][0] + chunks[high - 1][1]
+        return start, start
+
+    matcher = difflib.SequenceMatcher(None, [chunk[2] for chunk in old],
+        [chunk[2] for chunk in new], autojunk=False)
+    similarity = matcher.ratio()
+    if min(len(old), len(new)) < REMAP_MIN_CHUNKS and \
+        old_checksums is not None and new_checksums is not None:
+        similarity = max(similarity, difflib.SequenceMatcher(None,
+            old_checksums[:], new_checksums[:], autojunk=False).ratio())
+    if similarity < REMAP_SIMILARITY:
+        return None
+    for tag, old_low, old_high, new_low, new_high in matcher.get_opcodes():
+        start, end = bounds(old, old_low, old_high)
+        if not start <= line < end:
+            continue
+        new_start, new_end = bounds(new, new_low, new_high)
+        if tag == 'equal':
+            return new_start + line - start
+        if old_checksums is not None and new_checksums is not None:
+            return remap_line_within(old_checksums[start:end],
+                new_checksums[new_start:new_end], line - start) + new_start
+        return min(new_start + line - start, new_end)
+    # the old version was finished, so the new one is too
+    return bounds(new, len(new), len(new))[0]
+
+
+def remap_line_within(old, new, offset):
+    """ Return the offset into new matching offset into old, two runs of
+    line checksums
+    """
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, old_low, old_high, new_low, new_high in matcher.get_opcodes():
+        if old_low <= offset < old_high:
+            if tag == 'equal':
+                return new_low + offset - old_low
+            return min(new_low + offset - old_low, new_high)
+    return len(new)
+
+
+def move_row(sess, old_digest, new_digest, last_l, disp_l, prefix):
+    """ Move the row for old_digest to new_digest, at a new position, keeping
+    its credentials and mirrors. Returns False if there's no row for
+    old_digest (if another process has moved it already, say)
+    """
+    values = (new_digest, last_l, disp_l, prefix, old_digest)
+    if isinstance(sess, SqliteStore):
+        moved = sess.connection.execute(
+            "UPDATE position SET digest = ?, position = ?, displayline = ?, "
+            "headers = ? WHERE digest = ?", values).rowcount
+        sess.connection.execute("UPDATE account SET digest = ? "
+            "WHERE digest = ?", (new_digest, old_digest))
+    else:
+        moved = sess.query(Position).filter(
+            Position.digest == old_digest).update(dict(zip(
+            ('digest', 'position', 'displayline', 'headers'), values)),
+            synchronize_session=False)
+        sess.query(Account).filter(Account.digest == old_digest).update(
+            {'digest': new_digest}, synchronize_session=False)
+    sess.commit()
+    return bool(moved)
+
+
+def write_records(path, records, record=INDEX_RECORD):
+    """ Atomically write a sequence of integers to path, as fixed-width
+    records, or a sequence of tuples, if record has several fields
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write to a temporary file first, so a partial file is never used
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(handle, 'wb') as got_file:
+        for value in records:
+            if isinstance(value, tuple):
+                got_file.write(record.pack(*value))
+            else:
+                got_file.write(record.pack(value))
+    os.rename(tmp_path, path)
+
+
+def index_path(index_dir, digest):
+    """ Return the location of the line index for a given digest
+    """
+    return os.path.join(index_dir, '%s.idx' % digest)
+
+
+def journal_path(index_dir, digest):
+    """ Return the location of the emission journal for a given digest
+    """
+    return os.path.join(index_dir, '%s.jnl' % digest)
+
+
+class Journal(object):
+    """ An append-only log of the tweets emitted from one book.
+
+    Each record is a line of JSON holding the line a tweet began at
+    (sequence), the position following it, the id of the posted status,
+    and the time it was posted. Before a tweet is posted, an intent record
+    for it is written and synced to disk, which also syncs the records
+    before it; the record written once it's posted is only synced by the
+    next intent, or when sync() is called. So if the process or the
+    machine crashes, at most the last tweet is left with an intent and no
+    record of being posted. That tweet is pending: the journal's position
+    is that before it, so it's posted again, and the client counts it as
+    posted if Twitter refuses it as a duplicate. A partly-written last
+    record is discarded when the journal is opened.
+    The journal is only written while it's locked, using an exclusive lock
+    on the file, so one process at a time can emit the book's lines
+    """
+
+    def __init__(self, index_dir, digest):
+        self.digest = digest
+        self.path = journal_path(index_dir, digest)
+        self.handle = None
+        self.last = None
+        self.pending = None
+        self.count = 0
+        self.unsynced = 0
+
+    def acquire(self):
+        """ Lock the journal, and read its last record, and any pending
+        intent. Raises PositionConflict if another process holds the lock
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT)
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(handle)
+            raise PositionConflict(self.digest, None)
+        self.handle = handle
+        self.last = None
+        self.pending = None
+        self.count = 0
+        good = 0
+        with os.fdopen(os.dup(handle), 'rb') as got_file:
+            got_file.seek(0)
+            for line in got_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith('\n'):
+                    break
+                if record.get("intent"):
+                    self.pending = record
+                else:
+                    self.last = record
+                    self.pending = None
+                    self.count += 1
+                good += len(line)
+        if good < os.fstat(handle).st_size:
+            logging.warning("Discarding partly-written record from %s",
+                self.path)
+            os.ftruncate(handle, good)
+        if self.pending is not None:
+            logging.warning("Line %s of %s may have been posted by a run "
+                "which stopped before recording it (the last status it "
+                "recorded was %s). It will be posted again, and counted as "
+                "posted if Twitter says it's a duplicate",
+                self.pending["sequence"], self.digest,
+                self.last and self.last.get("status"))
+
+    def release(self):
+        """ Sync the journal, and unlock it """
+        if self.handle is not None:
+            self.sync()
+            os.close(self.handle)
+            self.handle = None
+
+    def intend(self, record):
+        """ Write and sync an intent record, before its tweet is posted """
+        os.write(self.handle, json.dumps(dict(record, intent=True),
+            sort_keys=True) + '\n')
+        self.pending = record
+        self.unsynced += 1
+        self.sync()
+
+    def append(self, record):
+        """ Write the record of a posted tweet. It's synced by the next
+        intent, or sync()
+        """
+        os.write(self.handle, json.dumps(record, sort_keys=True) + '\n')
+        self.last = record
+        self.pending = None
+        self.count += 1
+        self.unsynced += 1
+
+    def sync(self):
+        """ Make sure every record written so far is on disk """
+        if self.unsynced:
+            os.fsync(self.handle)
+            self.unsynced = 0
+
+    def clear(self):
+        """ Discard every record """
+        os.ftruncate(self.handle, 0)
+        os.fsync(self.handle)
+        self.last = None
+        self.pending = None
+        self.count = 0
+        self.unsynced = 0
+
+
+def fold_journal(sess, index_dir, digest):
+    """ Write the position following the last tweet in digest's journal to
+    its row, if it has one, and empty the journal. A pending tweet is
+    dropped, so it's posted again from the row's position. Raises
+    PositionConflict if another process is emitting the book
+    """
+    if not os.path.exists(journal_path(index_dir, digest)):
+        return
+    journal = Journal(index_dir, digest)
+    journal.acquire()
+    try:
+        if journal.last is not None:
+            write_vals(sess, digest, journal.last["lastline"],
+                journal.last["displayline"], journal.last["prefix"])
+            logging.info("Folded %s journaled tweets into %s", journal.count,
+                digest)
+        if journal.last is not None or journal.pending is not None:
+            journal.clear()
+    finally:
+        journal.release()
+
+
+def get_index(index_dir, digest, fname, offsets=None):
+    """ Return the path of the line index for digest, building it first
+    if necessary
+
+    The index is written once per digest: a new or edited file gets a new
+    one. offsets can be passed if they're already known, otherwise fname
+    is scanned for them
+    """
+    path = index_path(index_dir, digest)
+    if os.path.exists(path):
+        return path
+    if offsets is None:
+        _, offsets = scan_file(fname)
+    write_records(path, offsets)
+    logging.info("Built line index for %s: %s lines", digest, len(offsets))
+    return path
+
+
+@timed('hash')
 def get_hash(sha_dig):
     """ Derive SHA1 hash of a list
     """
-    return hashlib.sha1("".join(sha_dig)).hexdigest()
+    sha = hashlib.sha1()
+    for line in sha_dig:
+        sha.update(line)
+    return sha.hexdigest()
+
+
+def run_pool(func, items, workers):
+    """ Call func on each of items, using at most workers threads
+
+    Returns a list of (result, exception) pairs, in the same order as
+    items. Exceptions raised by func are caught and returned, not raised
+    """
+    items = list(items)
+    results = [None] * len(items)
+    todo = Queue.Queue()
+    for pair in enumerate(items):
+        todo.put(pair)
+
+    def work():
+        """ Take items from the queue until it's empty """
+        while True:
+            try:
+                num, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[num] = (func(item), None)
+            except Exception, err:
+                results[num] = (None, err)
+
+    threads = [threading.Thread(target=work)
+        for _ in xrange(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def read_books(config):
+    """ Read a list of books from a config file
+
+    Each non-blank line holds a file name, followed by the header words for
+    that file, separated by spaces. Names containing spaces can be quoted.
+    Lines beginning with # are ignored. Returns a list of
+    (file name, header list) tuples
+    """
+    books = []
+    with open(config, 'r') as got_file:
+        for line in got_file:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) < 2:
+                raise ValueError(
+                    "No headers given for %s in %s" % (fields[0], config))
+            books.append((fields[0], fields[1:]))
+    return books
+
+
+def run_books(sess, books, live, workers=8, queued=False):
+    """ Advance each of a list of books by one line
+
+    Lines are formatted one book at a time, then the new positions of all
+    the books are saved in a single, short transaction. Books which another
+    process has moved on in the meantime are skipped. The rest are posted
+    concurrently using at most workers threads, then the books whose posts
+    failed have their old positions restored, and the outcomes of posts to
+    their mirrors recorded, again in one transaction.
+    queued is passed to get_db().
+    Books without an existing row are skipped, since they'd need
+    interactive OAuth setup; run the script once for these first. Books
+    which appear more than once are only advanced once, and books which
+    have no more lines are reported as Finished.
+    Returns a list of (book, error) pairs, with error None on success
+    """
+    formatted = []
+    report = []
+    seen = set()
+    for book in books:
+        if book.sha in seen:
+            report.append((book, LookupError("Duplicate of an earlier book")))
+            continue
+        seen.add(book.sha)
+        if find_row(sess, book.sha) is None:
+            logging.warning("Skipping %s: no row for digest %s",
+                book.fname, book.sha)
+            report.append((book, LookupError("No row for %s" % book.sha)))
+            continue
+        try:
+            # raises PositionConflict if another process is journaling it
+            book.get_db(sess, queued)
+            previous = dict(book.position)
+            payload = book.format_tweet()
+        except StopIteration:
+            report.append((book, Finished(book.sha)))
+            continue
+        except (MatchError, PositionConflict), err:
+            report.append((book, err))
+            continue
+        formatted.append((book, payload, previous))
+    # claim the lines only once they're all formatted, so the write
+    # transaction is held for as little time as possible
+    ready = []
+    for book, payload, previous in formatted:
+        try:
+            book.save(commit=False)
+        except PositionConflict, err:
+            report.append((book, err))
+            continue
+        ready.append((book, payload, previous))
+    with TIMER('commit'):
+        sess.commit()
+    results = run_pool(
+        lambda item: item[0].post(item[1], live), ready, workers)
+    failed = False
+    for (book, _, previous), (_, err) in zip(ready, results):
+        if err is not None:
+            book.release(previous, commit=False)
+            failed = True
+        if book.record_mirrors(commit=False):
+            failed = True
+        report.append((book, err))
+    if failed:
+        with TIMER('commit'):
+            sess.commit()
+    logging.info("Advanced %s of %s books",
+        len([err for _, err in report if err is None]), len(books))
+    return report
+
+
+def shard_books(books, shards):
+    """ Split a list of (file name, header list) tuples into shards lists of
+    (number, file name, header list) tuples, where number is the book's
+    place in books. A file is always placed in the same shard, so each
+    worker keeps the same books, and their cached digests, from run to run
+    """
+    parts = [[] for _ in xrange(shards)]
+    for num, (fname, headers) in enumerate(books):
+        key = hashlib.sha1(os.path.abspath(fname)).hexdigest()
+        parts[int(key[:8], 16) % shards].append((num, fname, headers))
+    return parts
+
+
+def run_shard(args):
+    """ Load and advance one shard of books, in a worker process
+
+    args is a (db location, shard, live, workers, queued, mapped, index
+    directory, API location) tuple. Returns a list of (number, file name,
+    error) tuples, with error a string, or None on success, and the stage
+    timings
+    """
+    location, shard, live, workers, queued, mapped, index_dir, api_url = \
+        args
+    poster.POOL.base_url = api_url
+    TIMER.reset()
+    with TIMER('connect'):
+        sess = sync('sqlite:///%s' % location)
+    report = []
+    books = []
+    numbers = {}
+    for num, fname, headers in shard:
+        try:
+            book = book_class(fname, mapped)(fname, headers, index_dir, sess)
+        except (IOError, OSError), err:
+            report.append((num, fname, "%s: %s" % (type(err).__name__, err)))
+            continue
+        numbers[id(book)] = num
+        books.append(book)
+    for book, err in run_books(sess, books, live, workers, queued):
+        if err is not None:
+            err = "%s: %s" % (type(err).__name__, err)
+        report.append((numbers[id(book)], book.fname, err))
+    sess.close()
+    poster.POOL.close()
+    return report, TIMER.totals.items()
+
+
+def run_shards(location, books, live, processes, workers=8, queued=False,
+    mapped=False, index_dir=INDEX_DIR):
+    """ Advance each of a list of (file name, header list) tuples by one
+    line, spreading them across processes worker processes
+
+    Each worker loads and hashes its own shard of the books, then advances
+    them as run_books() does, using the shared db at location. Returns a
+    merged list of (file name, error) tuples in the order of books, with
+    error a string, or None on success. The workers' stage timings are
+    added to TIMER
+    """
+    # create or migrate the db once, before the workers open it
+    with TIMER('connect'):
+        sess = sync('sqlite:///%s' % location)
+        sess.close()
+        sess.bind.dispose()
+    shards = [(location, shard, live, workers, queued, mapped, index_dir,
+        poster.POOL.base_url)
+        for shard in shard_books(books, processes) if shard]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    report = []
+    for shard_report, totals in results:
+        report.extend(shard_report)
+        TIMER.merge(totals)
+    report.sort()
+    logging.info("Advanced %s of %s books in %s processes",
+        len([err for _, _, err in report if err is None]), len(books),
+        len(shards))
+    return [(fname, err) for _, fname, err in report]
+
+
+def index_book(args):
+    """ Hash a text file, and build its line index and section tables, in a
+    worker process
+
+    args is a (file name, header list, index directory) tuple. Returns a
+    (file name, digest, stat, error) tuple. stat is the (inode, size,
+    mtime_ns) to cache the digest against, or None if the file may still
+    be changing. error is a string, or None on success
+    """
+    fname, headers, index_dir = args
+    try:
+        stat = os.stat(fname)
+        book = book_class(fname)(fname, headers, index_dir)
+        # builds the line index, or checkpoints
+        book.line_count()
+        book.header_index()
+        restat = os.stat(fname)
+    except (IOError, OSError), err:
+        return fname, None, None, "%s: %s" % (type(err).__name__, err)
+    cached = (stat.st_ino, stat.st_size, int(round(stat.st_mtime * 1e9)))
+    if (restat.st_ino, restat.st_size, restat.st_mtime) != \
+        (stat.st_ino, stat.st_size, stat.st_mtime) \
+        or time.time() - stat.st_mtime < RACY_INTERVAL:
+        cached = None
+    return fname, book.sha, cached, None
+
+
+def find_credentials(sess, digest=None):
+    """ Return the OAuth credentials of the row for digest, or of the most
+    recently added row with credentials, as a dict. Returns None if
+    there's no such row
+    """
+    query = sess.query(Position).filter(Position.conkey != None)
+    if digest is not None:
+        query = query.filter(Position.digest == digest)
+    row = query.order_by(Position.id.desc()).first()
+    if row is None:
+        return None
+    return dict(conkey=row.conkey, consecret=row.consecret,
+        acckey=row.acckey, accsecret=row.accsecret)
+
+
+@timed('export')
+def export_payloads(book, out, position=None):
+    """ Write every tweet of book to the file object out, as JSON Lines
+
+    Each line is an object holding the tweet's sequence and payload, and
+    the position following it, as render() would store them. Tweets are
+    formatted from the text as they're written, beginning at a given
+    position dict, or the start of the book, and nothing is read from or
+    written to the db. Returns the number of tweets written
+    """
+    # the same output as json.dumps(..., sort_keys=True,
+    # separators=(',', ':')), but much faster, since only the two strings
+    # need encoding
+    escape = json.encoder.encode_basestring_ascii
+    template = '{"displayline":%d,"lastline":%d,"payload":%s,' \
+        '"prefix":%s,"sequence":%d}\n'
+    prefix = escaped = None
+    count = 0
+    for sequence, payload, following in book.iter_payloads(position):
+        # the prefix only changes at each header
+        if following["prefix"] != prefix:
+            prefix = following["prefix"]
+            escaped = escape(prefix)
+        out.write(template % (following["displayline"],
+            following["lastline"], escape(payload), escaped, sequence))
+        count += 1
+    return count
+
+
+def add_account(sess, digest, creds=None):
+    """ Add a further account to post the book with digest to, starting
+    with its next line. The credentials of the row whose digest is creds
+    are used, if it's given; otherwise OAuth setup is run. Returns the new
+    Account row
+    """
+    row = find_row(sess, digest)
+    if row is None:
+        raise LookupError("No row for %s: run the script once first" % digest)
+    if creds is not None:
+        oavals = find_credentials(sess, creds)
+        if oavals is None:
+            raise LookupError("No credentials for %s" % creds)
+    else:
+        oavals = create_oauth(sess, digest)
+    account = Account(digest=digest, position=row.position, failures=0,
+        conkey=oavals.get('conkey'), consecret=oavals.get('consecret'),
+        acckey=oavals.get('acckey'), accsecret=oavals.get('accsecret'))
+    sess.add(account)
+    sess.commit()
+    logging.info("Added account %s to %s", account.id, digest)
+    return account
+
+
+def ingest(sess, directory, headers, processes=None, pattern='*.txt',
+    creds=None, index_dir=INDEX_DIR):
+    """ Add every text file in directory matching pattern to the db
+
+    The files are hashed, and their indexes built, in processes worker
+    processes (one per CPU by default). Their rows are then inserted in a
+    single transaction, using the credentials of the row whose digest is
+    creds, or of the most recent row with credentials if creds isn't
+    given. OAuth setup is only run, once, if there are none, and there
+    are rows to insert. Their digests
+    are cached, so their first runs don't have to hash them again.
+    Returns a list of (file name, digest, outcome) tuples, where outcome
+    is "added", "exists", "duplicate", or an error string
+    """
+    fnames = [os.path.join(directory, name)
+        for name in sorted(fnmatch.filter(os.listdir(directory), pattern))]
+    fnames = [fname for fname in fnames if os.path.isfile(fname)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(index_book,
+            [(fname, headers, index_dir) for fname in fnames], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    oavals = find_credentials(sess, creds)
+    if oavals is None and creds is not None:
+        raise LookupError("No credentials for %s" % creds)
+    existing = set(digest for digest, in sess.query(Position.digest))
+    added = set()
+    report = []
+    rows = []
+    stats = []
+    for fname, digest, cached, err in results:
+        if err is not None:
+            report.append((fname, digest, err))
+            continue
+        if cached is not None:
+            stats.append(dict(zip(('path', 'inode', 'size', 'mtime_ns',
+                'digest'), (os.path.abspath(fname),) + cached + (digest,))))
+        if digest in added:
+            report.append((fname, digest, "duplicate"))
+            continue
+        if digest in existing:
+            report.append((fname, digest, "exists"))
+            continue
+        added.add(digest)
+        rows.append(dict(position=0, displayline=0, headers=u'',
+            digest=digest))
+        report.append((fname, digest, "added"))
+    if rows and oavals is None:
+        oavals = create_oauth(sess, directory)
+    for row in rows:
+        row.update(oavals)
+    with TIMER('commit'):
+        paths = [stat["path"] for stat in stats]
+        # stay under sqlite's limit on the number of bound parameters
+        for start in xrange(0, len(paths), 500):
+            sess.query(Filestat).filter(Filestat.path.in_(
+                paths[start:start + 500])).delete(synchronize_session=False)
+        if stats:
+            sess.execute(Filestat.__table__.insert(), stats)
+        if rows:
+            sess.execute(Position.__table__.insert(), rows)
+        sess.commit()
+    logging.info("Ingested %s: added %s of %s files", directory, len(rows),
+        len(fnames))
+    return report
+
+
+def parse_cron_field(field, lowest, highest):
+    """ Return the set of values matched by a single cron field
+
+    Supports *, single values, ranges (a-b), steps (*/n, a-b/n) and
+    comma-separated lists of these
+    """
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = lowest, highest
+        elif '-' in part:
+            start, end = [int(val) for val in part.split('-', 1)]
+        else:
+            start = end = int(part)
+        if start < lowest or end > highest or start > end or step < 1:
+            raise ValueError("Invalid cron field: %s" % field)
+        values.update(xrange(start, end + 1, step))
+    return values
+
+
+class IntervalSchedule(object):
+    """ Fire at a fixed interval, given in seconds
+    """
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("Interval must be positive: %s" % seconds)
+        self.interval = datetime.timedelta(seconds=seconds)
+
+    def next_after(self, when):
+        """ Return the first time after when at which we should fire
+        """
+        return when + self.interval
+
+
+class CronSchedule(object):
+    """ Fire according to a five-field cron specification:
+    minute, hour, day of month, month, day of week (0 or 7 is Sunday)
+    """
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError("Cron schedules need five fields: %s" % spec)
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = set(
+            day % 7 for day in parse_cron_field(fields[4], 0, 7))
+        # as in cron, if both day fields are restricted, either may match
+        self.either_day = fields[2] != '*' and fields[4] != '*'
+
+    def day_matches(self, when):
+        """ Check the day of month and day of week fields
+        """
+        dom = when.day in self.days
+        dow = when.isoweekday() % 7 in self.weekdays
+        if self.either_day:
+            return dom or dow
+        return dom and dow
+
+    def next_after(self, when):
+        """ Return the first time after when at which we should fire
+        """
+        when = when.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+        # every valid schedule fires at least once in a leap-year cycle
+        limit = when + datetime.timedelta(days=366 * 4)
+        while when < limit:
+            if when.month not in self.months:
+                year, month = divmod(when.month, 12)
+                when = when.replace(year=when.year + year, month=month + 1,
+                    day=1, hour=0, minute=0)
+            elif not self.day_matches(when):
+                when = when.replace(hour=0, minute=0) + \
+                    datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError("Cron schedule never fires")
+
+
+def run_daemon(book, sess, live, schedule, sleep=time.sleep,
+    now=datetime.datetime.now, queued=False, metrics=None, journaled=False):
+    """ Keep emitting lines from book on schedule, until it's finished
+
+    The session, book, compiled header pattern and API client are all
+    reused between emissions. The book is reloaded if its file changes.
+    A failed post is logged, and the same line is retried at the next
+    scheduled time. If metrics is given, the timings of each emission are
+    written to it in Prometheus' text format. If journaled is set, the
+    book's journal is held until the daemon exits, and folded into the db
+    then
+    """
+    if live:
+        post_errors = poster.PostError
+    else:
+        post_errors = ()
+    due = schedule.next_after(now())
+    try:
+        while True:
+            delay = due - now()
+            delay = delay.days * 86400 + delay.seconds + \
+                delay.microseconds / 1e6
+            if delay > 0:
+                sleep(delay)
+            if book.is_stale():
+                logging.info("%s has changed, reloading", book.fname)
+                book.close()
+                book = type(book)(
+                    book.fname, book.headers, book.index_dir, sess)
+            # re-read the position, in case a previous post failed
+            book.get_db(sess, queued, journaled)
+            try:
+                book.emit_tweet(live)
+            except StopIteration:
+                logging.info("Finished %s, daemon exiting", book.sha)
+                return book
+            except post_errors:
+                logging.error(
+                    "Post failed, retrying at the next scheduled time")
+            except PositionConflict:
+                logging.warning("Line already emitted by another process")
+            # don't leave a journaled tweet unsynced while we wait
+            book.sync()
+            if metrics:
+                TIMER.write_prometheus(metrics)
+                TIMER.reset()
+            due = schedule.next_after(max(due, now()))
+    finally:
+        book.close()
+
+
+def stop_daemon(signum, frame):
+    """ Exit cleanly when the daemon is asked to terminate
+    """
+    logging.info("Received signal %s, exiting", signum)
+    raise SystemExit(0)
+
+
+def peak_memory():
+    """ Return the peak resident set size of the process so far, in KiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on OS X, and KiB elsewhere
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def live_objects(limit=15):
+    """ Return the types with the most objects tracked by the garbage
+    collector, as (type name, count, bytes) tuples, largest count first.
+    Strings and numbers aren't tracked, so are only counted inside the
+    containers holding them
+    """
+    counts = collections.defaultdict(lambda: [0, 0])
+    for obj in gc.get_objects():
+        count = counts[type(obj).__name__]
+        count[0] += 1
+        count[1] += sys.getsizeof(obj, 0)
+    return sorted(((name, count, size) for name, (count, size) in
+        counts.items()), key=lambda item: -item[1])[:limit]
+
+
+def seek_row(sess, book, header, line):
+    """ Point book's row at a given line of a given section, and return the
+    new position. If the book has a journal, it's emptied under its lock,
+    since it would otherwise be replayed over the new position; books
+    which have never been journaled aren't given one
+    """
+    position = book.seek(header, line)
+    if not os.path.exists(journal_path(book.index_dir, book.sha)):
+        write_vals(sess, book.sha, position["lastline"],
+            position["displayline"], position["prefix"])
+        return position
+    journal = Journal(book.index_dir, book.sha)
+    journal.acquire()
+    try:
+        write_vals(sess, book.sha, position["lastline"],
+            position["displayline"], position["prefix"])
+        journal.clear()
+    finally:
+        journal.release()
+    return position
+
+
+def profile_call(directory, func, *args):
+    """ Call func(*args) under cProfile, writing the profile, and a report
+    of the time and memory it used, to timestamped files in directory
+
+    The profile is written to bookbyline-<time>-<pid>.prof, for pstats or
+    a viewer such as snakeviz, and the report to a .txt file alongside it,
+    even if func raises. directory is created before func is called. A
+    failure to write the files is logged, rather than raised, so it can't
+    hide func's outcome. Returns func's result
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    base = os.path.join(directory, 'bookbyline-%s-%s' % (
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    profiler = cProfile.Profile()
+    peak_before = peak_memory()
+    start = time.time()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        elapsed = time.time() - start
+        try:
+            write_profile(base, profiler, elapsed, peak_before)
+        except (IOError, OSError), err:
+            logging.error("Couldn't write profile to %s: %s", base, err)
+
+
+def write_profile(base, profiler, elapsed, peak_before):
+    """ Write a profile to base.prof, and its report to base.txt
+    """
+    profiler.dump_stats(base + '.prof')
+    with open(base + '.txt', 'w') as report:
+        report.write("Command: %s\n" % " ".join(sys.argv))
+        report.write("Elapsed: %.6fs\n" % elapsed)
+        report.write("Peak RSS: %s KiB (%s KiB before the run)\n\n"
+            % (peak_memory(), peak_before))
+        report.write("Stage timings (seconds, calls):\n")
+        for stage, (seconds, calls) in TIMER.totals.items():
+            report.write("  %-10s %.6f %d\n" % (stage, seconds, calls))
+        report.write("\nLive objects by type (count, bytes):\n")
+        for name, count, size in live_objects():
+            report.write("  %-28s %9d %12d\n" % (name, count, size))
+        report.write("\n")
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats('cumulative').print_stats(40)
+        stats.sort_stats('time').print_stats(20)
+    logging.info("Wrote profile to %s.prof and %s.txt", base, base)
 
 
 def main():
@@ -385,14 +3071,98 @@ def main():
     default = False, dest = "live")
     parser.add_argument(
     "-file", metavar = "filename",
-    help = "the full path to a text file", required = True,
+    help = "the full path to a text file. Required unless --books is given",
     type = argparse.FileType("r", 0))
     parser.add_argument(
     "-header", metavar = "header-line word to match",
     help = "a case-sensitive list of words (and punctuation) which will be \
     treated as header lines. Enter as many as you wish, separated by a \
-    space. Example - Purgatory: BOOK Passus", nargs = "+",
-    required = True)
+    space. Example - Purgatory: BOOK Passus", nargs = "+")
+    parser.add_argument(
+    "--mmap", help = "memory-map the text file, so that memory use doesn't \
+    grow with its size", action = "store_true", default = False,
+    dest = "mapped")
+    parser.add_argument(
+    "--queue", help = "render every tweet in the book the first time it's \
+    seen, and emit the stored tweets, rather than formatting each one \
+    from the text", action = "store_true", default = False, dest = "queue")
+    parser.add_argument(
+    "-n", "--count", metavar = "n", help = "emit the next n lines, rather \
+    than one, e.g. to catch up after an outage", type = int, default = 1)
+    parser.add_argument(
+    "--commit-every", metavar = "k", help = "with --count, save the \
+    position before every k tweets are posted. Default: %s" % CLAIM_BLOCK,
+    type = int, default = 0, dest = "commit_every")
+    parser.add_argument(
+    "--books", metavar = "config", help = "advance every book listed in \
+    this file by one line, posting concurrently. Each line of the file \
+    holds a file name, followed by its header words", default = None)
+    parser.add_argument(
+    "--workers", metavar = "n", help = "the number of posts to make \
+    concurrently with --books. Default: 8", type = int, default = 8)
+    parser.add_argument(
+    "--processes", metavar = "n", help = "with --books, load and advance \
+    the books in n worker processes, each handling its own share of them. \
+    With --ingest, hash the files in n processes. Default: 1 with --books, \
+    one per CPU with --ingest", type = int, default = None)
+    parser.add_argument(
+    "--ingest", metavar = "directory", help = "add every text file in \
+    directory to the db, using the header words given by -header, and the \
+    credentials of an existing book, then exit", default = None)
+    parser.add_argument(
+    "--pattern", metavar = "glob", help = "with --ingest, only add files \
+    whose names match this pattern. Default: *.txt", default = "*.txt")
+    parser.add_argument(
+    "--creds-from", metavar = "digest", help = "with --ingest, use the \
+    credentials of the book with this digest, rather than those of the \
+    most recently added book. With --add-account, use them rather than \
+    running OAuth setup", default = None, dest = "creds_from")
+    parser.add_argument(
+    "--add-account", help = "post the book to a further account as well, \
+    from its next line on, then exit. Each line is posted to all of a \
+    book's accounts at once", action = "store_true", default = False,
+    dest = "add_account")
+    parser.add_argument(
+    "--export", metavar = "filename", help = "write every tweet of the \
+    book to this file (or stdout, if it's -) as JSON Lines, without posting \
+    anything or moving the book on, then exit", default = None)
+    parser.add_argument(
+    "--seek", metavar = ("header", "line"), help = "point the book at a \
+    given line of a given section, so that it's the next to be tweeted, \
+    then exit. Example - --seek \"Canto XII\" 30", nargs = 2,
+    default = None)
+    parser.add_argument(
+    "--daemon", help = "keep running, emitting lines on a schedule \
+    rather than once", action = "store_true", default = False,
+    dest = "daemon")
+    parser.add_argument(
+    "--interval", metavar = "seconds", help = "in daemon mode, emit a \
+    line every this many seconds. Default: 3600", type = float,
+    default = 3600)
+    parser.add_argument(
+    "--schedule", metavar = "cron spec", help = "in daemon mode, emit \
+    lines according to a five-field cron specification instead of at an \
+    interval. Example - \"0 9-17 * * 1-5\"", default = None)
+    parser.add_argument(
+    "--journal", help = "record each tweet in an append-only journal \
+    beside the line index, rather than saving the position to the db after \
+    every tweet. The journal is saved to the db every %s tweets, and when \
+    the run ends, and other processes can't emit the book meanwhile. Useful \
+    with --daemon and --count" % JOURNAL_FOLD, action = "store_true",
+    default = False)
+    parser.add_argument(
+    "--api-url", metavar = "url", help = "post to the Twitter API at this \
+    location, e.g. a local test server. Default: %s" % poster.API_URL,
+    default = poster.API_URL, dest = "api_url")
+    parser.add_argument(
+    "--metrics", metavar = "filename", help = "write the time taken by \
+    each stage of the run to this file, in Prometheus' text format",
+    default = None)
+    parser.add_argument(
+    "--profile", metavar = "directory", help = "profile the whole run, \
+    writing a cProfile dump and a report of its timings and memory use to \
+    timestamped files in this directory. Default: the current directory",
+    nargs = "?", const = ".", default = None)
     parser.add_argument(
     "-v", help = "Print stack trace to stdout",
     action = "store_true", default = False, dest = "errs")
@@ -405,11 +3175,102 @@ def main():
         print err
         logging.critical(err)
         raise
+    if fromcl.ingest and not fromcl.header:
+        parser.error("-header is required with --ingest")
+    if not (fromcl.books or fromcl.ingest) and \
+        not (fromcl.file and fromcl.header):
+        parser.error(
+            "-file and -header are required, unless using --books or --ingest")
+    try:
+        if fromcl.profile:
+            profile_call(fromcl.profile, run, fromcl)
+        else:
+            run(fromcl)
+    finally:
+        if fromcl.metrics:
+            TIMER.write_prometheus(fromcl.metrics)
+
+
+def run(fromcl):
+    """ Carry out a run, using the parsed command-line arguments
+    """
+    poster.POOL.base_url = fromcl.api_url
     location = 'tweet_books.sl3'
-    sess = sync('sqlite:///%s' % location)
-    input_book = BookFromTextFile(fromcl.file, fromcl.header)
-    input_book.get_db(sess)
-    input_book.emit_tweet(fromcl.live)
+    if fromcl.books and (fromcl.processes or 1) > 1:
+        for fname, err in run_shards(location, read_books(fromcl.books),
+            fromcl.live, fromcl.processes, fromcl.workers, fromcl.queue,
+            fromcl.mapped):
+            if err is not None:
+                print "%s: %s" % (fname, err)
+        return
+    # dry runs of a single book don't need the ORM
+    with TIMER('connect'):
+        if fromcl.live or fromcl.queue or fromcl.books or fromcl.ingest \
+            or fromcl.add_account:
+            sess = sync('sqlite:///%s' % location)
+        else:
+            sess = SqliteStore(location)
+    if fromcl.ingest:
+        report = ingest(sess, fromcl.ingest, fromcl.header,
+            fromcl.processes, fromcl.pattern, fromcl.creds_from)
+        for fname, digest, outcome in report:
+            print "%s: %s %s" % (fname, outcome, digest or "")
+        return
+    if fromcl.books:
+        books = [book_class(fname, fromcl.mapped)(fname, headers, sess = sess)
+            for fname, headers in read_books(fromcl.books)]
+        for book, err in run_books(
+            sess, books, fromcl.live, fromcl.workers, fromcl.queue):
+            if err is not None:
+                print "%s: %s" % (book.fname, err)
+        return
+    # exports read the whole text, so use the mapped book if possible: its
+    # scan writes the line offsets to disk rather than keeping them, so
+    # memory use stays flat
+    mapped = fromcl.mapped or bool(fromcl.export and file_path(fromcl.file))
+    input_book = book_class(fromcl.file, mapped)(
+        fromcl.file, fromcl.header, sess = sess)
+    if fromcl.export:
+        if fromcl.export == '-':
+            export_payloads(input_book, sys.stdout)
+            return
+        with open(fromcl.export, 'wb', 1 << 20) as out:
+            count = export_payloads(input_book, out)
+        print "Exported %s tweets to %s" % (count, fromcl.export)
+        return
+    if fromcl.add_account:
+        account = add_account(sess, input_book.sha, fromcl.creds_from)
+        print "Added account %s to %s" % (account.id, input_book.sha)
+        return
+    if fromcl.seek:
+        header, line = fromcl.seek
+        if find_row(sess, input_book.sha) is None:
+            raise MatchError("No row for %s: run the script once first"
+                % input_book.sha)
+        position = seek_row(sess, input_book, header.decode('utf-8'),
+            int(line))
+        print "Next line: %s, line %s (line %s of the file's non-blank \
+lines)" % (header, line, position["lastline"] + 1)
+        return
+    if fromcl.daemon:
+        if fromcl.schedule:
+            schedule = CronSchedule(fromcl.schedule)
+        else:
+            schedule = IntervalSchedule(fromcl.interval)
+        signal.signal(signal.SIGTERM, stop_daemon)
+        run_daemon(input_book, sess, fromcl.live, schedule,
+            queued = fromcl.queue, metrics = fromcl.metrics,
+            journaled = fromcl.journal)
+    else:
+        input_book.get_db(sess, fromcl.queue, fromcl.journal)
+        try:
+            if fromcl.count > 1:
+                input_book.emit_tweets(
+                    fromcl.live, fromcl.count, fromcl.commit_every)
+            else:
+                input_book.emit_tweet(fromcl.live)
+        finally:
+            input_book.close()
 
 
 if __name__ == "__main__":
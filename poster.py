@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A small Twitter posting client, built on httplib.
+
+One client is kept per credential set, and its connection is kept alive
+and reused between posts. Requests are signed using OAuth 1.0a. If Twitter
+responds with a rate-limit error, or says it's over capacity, the client
+waits (using the rate-limit headers, if they're present, or exponential
+backoff if not) and retries, rather than failing the run.
+A post isn't sent again once Twitter may have acted on it: if the
+connection fails after the request was sent, or Twitter responds with any
+other server error, the failure is raised, and the line is retried on the
+next run. Twitter refuses a status it has just published, so if the first
+attempt did get through, that refusal is taken as success.
+The API's location can be changed, so that the client can be tested against
+a local HTTP server.
+"""
+import time
+import hmac
+import json
+import random
+import socket
+import base64
+import hashlib
+import logging
+import httplib
+import urllib
+import urlparse
+import binascii
+import os
+import threading
+
+API_URL = 'https://api.twitter.com/1.1/'
+# status codes which mean the request was refused, and can be retried
+RETRY_STATUSES = (420, 429)
+# server errors which only mean the request wasn't processed when they
+# carry Twitter's "over capacity" error code
+CAPACITY_STATUSES = (503,)
+OVER_CAPACITY = 130
+# Twitter's error code for a status which duplicates one just posted
+DUPLICATE = 187
+# seconds a kept-alive connection can be idle before it's re-opened, as
+# the server may have dropped it
+KEEP_ALIVE = 5.0
+
+
+class PostError(Exception):
+    """ Raised if a status update fails, and can't be retried
+    """
+
+    def __init__(self, reason, status=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.status = status
+
+    def __str__(self):
+        return repr(self.reason)
+
+
+def escape(value):
+    """ Percent-encode a value as OAuth requires (RFC 3986)
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe='~')
+
+
+def error_codes(data):
+    """ Return the error codes in an error response's body
+    """
+    try:
+        errors = json.loads(data).get('errors')
+        return [error.get('code') for error in errors]
+    except (ValueError, AttributeError, TypeError):
+        return []
+
+
+def sign_request(method, url, params, creds, nonce=None, timestamp=None):
+    """ Return an OAuth 1.0a Authorization header value for a request
+
+    params are the request's body parameters; any query parameters are
+    taken from url. creds is a (consumer key, consumer secret, access key,
+    access secret) tuple
+    """
+    conkey, consecret, acckey, accsecret = creds
+    oauth = {
+        'oauth_consumer_key': conkey,
+        'oauth_nonce': nonce or binascii.hexlify(os.urandom(16)),
+        'oauth_signature_method': 'HMAC-SHA1',
+        'oauth_timestamp': str(int(timestamp or time.time())),
+        'oauth_token': acckey,
+        'oauth_version': '1.0'}
+    parsed = urlparse.urlsplit(url)
+    signed = [(escape(key), escape(value)) for key, value in
+        urlparse.parse_qsl(parsed.query, keep_blank_values=True)]
+    signed.extend((escape(key), escape(value))
+        for key, value in params.items() + oauth.items())
+    base = '&'.join([
+        method.upper(),
+        escape('%s://%s%s' % (parsed.scheme, parsed.netloc.lower(),
+            parsed.path)),
+        escape('&'.join('%s=%s' % pair for pair in sorted(signed)))])
+    key = '%s&%s' % (escape(consecret), escape(accsecret))
+    oauth['oauth_signature'] = base64.b64encode(
+        hmac.new(key, base, hashlib.sha1).digest())
+    return 'OAuth ' + ', '.join(
+        '%s="%s"' % (escape(key), escape(value))
+        for key, value in sorted(oauth.items()))
+
+
+class Client(object):
+    """ A posting client for a single credential set.
+
+    Holds one HTTP connection, which is kept alive between requests, and
+    re-opened if it's dropped. Requests are serialised, so a client can be
+    shared between threads.
+    """
+
+    def __init__(self, creds, base_url=API_URL, max_retries=5,
+        backoff=2.0, max_wait=900, timeout=30, sleep=time.sleep,
+        now=time.time, sign=sign_request, keep_alive=KEEP_ALIVE):
+        self.creds = creds
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.sleep = sleep
+        self.now = now
+        # can be replaced, e.g. to time signing
+        self.sign = sign
+        self.keep_alive = keep_alive
+        self.connection = None
+        self.last_used = 0
+        self.lock = threading.Lock()
+        # set from the rate-limit headers when we've used up our requests
+        self.blocked_until = 0
+
+    def connect(self):
+        """ Return the client's connection, opening it if necessary, or
+        if it's been idle for long enough that it may have been dropped
+        """
+        if self.connection is not None and \
+            self.now() - self.last_used > self.keep_alive:
+            self.close()
+        if self.connection is None:
+            parsed = urlparse.urlsplit(self.base_url)
+            if parsed.scheme == 'https':
+                connection_type = httplib.HTTPSConnection
+            else:
+                connection_type = httplib.HTTPConnection
+            self.connection = connection_type(
+                parsed.hostname, parsed.port, timeout=self.timeout)
+        return self.connection
+
+    def close(self):
+        """ Close the client's connection, if it's open
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def wait_time(self, attempt, headers):
+        """ Return how long to wait before retrying, using the rate-limit
+        headers if they're present, or exponential backoff with jitter
+        """
+        reset = headers.get('x-rate-limit-reset')
+        if reset:
+            return max(0, min(float(reset) - self.now() + 1, self.max_wait))
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            return min(float(retry_after), self.max_wait)
+        return min(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5),
+            self.max_wait)
+
+    def request(self, method, path, params):
+        """ Make a signed request, retrying refused requests, and return the
+        decoded JSON response, or None if Twitter says it's a duplicate of a
+        status that was just posted
+
+        Failures which leave it unclear whether the request was acted on,
+        because the connection failed after it was sent, or Twitter
+        responded with a server error, are raised without retrying
+        """
+        url = urlparse.urljoin(self.base_url, path)
+        parsed = urlparse.urlsplit(url)
+        target = parsed.path + ('?' + parsed.query if parsed.query else '')
+        body = urllib.urlencode(dict(
+            (key, value.encode('utf-8') if isinstance(value, unicode)
+                else value) for key, value in params.items()))
+        with self.lock:
+            for attempt in xrange(self.max_retries + 1):
+                if self.blocked_until > self.now():
+                    self.sleep(self.blocked_until - self.now())
+                headers = {
+                    'Authorization': self.sign(
+                        method, url, params, self.creds),
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Connection': 'keep-alive'}
+                try:
+                    connection = self.connect()
+                    connection.request(method, target, body, headers)
+                except (httplib.HTTPException, socket.error), err:
+                    # nothing reached Twitter, so it's safe to send again
+                    self.close()
+                    reason = "Connection failed: %s" % err
+                    wait = self.wait_time(attempt, {})
+                else:
+                    try:
+                        response = connection.getresponse()
+                        # the body must be read before the connection is
+                        # reused
+                        data = response.read()
+                    except (httplib.HTTPException, socket.error), err:
+                        self.close()
+                        raise PostError(
+                            "No response, the request may have been "
+                            "processed: %s" % err)
+                    self.last_used = self.now()
+                    response_headers = dict(response.getheaders())
+                    if response.getheader('connection', '').lower() == \
+                        'close':
+                        self.close()
+                    if response_headers.get('x-rate-limit-remaining') == '0':
+                        self.blocked_until = float(response_headers.get(
+                            'x-rate-limit-reset', 0))
+                    if 200 <= response.status < 300:
+                        return json.loads(data or 'null')
+                    reason = "%s %s: %s" % (
+                        response.status, response.reason, data)
+                    codes = error_codes(data)
+                    if response.status == 403 and DUPLICATE in codes:
+                        logging.warning("Already posted: %s", reason)
+                        return None
+                    if response.status not in RETRY_STATUSES and not (
+                        response.status in CAPACITY_STATUSES and
+                        OVER_CAPACITY in codes):
+                        raise PostError(reason, response.status)
+                    wait = self.wait_time(attempt, response_headers)
+                if attempt < self.max_retries:
+                    logging.warning("Request failed (%s), retrying in %.1fs",
+                        reason, wait)
+                    self.sleep(wait)
+        raise PostError(reason)
+
+    def update_status(self, status):
+        """ Post a status update. Returns the posted status, or None if
+        Twitter refused it as a duplicate of one just posted
+        """
+        return self.request('POST', 'statuses/update.json',
+            {'status': status})
+
+
+class ClientPool(object):
+    """ Keep one client per credential set, and API location, so that
+    their connections can be reused
+    """
+
+    def __init__(self, base_url=API_URL, **options):
+        self.base_url = base_url
+        self.options = options
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, creds):
+        """ Return the client for a (consumer key, consumer secret,
+        access key, access secret) tuple, creating it if necessary
+        """
+        key = (self.base_url, tuple(creds))
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = Client(
+                    tuple(creds), self.base_url, **self.options)
+            return self.clients[key]
+
+    def close(self):
+        """ Close every client's connection
+        """
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+
+POOL = ClientPool()
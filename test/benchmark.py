@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+# coding=utf-8
+"""
+Benchmarks for the bookbyline module
+
+Generates synthetic poems of various sizes and header densities, and times
+each stage of a run separately, as well as an end-to-end dry run of the
+script. Results are written as JSON, and can be compared with those of an
+earlier version to catch regressions:
+
+python benchmark.py --sizes 1K 1M 100M --output new.json --compare old.json
+"""
+import sys
+import os
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+import bookbyline
+from bookbyline import Position
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(bookbyline.__file__)),
+    'bookbyline.py')
+WORDS = ("wandering", "field", "full", "of", "folk", "fair", "found", "I",
+    "there", "the", "of", "all", "manner", "men", "meaner", "and", "richer",
+    "working", "and", "wandering", "as", "the", "world", "asketh", "some",
+    "put", "them", "to", "plough", "played", "full", "seldom")
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# in-memory stages are skipped for files larger than this, by default
+IN_MEMORY_MAX = '256M'
+
+
+def parse_size(size):
+    """ Convert a size such as 64K or 1G to bytes
+    """
+    match = re.match(r'^(\d+)([KMG]?)$', size.upper())
+    if not match:
+        raise argparse.ArgumentTypeError("Invalid size: %s" % size)
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def make_poem(fname, size, density):
+    """ Write a synthetic poem of roughly size bytes, with a header line
+    every density lines, and a blank line after each verse of four lines.
+    Returns the number of non-blank lines written
+    """
+    rand = random.Random(size * 1000 + density)
+    verses = [" ".join(rand.choice(WORDS) for _ in xrange(rand.randint(5, 9)))
+        for _ in xrange(997)]
+    written = 0
+    count = 0
+    with open(fname, 'wb') as poem:
+        for num in itertools.count():
+            if num % density == 0:
+                line = "Canto %s\n" % (num // density + 1)
+            else:
+                line = verses[num % len(verses)] + "\n"
+                if num % 4 == 0:
+                    line += "\n"
+            poem.write(line)
+            written += len(line)
+            count += 1
+            if written >= size:
+                break
+    return count
+
+
+def time_stage(func, repeat, setup=None):
+    """ Call func repeat times, calling setup (untimed) before each call.
+    Returns a dict of the best and mean times, in seconds
+    """
+    times = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        func()
+        times.append(default_timer() - start)
+    return {
+        "best": min(times),
+        "mean": sum(times) / len(times),
+        "runs": repeat}
+
+
+def dry_run(work_dir, fname):
+    """ Run the script as cron would, without tweeting
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, SCRIPT, '-file', fname, '-header', 'Canto'],
+            cwd=work_dir, stdout=devnull, stdin=devnull)
+
+
+def bench_book(work_dir, size, density, repeat, in_memory_max):
+    """ Time each stage of a run against a synthetic poem.
+    Returns a dict of results
+    """
+    fname = os.path.join(work_dir, 'poem_%s_%s.txt' % (size, density))
+    start = default_timer()
+    lines = make_poem(fname, size, density)
+    generated = default_timer() - start
+    # age the file, so its digest can be cached
+    then = time.time() - 60
+    os.utime(fname, (then, then))
+    index_dir = os.path.join(work_dir, bookbyline.INDEX_DIR)
+    sess = bookbyline.sync(
+        'sqlite:///%s' % os.path.join(work_dir, 'bench.sl3'))
+    digest, offsets = bookbyline.scan_file(fname)
+    # resume from the middle of the poem, just after a header
+    middle = (lines // 2) - (lines // 2) % density + 1
+    sess.add(Position(position=middle, displayline=1, headers=u'Canto\n',
+        digest=digest, conkey='A', consecret='B', acckey='C',
+        accsecret='D'))
+    sess.commit()
+    store = bookbyline.SqliteStore(os.path.join(work_dir, 'bench.sl3'))
+    book = bookbyline.BookFromTextFile(fname, ['Canto'], index_dir, sess)
+    book.get_db(sess)
+    stages = {}
+    if size <= in_memory_max:
+        stages["gimme_lines"] = time_stage(
+            lambda: bookbyline.gimme_lines(
+                fname, bookbyline.open_file, bookbyline.imp_file), repeat)
+        text = bookbyline.gimme_lines(
+            fname, bookbyline.open_file, bookbyline.imp_file)
+        stages["get_hash"] = time_stage(
+            lambda: bookbyline.get_hash(text), repeat)
+        text = None
+        stages["read_packed"] = time_stage(
+            lambda: bookbyline.read_packed(fname), repeat)
+    # the seek get_db() makes, using the line index
+    stages["read_lines"] = time_stage(
+        lambda: book.read_lines(middle, 2), repeat)
+    stages["scan_file"] = time_stage(
+        lambda: bookbyline.scan_file(fname), repeat)
+    stages["get_digest_cached"] = time_stage(
+        lambda: bookbyline.get_digest(sess, fname), repeat)
+    stages["get_row"] = time_stage(
+        lambda: bookbyline.get_row(sess, digest), repeat)
+    stages["get_row_sqlite3"] = time_stage(
+        lambda: bookbyline.get_row(store, digest), repeat)
+    stages["get_db"] = time_stage(lambda: book.get_db(sess), repeat)
+
+    def reset():
+        """ Put the book back at the middle line """
+        book.lines = iter(book.read_lines(middle, 2))
+        book.position = {
+            "lastline": middle, "displayline": 1, "prefix": u"Canto\n"}
+    stages["format_tweet"] = time_stage(book.format_tweet, repeat, reset)
+    with open(os.devnull, 'wb') as devnull:
+        stages["export"] = time_stage(
+            lambda: bookbyline.export_payloads(book, devnull), repeat)
+    stages["write_vals"] = time_stage(
+        lambda: bookbyline.write_vals(sess, digest, middle, 1, u"Canto\n"),
+        repeat)
+    # the script uses tweet_books.sl3 in its working directory
+    run_dir = os.path.join(work_dir, 'run')
+    os.mkdir(run_dir)
+    run_store = bookbyline.SqliteStore(
+        os.path.join(run_dir, 'tweet_books.sl3'))
+    run_store.add_row({'position': middle, 'displayline': 1,
+        'headers': u'Canto\n', 'digest': digest})
+    run_store.commit()
+    stages["main_dry_run"] = time_stage(
+        lambda: dry_run(run_dir, fname), repeat)
+    sess.close()
+    os.remove(fname)
+    shutil.rmtree(run_dir)
+    return {
+        "size": size,
+        "density": density,
+        "lines": lines,
+        "generate": generated,
+        "stages": stages}
+
+
+def compare(old, new, threshold):
+    """ Print the stages which got slower by more than threshold (a
+    fraction) between two sets of results. Returns the number of
+    regressions found
+    """
+    previous = {}
+    for result in old["results"]:
+        for stage, timing in result["stages"].items():
+            previous[(result["size"], result["density"], stage)] = \
+                timing["best"]
+    regressions = 0
+    for result in new["results"]:
+        for stage, timing in sorted(result["stages"].items()):
+            key = (result["size"], result["density"], stage)
+            if key not in previous or not previous[key]:
+                continue
+            ratio = timing["best"] / previous[key]
+            if ratio > 1 + threshold:
+                regressions += 1
+                print "REGRESSION %s bytes, density %s, %s: %.6fs -> %.6fs " \
+                    "(%.2fx)" % (key + (previous[key], timing["best"], ratio))
+    return regressions
+
+
+def main():
+    """ Main function, called from command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage of a bookbyline run')
+    parser.add_argument("--sizes", nargs="+", type=parse_size,
+        default=[parse_size(size) for size in ('1K', '64K', '1M', '16M')],
+        help="poem sizes to generate, e.g. 1K 1M 1G. Default: 1K 64K 1M 16M")
+    parser.add_argument("--densities", nargs="+", type=int,
+        default=[10, 100, 1000],
+        help="generate a header every n lines. Default: 10 100 1000")
+    parser.add_argument("--repeat", type=int, default=5,
+        help="times to run each stage. Default: 5")
+    parser.add_argument("--in-memory-max", type=parse_size,
+        default=parse_size(IN_MEMORY_MAX), dest="in_memory_max",
+        help="skip stages which read the whole poem into memory for "
+        "larger poems. Default: %s" % IN_MEMORY_MAX)
+    parser.add_argument("--output", default="bench_results.json",
+        help="file to write results to. Default: bench_results.json")
+    parser.add_argument("--compare", metavar="old results",
+        help="report stages which are slower than in these results")
+    parser.add_argument("--threshold", type=float, default=0.25,
+        help="fractional slowdown reported as a regression. Default: 0.25")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for size in args.sizes:
+            for density in args.densities:
+                result = bench_book(work_dir, size, density, args.repeat,
+                    args.in_memory_max)
+                results.append(result)
+                print "%s bytes, header every %s lines:" % (size, density)
+                for stage, timing in sorted(result["stages"].items()):
+                    print "  %-20s %.6fs" % (stage, timing["best"])
+    finally:
+        shutil.rmtree(work_dir)
+    output = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat},
+        "results": results}
+    with open(args.output, 'w') as got_file:
+        json.dump(output, got_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as got_file:
+            if compare(json.load(got_file), output, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
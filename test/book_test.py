@@ -6,9 +6,25 @@ Tests for the bookbyline module
 
 import unittest
 import sys
+import os
+import shutil
+import tempfile
+import time
+import datetime
+import sqlite3
+import gzip
+import bz2
+import threading
+import multiprocessing
+import BaseHTTPServer
+import json
+import StringIO
+import pstats
+import zlib
 sys.path.insert(0, '..')
 
 import bookbyline
+import poster
 # import sync
 from bookbyline import Position
 
@@ -17,7 +33,9 @@ class BookTests(unittest.TestCase):
     def setUp(self):
         """ Set up known good values with which to test
         """
-        self.book = bookbyline.BookFromTextFile('test_file.txt', 'This')
+        self.index_dir = tempfile.mkdtemp()
+        self.book = bookbyline.BookFromTextFile(
+            'test_file.txt', 'This', self.index_dir)
         self.database = bookbyline.sync('sqlite:///')
         self.digest = u'dd5c938011a40a91c49ca9564f3aac40b67c8d27'
         # provide known correct SHA1 hash of a list of strings
@@ -61,6 +79,7 @@ class BookTests(unittest.TestCase):
         del self.knownValues
         del self.lines
         del self.live
+        shutil.rmtree(self.index_dir)
 
     def testDatabaseConnectionExists(self):
         """ Should return a valid sqlite3 connection object
@@ -200,5 +219,1924 @@ class BookTests(unittest.TestCase):
         self.book.sha,
         'dd5c938011a40a91c49ca9564f3aac40b67c8d27')
 
+    def testScanFileMatchesHash(self):
+        """ Streamed digest should equal the digest of the imported lines
+        """
+        digest, offsets = bookbyline.scan_file('test_file.txt')
+        self.assertEqual(digest, bookbyline.get_hash(
+            bookbyline.imp_file(self.lines)))
+        self.assertEqual(len(offsets), 4)
+
+    def testLineIndexIsWritten(self):
+        """ get_db should leave a line index for the digest on disk
+        """
+        self.assertTrue(os.path.exists(
+            bookbyline.index_path(self.index_dir, self.digest)))
+
+    def testReadLinesSeeksToPosition(self):
+        """ read_lines should return the non-blank lines at a given position
+        """
+        self.assertEqual(
+            self.book.read_lines(2, 2),
+            [u"They'll be stripped by a function which we test\n",
+            u"That's all really"])
+        self.assertEqual(self.book.read_lines(4, 2), [])
+
+    def testGetDbSeeksToStoredPosition(self):
+        """ The next line should be read from the stored position, rather
+        than from the beginning of the file
+        """
+        bookbyline.write_vals(self.database, self.digest, 3, 2, 'This\n')
+        self.book.get_db(self.database)
+        self.book.headers = ['foo']
+        self.assertEqual(
+            self.book.format_tweet(), "This\nl. 3: That's all really")
+
+    def testBookFromFileObject(self):
+        """ Opened file objects should be read via the index too, and
+        produce the same digest
+        """
+        with open('test_file.txt', 'r') as f:
+            book = bookbyline.BookFromTextFile(f, 'This', self.index_dir)
+        self.assertEqual(book.sha, self.digest)
+        self.assertEqual(book.fname, 'test_file.txt')
+
+
+
+class DigestCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Copy the test file somewhere we can modify it, and age it so
+        its stat values can be cached
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'poem.txt')
+        shutil.copy('test_file.txt', self.fname)
+        self.age(self.fname)
+        self.database = bookbyline.sync('sqlite:///')
+        self.scan_file = bookbyline.scan_file
+
+    def tearDown(self):
+        bookbyline.scan_file = self.scan_file
+        shutil.rmtree(self.tmp_dir)
+
+    def age(self, fname):
+        """ Set a file's mtime safely into the past
+        """
+        then = time.time() - 60
+        os.utime(fname, (then, then))
+
+    def book(self):
+        return bookbyline.BookFromTextFile(
+            self.fname, 'This', self.tmp_dir, self.database)
+
+    def testUnchangedFileIsNotRehashed(self):
+        """ A second book from the same unchanged file should reuse the
+        cached digest
+        """
+        first = self.book()
+        def fail(fname):
+            raise AssertionError("file was re-hashed")
+        bookbyline.scan_file = fail
+        second = self.book()
+        self.assertEqual(first.sha, second.sha)
+        self.assertEqual(second.sha,
+            'dd5c938011a40a91c49ca9564f3aac40b67c8d27')
+
+    def testChangedFileIsRehashed(self):
+        """ Editing the file should produce a new digest
+        """
+        first = self.book()
+        with open(self.fname, 'a') as f:
+            f.write('\nAnother line')
+        self.age(self.fname)
+        self.assertNotEqual(first.sha, self.book().sha)
+
+    def testRecentlyModifiedFileIsNotCached(self):
+        """ Stat values of a file which was just written aren't stored
+        """
+        os.utime(self.fname, None)
+        self.book()
+        self.assertEqual(
+            self.database.query(bookbyline.Filestat).count(), 0)
+
+
+
+class MappedBookTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.database = bookbyline.sync('sqlite:///')
+        self.book = bookbyline.MappedBookFromTextFile(
+            'test_file.txt', ['This'], self.index_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def testMappedDigestAndIndex(self):
+        """ The mapped scan should produce the same digest and index as
+        the streamed one
+        """
+        digest, offsets = bookbyline.scan_file('test_file.txt')
+        self.assertEqual(self.book.sha, digest)
+        with open(bookbyline.index_path(self.index_dir, digest), 'rb') as f:
+            self.assertEqual(f.read(), ''.join(
+                bookbyline.INDEX_RECORD.pack(o) for o in offsets))
+
+    def testMappedReadLines(self):
+        """ Lines should be sliced from the mapped file, including the
+        last line, which has no newline
+        """
+        self.assertEqual(self.book.read_lines(3, 2), [u"That's all really"])
+        self.assertEqual(self.book.read_lines(0, 1), [u"This is a test file\n"])
+
+    def testMappedReadLinesRebuildsIndex(self):
+        """ A missing index should be rebuilt
+        """
+        os.remove(bookbyline.index_path(self.index_dir, self.book.sha))
+        self.assertEqual(len(self.book.read_lines(0, 4)), 4)
+
+    def testMappedEmitTweet(self):
+        """ Should behave identically to a BookFromTextFile
+        """
+        self.database.add(Position(
+            position=0, displayline=0, headers='', digest=self.book.sha))
+        self.database.commit()
+        self.book.get_db(self.database)
+        self.assertEqual(
+            self.book.format_tweet(),
+            u"This is a test file\nl. 1: It has some blank lines in it")
+
+    def testMappedBookNeedsFile(self):
+        """ Only files on disk can be mapped
+        """
+        with self.assertRaises(IOError):
+            bookbyline.MappedBookFromTextFile(['a\n'], ['a'], self.index_dir)
+
+
+
+class SqliteStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'books.sl3')
+        self.fname = os.path.join(self.tmp_dir, 'poem.txt')
+        shutil.copy('test_file.txt', self.fname)
+        then = time.time() - 60
+        os.utime(self.fname, (then, then))
+        self.digest = 'dd5c938011a40a91c49ca9564f3aac40b67c8d27'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testStoreReadsOrmRows(self):
+        """ Rows written through the ORM should be readable by the store,
+        and updates made by the store visible to the ORM
+        """
+        sess = bookbyline.sync('sqlite:///%s' % self.location)
+        sess.add(Position(position=2, displayline=1, headers=u'Canto I',
+            digest=self.digest, conkey='A', consecret='B', acckey='C',
+            accsecret='D'))
+        sess.commit()
+        store = bookbyline.SqliteStore(self.location)
+        row = bookbyline.get_row(store, self.digest)
+        self.assertEqual((row.position, row.conkey), (2, 'A'))
+        bookbyline.write_vals(store, self.digest, 5, 3, u'Canto II')
+        sess.expire_all()
+        row = sess.query(Position).one()
+        self.assertEqual((row.position, row.headers), (5, u'Canto II'))
+
+    def testStoreCreatesOrmSchema(self):
+        """ A db created by the store should be usable by the ORM
+        """
+        store = bookbyline.SqliteStore(self.location)
+        store.add_row({'position': 0, 'displayline': 0, 'headers': '',
+            'digest': self.digest})
+        store.commit()
+        sess = bookbyline.sync('sqlite:///%s' % self.location)
+        self.assertEqual(sess.query(Position).one().digest, self.digest)
+
+    def testDryRunWithStore(self):
+        """ A book should cache its digest and emit using the store
+        """
+        store = bookbyline.SqliteStore(self.location)
+        store.add_row({'position': 0, 'displayline': 0, 'headers': '',
+            'digest': self.digest})
+        book = bookbyline.BookFromTextFile(
+            self.fname, ['This'], self.tmp_dir, store)
+        self.assertEqual(store.get_filestat(os.path.abspath(self.fname))[3],
+            self.digest)
+        book.get_db(store)
+        book.emit_tweet(False)
+        self.assertEqual(store.get_row(self.digest).position, 2)
+
+    def testTweepyNotImportedForDryRun(self):
+        """ Emitting to stdout shouldn't need tweepy
+        """
+        bookbyline.tweepy = None
+        store = bookbyline.SqliteStore(self.location)
+        store.add_row({'position': 0, 'displayline': 0, 'headers': '',
+            'digest': self.digest})
+        book = bookbyline.BookFromTextFile(
+            self.fname, ['This'], self.tmp_dir, store)
+        book.get_db(store)
+        book.emit_tweet(False)
+        self.assertTrue(bookbyline.tweepy is None)
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'books.sl3')
+        # a db as created by earlier versions, with a duplicated digest
+        conn = sqlite3.connect(self.location)
+        conn.execute("""CREATE TABLE position (id INTEGER NOT NULL,
+            position INTEGER, displayline INTEGER, headers VARCHAR(50),
+            digest VARCHAR(50), conkey VARCHAR(50), consecret VARCHAR(50),
+            acckey VARCHAR(50), accsecret VARCHAR(50), PRIMARY KEY (id))""")
+        conn.executemany(
+            "INSERT INTO position (position, digest, conkey) VALUES (?, ?, ?)",
+            [(3, 'abc', 'A'), (7, 'abc', 'B'), (5, 'def', 'C')])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def indexes(self):
+        conn = sqlite3.connect(self.location)
+        return [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+
+    def testSyncMigratesOldDb(self):
+        """ sync() should de-duplicate digests, keeping the most advanced
+        row, and add a unique index
+        """
+        sess = bookbyline.sync('sqlite:///%s' % self.location)
+        rows = dict((row.digest, (row.position, row.conkey))
+            for row in sess.query(Position).all())
+        self.assertEqual(rows, {'abc': (7, 'B'), 'def': (5, 'C')})
+        self.assertTrue('ix_position_digest' in self.indexes())
+        with self.assertRaises(Exception):
+            sess.add(Position(digest='def'))
+            sess.commit()
+
+    def testStoreMigratesOldDb(self):
+        """ SqliteStore should apply the same migration
+        """
+        store = bookbyline.SqliteStore(self.location)
+        self.assertEqual(store.get_row('abc').position, 7)
+        self.assertTrue('ix_position_digest' in self.indexes())
+        self.assertEqual(store.connection.execute(
+            "PRAGMA user_version").fetchone()[0], bookbyline.SCHEMA_VERSION)
+
+    def testNewDbIndexed(self):
+        """ A new db should get the index from its model
+        """
+        location = os.path.join(self.tmp_dir, 'new.sl3')
+        bookbyline.sync('sqlite:///%s' % location)
+        conn = sqlite3.connect(location)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0],
+            bookbyline.SCHEMA_VERSION)
+
+
+class ScheduleTests(unittest.TestCase):
+
+    def testCronField(self):
+        """ Cron fields should expand to the values they match
+        """
+        self.assertEqual(
+            bookbyline.parse_cron_field('*/15', 0, 59), set([0, 15, 30, 45]))
+        self.assertEqual(
+            bookbyline.parse_cron_field('1-3,7', 0, 7), set([1, 2, 3, 7]))
+        with self.assertRaises(ValueError):
+            bookbyline.parse_cron_field('61', 0, 59)
+
+    def testCronNextAfter(self):
+        """ Should find the next matching minute, across month boundaries
+        """
+        sched = bookbyline.CronSchedule('30 9 * * 1-5')
+        # Friday 2012-08-31 10:00 -> Monday 2012-09-03 09:30
+        self.assertEqual(
+            sched.next_after(datetime.datetime(2012, 8, 31, 10, 0)),
+            datetime.datetime(2012, 9, 3, 9, 30))
+        sched = bookbyline.CronSchedule('0 0 29 2 *')
+        self.assertEqual(
+            sched.next_after(datetime.datetime(2013, 1, 1)),
+            datetime.datetime(2016, 2, 29))
+
+    def testInterval(self):
+        sched = bookbyline.IntervalSchedule(90)
+        self.assertEqual(
+            sched.next_after(datetime.datetime(2012, 1, 1)),
+            datetime.datetime(2012, 1, 1, 0, 1, 30))
+
+
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.database = bookbyline.sync('sqlite:///')
+        self.book = bookbyline.BookFromTextFile(
+            'test_file.txt', ['This'], self.index_dir, self.database)
+        self.database.add(Position(
+            position=0, displayline=0, headers='', digest=self.book.sha))
+        self.database.commit()
+        self.clock = datetime.datetime(2012, 1, 1)
+        self.sleeps = []
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def now(self):
+        return self.clock
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock += datetime.timedelta(seconds=seconds)
+
+    def testDaemonRunsToEndOfBook(self):
+        """ The daemon should emit every line on schedule, then exit
+        """
+        book = bookbyline.run_daemon(
+            self.book, self.database, False,
+            bookbyline.IntervalSchedule(60), self.sleep, self.now)
+        self.assertTrue(book is self.book)
+        # header + first line, then two more lines
+        self.assertEqual(self.sleeps, [60, 60, 60, 60])
+        row = self.database.query(Position).one()
+        self.assertEqual(row.position, 4)
+        self.assertEqual(row.displayline, 3)
+
+    def testDaemonReusesCompiledHeaders(self):
+        """ The header pattern should only be compiled once
+        """
+        bookbyline.run_daemon(
+            self.book, self.database, False,
+            bookbyline.IntervalSchedule(60), self.sleep, self.now)
+        matcher = self.book.matcher
+        self.book.header_match(u'This')
+        self.assertTrue(self.book.matcher is matcher)
+
+
+
+class MultiBookTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = bookbyline.sync('sqlite:///')
+        self.books = []
+        for num in xrange(3):
+            fname = os.path.join(self.tmp_dir, 'poem%s.txt' % num)
+            with open(fname, 'w') as f:
+                f.write('This is poem %s\nLine one\nLine two\n' % num)
+            book = bookbyline.BookFromTextFile(
+                fname, ['This'], self.tmp_dir, self.database)
+            self.database.add(Position(
+                position=0, displayline=0, headers='', digest=book.sha))
+            self.books.append(book)
+        self.database.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testReadBooks(self):
+        """ Config lines should be split into names and headers
+        """
+        config = os.path.join(self.tmp_dir, 'books.conf')
+        with open(config, 'w') as f:
+            f.write('# comment\n\n"my poem.txt" Canto BOOK\nb.txt This\n')
+        self.assertEqual(bookbyline.read_books(config), [
+            ('my poem.txt', ['Canto', 'BOOK']), ('b.txt', ['This'])])
+
+    def testRunBooksAdvancesEachBook(self):
+        """ Every book should be advanced, in one transaction
+        """
+        report = bookbyline.run_books(self.database, self.books, False, 2)
+        self.assertEqual([err for _, err in report], [None] * 3)
+        for row in self.database.query(Position).all():
+            self.assertEqual(row.position, 2)
+
+    def testRunBooksFailedPostNotSaved(self):
+        """ A book whose post fails should keep its old position
+        """
+        def fail(payload, live):
+            raise IOError("post failed")
+        self.books[1].post = fail
+        report = dict(
+            (book.sha, err) for book, err in
+            bookbyline.run_books(self.database, self.books, False))
+        self.assertTrue(isinstance(report[self.books[1].sha], IOError))
+        positions = dict(
+            (row.digest, row.position)
+            for row in self.database.query(Position).all())
+        self.assertEqual(positions[self.books[0].sha], 2)
+        self.assertEqual(positions[self.books[1].sha], 0)
+
+    def testRunBooksReportsFinishedBook(self):
+        """ A book with no more lines should be reported as finished, with
+        a message saying so
+        """
+        self.database.query(Position).filter_by(
+            digest=self.books[1].sha).update({'position': 3})
+        self.database.commit()
+        report = dict((book.sha, err) for book, err in
+            bookbyline.run_books(self.database, self.books, False))
+        err = report[self.books[1].sha]
+        self.assertTrue(isinstance(err, bookbyline.Finished))
+        self.assertEqual(str(err),
+            "%s has no more lines to tweet" % self.books[1].sha)
+        self.assertEqual(report[self.books[0].sha], None)
+
+    def testRunBooksQueuedHeaderlessBook(self):
+        """ A queued book which can't be rendered shouldn't undo the other
+        books' saved positions
+        """
+        fname = os.path.join(self.tmp_dir, 'headerless.txt')
+        with open(fname, 'w') as f:
+            f.write('No header here\nLine one\n')
+        book = bookbyline.BookFromTextFile(
+            fname, ['This'], self.tmp_dir, self.database)
+        self.database.add(Position(
+            position=0, displayline=0, headers='', digest=book.sha))
+        self.database.commit()
+        report = dict((each.sha, err) for each, err in bookbyline.run_books(
+            self.database, [self.books[0], book], False, 2, queued=True))
+        self.assertEqual(report[self.books[0].sha], None)
+        self.assertTrue(isinstance(report[book.sha], bookbyline.MatchError))
+        self.assertEqual(self.database.query(Position).filter_by(
+            digest=self.books[0].sha).one().position, 2)
+
+    def testRunBooksClaimsAfterFormatting(self):
+        """ Books' lines should all be formatted before any is claimed, so
+        the write transaction is kept short
+        """
+        events = []
+        for book in self.books:
+            def wrap(book, name):
+                method = getattr(book, name)
+                def wrapped(*args, **kwargs):
+                    events.append(name)
+                    return method(*args, **kwargs)
+                setattr(book, name, wrapped)
+            wrap(book, 'format_tweet')
+            wrap(book, 'save')
+        bookbyline.run_books(self.database, self.books, False, 2)
+        self.assertEqual(events, ['format_tweet'] * 3 + ['save'] * 3)
+
+    def testRunPoolKeepsOrder(self):
+        """ Results should be returned in order, with errors caught
+        """
+        results = bookbyline.run_pool(lambda x: 10 / x, [1, 0, 5], 2)
+        self.assertEqual(results[0], (10, None))
+        self.assertTrue(isinstance(results[1][1], ZeroDivisionError))
+        self.assertEqual(results[2], (2, None))
+
+
+
+class ShardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'shared.sl3')
+        database = bookbyline.sync('sqlite:///%s' % self.location)
+        self.books = []
+        for num in xrange(6):
+            fname = os.path.join(self.tmp_dir, 'poem%s.txt' % num)
+            with open(fname, 'w') as f:
+                f.write('This is poem %s\nLine one\nLine two\n' % num)
+            book = bookbyline.BookFromTextFile(fname, ['This'], self.tmp_dir)
+            database.add(Position(
+                position=0, displayline=0, headers='', digest=book.sha))
+            self.books.append((fname, ['This']))
+        database.commit()
+        self.database = database
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testShardsStable(self):
+        """ Every book should be placed in one shard, and always the same
+        """
+        shards = bookbyline.shard_books(self.books, 4)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sorted(num for shard in shards for num, _, _ in
+            shard), range(6))
+        def placed(books):
+            """ Map each file to its shard """
+            return dict((fname, num) for num, shard in enumerate(
+                bookbyline.shard_books(books, 4)) for _, fname, _ in shard)
+        self.assertEqual(placed(self.books), placed(self.books[::-1]))
+
+    def testRunShardsAdvancesEveryBook(self):
+        """ Books should be advanced by the workers, and reported in their
+        original order
+        """
+        missing = os.path.join(self.tmp_dir, 'missing.txt')
+        books = self.books[:3] + [(missing, ['This'])] + self.books[3:]
+        bookbyline.TIMER.reset()
+        report = bookbyline.run_shards(self.location, books, False, 3,
+            index_dir=self.tmp_dir)
+        self.assertEqual([fname for fname, _ in report],
+            [fname for fname, _ in books])
+        self.assertEqual([err for _, err in report],
+            [None] * 3 + [report[3][1]] + [None] * 3)
+        self.assertTrue(report[3][1].startswith('IOError'))
+        for row in self.database.query(Position).all():
+            self.assertEqual(row.position, 2)
+        self.assertTrue(bookbyline.TIMER.totals['connect'][1] > 1)
+
+
+class IngestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.tmp_dir, 'corpus')
+        os.mkdir(self.corpus)
+        then = time.time() - 60
+        for name, text in (('a.txt', 'Canto I\nfirst\n'),
+            ('b.txt', 'Canto I\nsecond\n'), ('c.txt', 'Canto I\nfirst\n'),
+            ('notes.md', 'Canto I\nnot a poem\n')):
+            fname = os.path.join(self.corpus, name)
+            with open(fname, 'w') as f:
+                f.write(text)
+            os.utime(fname, (then, then))
+        self.database = bookbyline.sync('sqlite:///')
+        self.database.add(Position(position=3, displayline=1, headers='',
+            digest='existing', conkey='A', consecret='B', acckey='C',
+            accsecret='D'))
+        self.database.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def ingest(self, **options):
+        return bookbyline.ingest(self.database, self.corpus, ['Canto'], 2,
+            index_dir=self.tmp_dir, **options)
+
+    def testIngestAddsRows(self):
+        """ Each new text should get a row, with existing credentials
+        """
+        report = self.ingest()
+        self.assertEqual([(os.path.basename(fname), outcome)
+            for fname, _, outcome in report],
+            [('a.txt', 'added'), ('b.txt', 'added'), ('c.txt', 'duplicate')])
+        rows = self.database.query(Position).filter(
+            Position.digest != 'existing').all()
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertEqual((row.position, row.conkey, row.accsecret),
+                (0, 'A', 'D'))
+        self.assertEqual([outcome for _, _, outcome in self.ingest()],
+            ['exists'] * 3)
+
+    def testReingestNeedsNoCredentials(self):
+        """ OAuth setup shouldn't be run when there are no rows to add
+        """
+        self.ingest()
+        self.database.query(Position).update({'conkey': None,
+            'consecret': None, 'acckey': None, 'accsecret': None})
+        self.database.commit()
+        def create_oauth(sess, digest):
+            raise AssertionError("OAuth setup was run")
+        original, bookbyline.create_oauth = bookbyline.create_oauth, \
+            create_oauth
+        try:
+            self.assertEqual([outcome for _, _, outcome in self.ingest()],
+                ['exists'] * 3)
+        finally:
+            bookbyline.create_oauth = original
+
+    def testIngestBuildsIndexes(self):
+        """ Ingested books shouldn't need hashing or indexing again
+        """
+        report = self.ingest()
+        fname, digest, _ = report[0]
+        self.assertTrue(os.path.exists(
+            bookbyline.index_path(self.tmp_dir, digest)))
+        def scan(to_scan):
+            raise AssertionError("file was re-hashed")
+        self.assertEqual(bookbyline.get_digest(self.database, fname, scan),
+            (digest, None))
+        book = bookbyline.BookFromTextFile(
+            fname, ['Canto'], self.tmp_dir, self.database)
+        self.assertEqual(book.sha, digest)
+        self.assertTrue(os.path.exists(book.header_index()))
+
+    def testIngestUnknownCredentials(self):
+        """ Asking for the credentials of a missing book should fail
+        """
+        self.assertRaises(LookupError, self.ingest, creds='missing')
+        self.assertEqual(self.database.query(Position).count(), 1)
+
+
+class LineBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = [u'Canto I\n', u'caf\xe9 au lait\n', 'plain\n', u'last']
+        self.text = bookbyline.LineBuffer(self.lines)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testSequence(self):
+        """ Lines should be read back as unicode, by index or slice
+        """
+        self.assertEqual(len(self.text), 4)
+        self.assertEqual(self.text[1], u'caf\xe9 au lait\n')
+        self.assertEqual(self.text[-1], u'last')
+        self.assertEqual(self.text[2:10], [u'plain\n', u'last'])
+        self.assertEqual(list(self.text), [unicode(line) for line in
+            self.lines])
+        self.assertRaises(IndexError, lambda: self.text[4])
+
+    def testRawLines(self):
+        """ Lines should be stored as UTF-8, in a single string
+        """
+        self.assertEqual(self.text.raw(1), 'caf\xc3\xa9 au lait\n')
+        self.assertEqual(''.join(self.text.iter_raw()), self.text.data)
+
+    def testBookFromPipe(self):
+        """ Text which isn't in a regular file should be held in a
+        LineBuffer, and hashed as the same file on disk would be
+        """
+        with open('test_file.txt', 'rb') as f:
+            data = f.read()
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            book = bookbyline.BookFromTextFile(pipe, ['This'])
+        self.assertTrue(isinstance(book.text, bookbyline.LineBuffer))
+        self.assertEqual(book.sha, bookbyline.scan_file('test_file.txt')[0])
+        self.assertEqual(book.read_lines(0, 2), bookbyline.BookFromTextFile(
+            'test_file.txt', ['This'], self.tmp_dir).read_lines(0, 2))
+        self.assertEqual(book.line_count(), len(list(book.iter_lines())))
+
+
+class CompressedBookTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'poem.txt')
+        lines = []
+        for canto in xrange(1, 6):
+            lines.append('Canto %s\n' % canto)
+            lines.extend('line %s of canto %s\n\n' % (num, canto)
+                for num in xrange(1, 9))
+        with open(self.fname, 'w') as f:
+            f.writelines(lines)
+        self.plain = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        # small blocks, so the poem is split across several
+        self.checkpoint_bytes = bookbyline.CHECKPOINT_BYTES
+        bookbyline.CHECKPOINT_BYTES = 100
+
+    def tearDown(self):
+        bookbyline.CHECKPOINT_BYTES = self.checkpoint_bytes
+        shutil.rmtree(self.tmp_dir)
+
+    def compressed(self, opener, extension):
+        """ Write a compressed copy of the poem, and return a book for it
+        """
+        fname = self.fname + extension
+        with open(self.fname, 'rb') as plain:
+            compressed = opener(fname, 'wb')
+            compressed.write(plain.read())
+            compressed.close()
+        return bookbyline.book_class(fname)(
+            fname, ['Canto'], os.path.join(self.tmp_dir, 'idx'))
+
+    def testGzipMatchesPlain(self):
+        """ A gzipped book should have the same digest and lines as the
+        uncompressed one
+        """
+        book = self.compressed(gzip.open, '.gz')
+        self.assertTrue(isinstance(book, bookbyline.CompressedBookFromTextFile))
+        self.assertEqual(book.sha, self.plain.sha)
+        self.assertEqual(book.line_count(), self.plain.line_count())
+        self.assertEqual(list(book.iter_lines()),
+            list(self.plain.iter_lines()))
+        for start in (0, 7, 20, 44, 45, 50):
+            self.assertEqual(book.read_lines(start, 3),
+                self.plain.read_lines(start, 3))
+        self.assertEqual(book.seek(u'Canto 4', 3),
+            self.plain.seek(u'Canto 4', 3))
+
+    def testBzip2SeeksByBlock(self):
+        """ Reading a line should only decompress the block holding it
+        """
+        book = self.compressed(bz2.BZ2File, '.bz2')
+        table = book.checkpoints()
+        self.assertTrue(len(table) // 2 - 1 > 3)
+        self.assertEqual(table[-2], 45)
+        self.assertEqual(book.read_lines(40, 1), [u'line 4 of canto 5\n'])
+        num = book.block[0]
+        self.assertTrue(table[num * 2] <= 40 < table[num * 2 + 2])
+
+    def testXz(self):
+        """ An xz compressed book should match the uncompressed one, if an
+        lzma module is available
+        """
+        try:
+            lzma = bookbyline.load_lzma()
+        except ImportError:
+            self.skipTest("no lzma module")
+        book = self.compressed(lzma.open, '.xz')
+        self.assertEqual(book.sha, self.plain.sha)
+        self.assertEqual(book.read_lines(30, 2), self.plain.read_lines(30, 2))
+
+    def testCheckpointsRebuilt(self):
+        """ Missing checkpoints should be rebuilt
+        """
+        book = self.compressed(gzip.open, '.gz')
+        shutil.rmtree(book.index_dir)
+        self.assertEqual(book.read_lines(10, 1), self.plain.read_lines(10, 1))
+
+    def testEmitCompressed(self):
+        """ Emitting a compressed book should resume from the stored
+        position, as an uncompressed one does
+        """
+        database = bookbyline.sync('sqlite:///')
+        book = self.compressed(gzip.open, '.gz')
+        database.add(Position(position=12, displayline=3,
+            headers=u'Canto 2\n', digest=book.sha))
+        database.commit()
+        output = []
+        book.post = lambda payload, live: output.append(payload)
+        book.get_db(database)
+        book.emit_tweet(True)
+        self.assertEqual(output, [u'Canto 2\nl. 4: line 3 of canto 2'])
+
+
+class RemapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'poem.txt')
+        self.lines = []
+        for canto in xrange(1, 11):
+            self.lines.append('Canto %s\n' % canto)
+            self.lines.extend('verse %s of canto %s\n' % (num, canto)
+                for num in xrange(1, 101))
+        self.database = bookbyline.sync('sqlite:///')
+        book = self.write(self.lines, 120)
+        self.database.add(Position(position=0, displayline=0, headers='',
+            digest=book.sha, conkey='A', consecret='B', acckey='C',
+            accsecret='D'))
+        self.database.commit()
+        # tweet up to verse 50 of canto 6
+        book.get_db(self.database)
+        self.position = book.seek(u'Canto 6', 50)
+        bookbyline.write_vals(self.database, book.sha,
+            self.position["lastline"], self.position["displayline"],
+            self.position["prefix"])
+        self.old = book
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, lines, age):
+        """ Write a version of the poem, last modified age seconds ago,
+        and load it """
+        with open(self.fname, 'w') as f:
+            f.writelines(lines)
+        then = time.time() - age
+        os.utime(self.fname, (then, then))
+        return bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir, self.database)
+
+    def testChunksContentDefined(self):
+        """ Inserting a line should only change the chunk holding it
+        """
+        old = self.old.chunks()
+        self.assertEqual(sum(chunk[1] for chunk in old), len(self.lines))
+        checksums = bookbyline.ChecksumFile(self.tmp_dir, self.old.sha)
+        self.assertEqual(len(checksums), len(self.lines))
+        self.assertEqual(checksums[3:5], [zlib.crc32(line) & 0xffffffff
+            for line in self.lines[3:5]])
+        self.assertTrue(all(bookbyline.CHUNK_MIN <= chunk[1] <=
+            bookbyline.CHUNK_MAX for chunk in old[:-1]))
+        new = self.write(self.lines[:30] + ['a new line\n'] + self.lines[30:],
+            60).chunks()
+        changed = set(chunk[2] for chunk in new) - set(
+            chunk[2] for chunk in old)
+        self.assertEqual(len(changed), 1)
+        self.assertNotEqual(bookbyline.merkle_root(old),
+            bookbyline.merkle_root(new))
+
+    def testRemapLine(self):
+        """ Lines should keep their place in unchanged chunks, and their
+        offset in edited ones
+        """
+        old = [(0, 10, 'a'), (10, 10, 'b'), (20, 10, 'c'), (30, 10, 'd')]
+        new = [(0, 12, 'x'), (12, 10, 'b'), (22, 10, 'c'), (32, 5, 'y')]
+        self.assertEqual(bookbyline.remap_line(old, new, 15), 17)
+        self.assertEqual(bookbyline.remap_line(old, new, 25), 27)
+        self.assertEqual(bookbyline.remap_line(old, new, 3), 3)
+        self.assertEqual(bookbyline.remap_line(old, new, 38), 37)
+        self.assertEqual(bookbyline.remap_line(old, new, 40), 37)
+        self.assertEqual(bookbyline.remap_line(old, [(0, 30, 'z')], 15), None)
+        # with line checksums, lines are matched within edited chunks
+        old_sums = range(40)
+        new_sums = [100, 101] + range(0, 5) + range(6, 10) + [102] + \
+            range(10, 30) + range(30, 35)
+        new = [(0, 12, 'x'), (12, 10, 'b'), (22, 10, 'c'), (32, 5, 'y')]
+        self.assertEqual(bookbyline.remap_line(old, new, 3, old_sums,
+            new_sums), 5)
+        self.assertEqual(bookbyline.remap_line(old, new, 8, old_sums,
+            new_sums), 9)
+        self.assertEqual(bookbyline.remap_line(old, new, 5, old_sums,
+            new_sums), 7)
+
+    def testEditKeepsPosition(self):
+        """ Editing the poem should move its row to the new version, at the
+        same line, without OAuth setup
+        """
+        lines = self.lines[:]
+        lines[20] = 'verse 20 of canto 1, corrected\n'
+        del lines[150:152]
+        lines.insert(400, 'an added verse\n')
+        book = self.write(lines, 60)
+        self.assertEqual(book.previous, self.old.sha)
+        book.get_db(self.database)
+        row = self.database.query(Position).one()
+        self.assertEqual(row.digest, book.sha)
+        self.assertEqual(row.conkey, 'A')
+        self.assertEqual(book.read_lines(row.position, 1),
+            [self.lines[self.position["lastline"]].decode('utf-8')])
+        self.assertEqual((row.displayline, row.headers),
+            (self.position["displayline"], self.position["prefix"]))
+
+    def testTypoInShortPoemKeepsPosition(self):
+        """ A short poem has a single chunk, so a corrected typo should be
+        judged by its lines, and keep its position
+        """
+        fname = os.path.join(self.tmp_dir, 'short.txt')
+        lines = ['Canto 1\n'] + ['verse %s\n' % num for num in xrange(20)]
+        with open(fname, 'w') as f:
+            f.writelines(lines)
+        then = time.time() - 120
+        os.utime(fname, (then, then))
+        book = bookbyline.BookFromTextFile(fname, ['Canto'], self.tmp_dir,
+            self.database)
+        self.database.add(Position(position=12, displayline=11,
+            headers='Canto 1\n', digest=book.sha, conkey='A',
+            consecret='B', acckey='C', accsecret='D'))
+        self.database.commit()
+        lines[3] = 'vrese 2\n'
+        with open(fname, 'w') as f:
+            f.writelines(lines)
+        edited = bookbyline.BookFromTextFile(fname, ['Canto'], self.tmp_dir,
+            self.database)
+        self.assertEqual(len(edited.chunks()), 1)
+        self.assertTrue(edited.remap(self.database))
+        row = self.database.query(Position).filter_by(
+            digest=edited.sha).one()
+        self.assertEqual((row.position, row.conkey), (12, 'A'))
+
+    def testRewriteNotRemapped(self):
+        """ A different poem in the same file shouldn't take over the row
+        """
+        book = self.write(['Canto 1\n'] + ['other %s\n' % num
+            for num in xrange(500)], 60)
+        self.assertFalse(book.remap(self.database))
+        self.assertEqual(self.database.query(Position).one().digest,
+            self.old.sha)
+
+
+class PoemTestCase(unittest.TestCase):
+    """ Set up a short poem with two headers, and a row for it """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = bookbyline.sync('sqlite:///')
+        self.fname = os.path.join(self.tmp_dir, 'poem.txt')
+        with open(self.fname, 'w') as f:
+            f.write('Canto I\nfirst\n\nsecond\nCanto II\nthird\nfourth\n')
+        self.book = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        self.database.add(Position(
+            position=0, displayline=0, headers='', digest=self.book.sha))
+        self.database.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def emit_all(self, queued):
+        """ Emit the whole book, returning the payloads
+        """
+        output = []
+        self.book.post = lambda payload, live: output.append(payload)
+        while True:
+            self.book.get_db(self.database, queued)
+            try:
+                self.book.emit_tweet(False)
+            except StopIteration:
+                return output
+
+
+def emit_until_done(args):
+    """ Emit lines from a book in a shared db until it's finished, and
+    return the payloads posted. Run in a separate process by
+    ConcurrencyTests
+    """
+    location, fname, index_dir, use_store = args
+    if use_store:
+        sess = bookbyline.SqliteStore(location)
+    else:
+        sess = bookbyline.sync('sqlite:///%s' % location)
+    book = bookbyline.BookFromTextFile(fname, ['Canto'], index_dir, sess)
+    output = []
+    book.post = lambda payload, live: output.append(payload)
+    while True:
+        book.get_db(sess)
+        try:
+            book.emit_tweet(True)
+        except bookbyline.PositionConflict:
+            continue
+        except StopIteration:
+            return output
+
+
+class ConcurrencyTests(PoemTestCase):
+
+    def testStaleBookNotEmitted(self):
+        """ A book whose position was moved on by another process shouldn't
+        post the line again
+        """
+        output = []
+        other = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        for book in self.book, other:
+            book.post = lambda payload, live: output.append(payload)
+            book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertRaises(bookbyline.PositionConflict, other.emit_tweet, True)
+        self.assertEqual(output, [u'Canto I\nl. 1: first'])
+        self.assertEqual(self.database.query(Position).one().position, 2)
+
+    def testFailedPostRestoresPosition(self):
+        """ A line which couldn't be posted should be handed back
+        """
+        def fail(payload, live):
+            raise IOError("post failed")
+        self.book.post = fail
+        self.book.get_db(self.database)
+        self.assertRaises(IOError, self.book.emit_tweet, True)
+        self.assertEqual(self.database.query(Position).one().position, 0)
+        self.book.get_db(self.database)
+        self.book.post = lambda payload, live: None
+        self.book.emit_tweet(True)
+        self.assertEqual(self.database.query(Position).one().position, 2)
+
+    def testWriteAheadLogging(self):
+        """ File dbs should use WAL journaling, and wait for locks
+        """
+        location = os.path.join(self.tmp_dir, 'shared.sl3')
+        sess = bookbyline.sync('sqlite:///%s' % location)
+        self.assertEqual(sess.execute("PRAGMA journal_mode").scalar(), 'wal')
+        store = bookbyline.SqliteStore(location)
+        self.assertEqual(store.connection.execute(
+            "PRAGMA busy_timeout").fetchone()[0], bookbyline.BUSY_TIMEOUT)
+
+    def testConcurrentWriters(self):
+        """ Processes sharing a db should emit every line exactly once
+        """
+        location = os.path.join(self.tmp_dir, 'shared.sl3')
+        fname = os.path.join(self.tmp_dir, 'long.txt')
+        with open(fname, 'w') as f:
+            f.write('Canto I\n')
+            f.writelines('line %s\n' % num for num in xrange(300))
+        sess = bookbyline.sync('sqlite:///%s' % location)
+        book = bookbyline.BookFromTextFile(fname, ['Canto'], self.tmp_dir)
+        sess.add(Position(
+            position=0, displayline=0, headers='', digest=book.sha))
+        sess.commit()
+        pool = multiprocessing.Pool(8)
+        try:
+            results = pool.map(emit_until_done, [
+                (location, fname, self.tmp_dir, num % 2)
+                for num in xrange(8)])
+        finally:
+            pool.close()
+            pool.join()
+        posted = [payload for output in results for payload in output]
+        self.assertEqual(len(posted), 300)
+        self.assertEqual(len(set(posted)), 300)
+        sess.expire_all()
+        self.assertEqual(sess.query(Position).one().position, 301)
+
+
+class QueueTests(PoemTestCase):
+
+    def testIterPayloads(self):
+        """ Should yield every tweet, with its starting line
+        """
+        payloads = list(self.book.iter_payloads())
+        self.assertEqual([seq for seq, _, _ in payloads], [0, 2, 3, 5])
+        self.assertEqual(payloads[2][1], u'Canto II\nl. 1: third')
+        self.assertEqual(payloads[3][2]['displayline'], 2)
+
+    def testQueuedMatchesFormatted(self):
+        """ Emitting from the queue should produce identical tweets and
+        positions
+        """
+        queued = self.emit_all(True)
+        self.assertEqual(
+            self.database.query(bookbyline.Payload).count(), 4)
+        self.database.query(Position).update({
+            'position': 0, 'displayline': 0, 'headers': ''})
+        self.database.commit()
+        self.assertEqual(queued, self.emit_all(False))
+
+    def testQueueRenderedOnce(self):
+        """ A book should only be rendered once for a set of headers, and
+        re-rendered if they change
+        """
+        self.assertTrue(self.book.render(self.database))
+        self.book.iter_payloads = None
+        self.assertTrue(self.book.render(self.database))
+        del self.book.iter_payloads
+        self.book.headers = ['Canto', 'second']
+        self.assertTrue(self.book.render(self.database))
+        self.assertEqual(
+            self.database.query(bookbyline.Payload).filter_by(
+                sequence=2).one().payload,
+            u'second\nl. 1: Canto II')
+
+    def testRenderCommitsInBatches(self):
+        """ Payloads should be committed a batch at a time, and the book
+        only recorded as rendered once they all are, so a render which
+        doesn't finish is done again
+        """
+        batch = bookbyline.RENDER_BATCH
+        bookbyline.RENDER_BATCH = 2
+        payloads = self.book.iter_payloads
+        def fail():
+            for count, payload in enumerate(payloads()):
+                if count == 3:
+                    raise IOError("render interrupted")
+                yield payload
+        self.book.iter_payloads = fail
+        try:
+            self.assertRaises(IOError, self.book.render, self.database)
+        finally:
+            bookbyline.RENDER_BATCH = batch
+            del self.book.iter_payloads
+        self.database.rollback()
+        self.assertEqual(
+            self.database.query(bookbyline.Payload).count(), 2)
+        self.assertEqual(
+            self.database.query(bookbyline.Rendering).count(), 0)
+        self.assertTrue(self.book.render(self.database))
+        self.assertEqual(
+            self.database.query(bookbyline.Payload).count(), 4)
+        self.assertEqual(
+            self.database.query(bookbyline.Rendering).one().count, 4)
+
+    def testQueueNotRenderedWithoutHeader(self):
+        """ Books whose first line isn't a header aren't rendered
+        """
+        self.book.headers = ['foo']
+        self.assertFalse(self.book.render(self.database))
+        self.assertEqual(
+            self.database.query(bookbyline.Rendering).count(), 0)
+
+
+class ExportTests(PoemTestCase):
+
+    def testExportMatchesEmits(self):
+        """ Every tweet should be exported, as it would be emitted, without
+        touching the db
+        """
+        out = StringIO.StringIO()
+        self.assertEqual(bookbyline.export_payloads(self.book, out), 4)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(records[2], {"sequence": 3,
+            "payload": u'Canto II\nl. 1: third', "lastline": 5,
+            "displayline": 1, "prefix": u'Canto II\n'})
+        self.assertEqual(self.database.query(Position).one().position, 0)
+        self.assertEqual([record["payload"] for record in records],
+            self.emit_all(False))
+
+    def testExportEncodesLikeJson(self):
+        """ Lines should be identical to json.dumps' output, including for
+        non-ASCII text
+        """
+        with open(self.fname, 'w') as f:
+            f.write('Canto \xc3\x89\nfirst "quoted"\n\tsecond\n')
+        book = bookbyline.BookFromTextFile(self.fname, ['Canto'],
+            self.tmp_dir)
+        out = StringIO.StringIO()
+        bookbyline.export_payloads(book, out, {"lastline": 1,
+            "displayline": 0, "prefix": u'Canto \xc9\n'})
+        expected = [{"sequence": 1, "payload": u'Canto \xc9\nl. 1: first '
+            u'"quoted"', "lastline": 2, "displayline": 1},
+            {"sequence": 2, "payload": u'Canto \xc9\nl. 2: second',
+            "lastline": 3, "displayline": 2}]
+        self.assertEqual(out.getvalue(), ''.join(json.dumps(dict(record,
+            prefix=u'Canto \xc9\n'), separators=(',', ':'),
+            sort_keys=True) + '\n' for record in expected))
+
+
+class SectionTests(PoemTestCase):
+
+    def testHeaderMatcher(self):
+        """ Header words should be matched literally, at the start of lines
+        """
+        matcher = bookbyline.HeaderMatcher(['Canto', 'BOOK.', 'Passus'])
+        self.assertEqual(matcher.match(u'Canto I'), u'Canto')
+        self.assertEqual(matcher.match(u'BOOK. 2'), u'BOOK.')
+        self.assertEqual(matcher.match(u'BOOKS 2'), None)
+        self.assertEqual(matcher.match(u' Canto'), None)
+
+    def testSectionsSkipLineAfterHeader(self):
+        """ A header directly after a header is tweeted with it, so it
+        doesn't begin a section
+        """
+        table = bookbyline.classify(
+            ['A', 'A', 'b', 'A', 'c'], lambda line: line == 'A')
+        self.assertEqual(list(table), [0, 3])
+
+    def testSectionsCached(self):
+        """ The section table should be built once per digest and headers
+        """
+        self.assertEqual(list(self.book.sections()), [0, 3])
+        self.assertTrue(os.path.exists(bookbyline.section_path(
+            self.tmp_dir, self.book.sha, ['Canto'])))
+        self.book.section_table = None
+        self.book.iter_lines = None
+        self.assertEqual(list(self.book.sections()), [0, 3])
+
+    def testLocateMatchesEmittedPositions(self):
+        """ locate() should agree with the positions stored while emitting
+        """
+        for sequence, _, position in self.book.iter_payloads():
+            self.assertEqual(self.book.locate(position["lastline"]),
+                (position["prefix"], position["displayline"]))
+        self.assertEqual(self.book.locate(0), (u'', 0))
+
+
+class SeekTests(PoemTestCase):
+
+    def testSeekMatchesEmittedPositions(self):
+        """ Seeking to a line should give the position from which emitting
+        would tweet that line
+        """
+        payloads = list(self.book.iter_payloads())
+        # tweet 3 (Canto II, line 1) begins at the header line
+        self.assertEqual(self.book.seek(u'Canto II', 1), payloads[1][2])
+        # tweet 4 (Canto II, line 2) follows tweet 3
+        self.assertEqual(self.book.seek(u'Canto II', 2), payloads[2][2])
+        self.assertEqual(self.book.seek(u' Canto I\n', 2), payloads[0][2])
+
+    def testSeekThenEmit(self):
+        """ The next tweet after seeking should be the requested line
+        """
+        position = self.book.seek(u'Canto I', 2)
+        bookbyline.write_vals(self.database, self.book.sha,
+            position["lastline"], position["displayline"],
+            position["prefix"])
+        self.book.get_db(self.database)
+        self.assertEqual(self.book.format_tweet(), u'Canto I\nl. 2: second')
+
+    def testSeekOutOfRange(self):
+        """ Unknown headers and lines should raise MatchError
+        """
+        with self.assertRaises(bookbyline.MatchError):
+            self.book.seek(u'Canto III', 1)
+        with self.assertRaises(bookbyline.MatchError):
+            self.book.seek(u'Canto I', 3)
+        with self.assertRaises(bookbyline.MatchError):
+            self.book.seek(u'Canto II', 0)
+
+    def testSeekFindsFirstDuplicate(self):
+        """ Repeated headers should resolve to their first occurrence
+        """
+        with open(self.fname, 'a') as f:
+            f.write('Canto I\nfifth\n')
+        book = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        self.assertEqual(book.find_header(u'Canto I'), 0)
+        self.assertEqual(book.find_header(u'Canto II'), 3)
+
+
+class CatchUpTests(PoemTestCase):
+
+    def position(self):
+        row = self.database.query(Position).one()
+        return row.position, row.displayline
+
+    def testEmitCount(self):
+        """ Should emit count tweets, claiming them all at once
+        """
+        output = []
+        self.book.post = lambda payload, live: output.append(payload)
+        saves = []
+        save = self.book.save
+        self.book.save = lambda commit=True: (saves.append(1), save(commit))
+        self.book.get_db(self.database)
+        self.assertEqual(self.book.emit_tweets(False, 3), 3)
+        self.assertEqual(output[2], u'Canto II\nl. 1: third')
+        self.assertEqual(len(saves), 1)
+        self.assertEqual(self.position(), (5, 1))
+
+    def testEmitCountClaimsInBlocks(self):
+        """ Without commit_every, tweets should be claimed CLAIM_BLOCK at a
+        time, so a crash can't skip the rest of the run
+        """
+        output = []
+        claimed = []
+        self.book.post = lambda payload, live: (output.append(payload),
+            claimed.append(self.position()[0]))
+        self.book.get_db(self.database)
+        block = bookbyline.CLAIM_BLOCK
+        bookbyline.CLAIM_BLOCK = 2
+        try:
+            self.assertEqual(self.book.emit_tweets(False, 3), 3)
+        finally:
+            bookbyline.CLAIM_BLOCK = block
+        self.assertEqual(claimed, [3, 3, 5])
+
+    def testEmitCountMatchesSingleEmits(self):
+        """ Catching up should produce the same tweets as single runs
+        """
+        output = []
+        self.book.post = lambda payload, live: output.append(payload)
+        self.book.get_db(self.database)
+        self.assertEqual(self.book.emit_tweets(False, 10, 3), 4)
+        self.assertEqual(self.position(), (6, 2))
+        caught_up = output[:]
+        del output[:]
+        self.database.query(Position).update({
+            'position': 0, 'displayline': 0, 'headers': ''})
+        self.database.commit()
+        self.assertEqual(caught_up, self.emit_all(False))
+
+    def testEmitCountResumesAfterFailure(self):
+        """ A failed post should leave the position after the last success
+        """
+        output = []
+        def post(payload, live):
+            if len(output) == 2:
+                raise IOError("post failed")
+            output.append(payload)
+        self.book.post = post
+        self.book.get_db(self.database)
+        with self.assertRaises(IOError):
+            self.book.emit_tweets(False, 4)
+        self.assertEqual(self.position(), (3, 2))
+
+
+class FakeClient(object):
+    """ Records the statuses posted with one credential set """
+
+    def __init__(self, creds):
+        self.creds = creds
+        self.statuses = []
+        self.fail = False
+
+    def update_status(self, status):
+        if self.fail:
+            raise poster.PostError("403 Forbidden", 403)
+        self.statuses.append(status)
+
+
+class MirrorTests(PoemTestCase):
+
+    def setUp(self):
+        PoemTestCase.setUp(self)
+        row = self.database.query(Position).one()
+        row.conkey, row.consecret, row.acckey, row.accsecret = 'ABCD'
+        # each account's clients are named by its access key; credentials
+        # which don't match an account's fail the test
+        self.names = {('A', 'B', 'C', 'D'): 'C'}
+        for acckey in 'EF':
+            self.database.add(bookbyline.Account(digest=self.book.sha,
+                conkey='A', consecret='B', acckey=acckey,
+                accsecret=acckey.lower(), position=0, failures=0))
+            self.names[('A', 'B', acckey, acckey.lower())] = acckey
+        self.database.commit()
+        self.clients = {}
+        self.get = poster.POOL.get
+        poster.POOL.get = lambda creds: self.clients.setdefault(
+            self.names[tuple(creds)], FakeClient(creds))
+
+    def tearDown(self):
+        poster.POOL.get = self.get
+        PoemTestCase.tearDown(self)
+
+    def accounts(self):
+        return dict((account.acckey, (account.position, account.failures))
+            for account in self.database.query(bookbyline.Account))
+
+    def testPostedToEveryAccount(self):
+        """ Each line should be posted to the book's account and its
+        mirrors, and each mirror's position recorded
+        """
+        self.book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertEqual(sorted(self.clients), ['C', 'E', 'F'])
+        for client in self.clients.values():
+            self.assertEqual(client.statuses, [u'Canto I\nl. 1: first'])
+        self.assertEqual(self.accounts(), {'E': (2, 0), 'F': (2, 0)})
+
+    def testMirrorFailureRecorded(self):
+        """ A mirror which fails shouldn't hold the book back, but should
+        have its failure recorded
+        """
+        self.clients['F'] = FakeClient(None)
+        self.clients['F'].fail = True
+        self.book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.database.query(Position).one().position, 2)
+        self.assertEqual(self.accounts(), {'E': (2, 0), 'F': (0, 1)})
+        self.clients['F'].fail = False
+        self.book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.accounts(), {'E': (3, 0), 'F': (3, 0)})
+
+    def testRetrySkipsMirrorsAlreadySent(self):
+        """ If the book's own post fails, the line should be retried without
+        posting it to the mirrors again
+        """
+        self.clients['C'] = FakeClient(None)
+        self.clients['C'].fail = True
+        self.book.get_db(self.database)
+        self.assertRaises(poster.PostError, self.book.emit_tweet, True)
+        self.assertEqual(self.database.query(Position).one().position, 0)
+        self.assertEqual(self.accounts(), {'E': (2, 0), 'F': (2, 0)})
+        self.clients['C'].fail = False
+        self.book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.clients['C'].statuses, [u'Canto I\nl. 1: first'])
+        self.assertEqual(len(self.clients['E'].statuses), 1)
+
+    def testCatchUpRecordsEachLine(self):
+        """ Mirrors should be recorded at the last line they were sent
+        """
+        self.book.get_db(self.database)
+        self.assertEqual(self.book.emit_tweets(True, 3, 2), 3)
+        self.assertEqual(len(self.clients['F'].statuses), 3)
+        self.assertEqual(self.accounts(), {'E': (5, 0), 'F': (5, 0)})
+
+    def testAddAccount(self):
+        """ A new account should reuse another book's credentials, and start
+        from the book's current position
+        """
+        self.database.add(Position(position=0, digest='other', conkey='G',
+            consecret='H', acckey='I', accsecret='J'))
+        self.database.query(Position).filter_by(digest=self.book.sha).update(
+            {'position': 2})
+        self.database.commit()
+        account = bookbyline.add_account(self.database, self.book.sha,
+            'other')
+        self.assertEqual((account.conkey, account.acckey, account.position),
+            ('G', 'I', 2))
+        self.assertRaises(LookupError, bookbyline.add_account,
+            self.database, 'missing', 'other')
+
+
+
+class JournalTests(PoemTestCase):
+
+    def setUp(self):
+        PoemTestCase.setUp(self)
+        self.output = []
+        self.book.post = lambda payload, live: (self.output.append(payload),
+            {"id": len(self.output)})[1]
+
+    def position(self):
+        return self.database.query(Position).one().position
+
+    def records(self):
+        with open(bookbyline.journal_path(self.tmp_dir, self.book.sha)) as f:
+            return [json.loads(line) for line in f]
+
+    def posted(self):
+        """ Return the journal's records of posted tweets """
+        return [record for record in self.records()
+            if not record.get("intent")]
+
+    def testJournaledTweetsFolded(self):
+        """ Journaled tweets should be recorded in the journal, with their
+        status ids, and only saved to the db when the journal is closed
+        """
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.position(), 0)
+        records = self.posted()
+        self.assertEqual([(record["sequence"], record["lastline"],
+            record["status"]) for record in records], [(0, 2, 1), (2, 3, 2)])
+        self.book.close()
+        self.assertEqual(self.position(), 3)
+        self.assertEqual(self.records(), [])
+        self.book.get_db(self.database)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.output[-1], u'Canto II\nl. 1: third')
+
+    def testReplayAfterCrash(self):
+        """ Tweets journaled by a run which didn't finish shouldn't be
+        posted again
+        """
+        self.book.get_db(self.database, journaled=True)
+        self.assertEqual(self.book.emit_tweets(True, 2), 2)
+        # the process dies, releasing its lock, without folding
+        self.book.journal.release()
+        self.book.journal = None
+        with open(bookbyline.journal_path(self.tmp_dir, self.book.sha),
+            'a') as f:
+            f.write('{"sequence": 3, "lastl')
+        other = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        other.post = self.book.post
+        other.get_db(self.database, journaled=True)
+        self.assertEqual(other.position["lastline"], 3)
+        other.emit_tweet(True)
+        self.assertEqual(self.output, [u'Canto I\nl. 1: first',
+            u'Canto I\nl. 2: second', u'Canto II\nl. 1: third'])
+        self.assertEqual(len(self.posted()), 3)
+        other.close()
+        self.assertEqual(self.position(), 5)
+
+    def testIntentSyncedBeforePost(self):
+        """ The intent to post a tweet should be in the journal before it's
+        posted, and only its posted record once it has been
+        """
+        seen = []
+        post = self.book.post
+        self.book.post = lambda payload, live: (seen.append(self.records()),
+            post(payload, live))[1]
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        self.assertEqual(seen, [[{"sequence": 0, "lastline": 2,
+            "displayline": 1, "prefix": u"Canto I\n", "intent": True}]])
+        self.assertEqual(self.book.journal.unsynced, 1)
+        self.assertEqual(self.book.journal.pending, None)
+
+    def testPendingTweetPostedAgain(self):
+        """ A tweet whose run died after recording its intent, but before
+        recording it as posted, should be posted again by the next run
+        """
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        def die(payload, live):
+            self.output.append(payload)
+            raise SystemExit
+        post, self.book.post = self.book.post, die
+        self.book.get_db(self.database, journaled=True)
+        self.assertRaises(SystemExit, self.book.emit_tweet, True)
+        self.book.journal.release()
+        self.book.journal = None
+        other = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        other.post = post
+        other.get_db(self.database, journaled=True)
+        self.assertEqual(other.journal.pending["sequence"], 2)
+        self.assertEqual(other.position["lastline"], 2)
+        other.emit_tweet(True)
+        self.assertEqual(self.output, [u'Canto I\nl. 1: first',
+            u'Canto I\nl. 2: second', u'Canto I\nl. 2: second'])
+        self.assertEqual(other.journal.pending, None)
+        other.close()
+        self.assertEqual(self.position(), 3)
+
+    def testSeekClearsJournal(self):
+        """ Seeking should empty a book's journal, but not create one for a
+        book which has never been journaled
+        """
+        path = bookbyline.journal_path(self.tmp_dir, self.book.sha)
+        bookbyline.seek_row(self.database, self.book, u'Canto II', 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.position(), 3)
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        self.book.journal.release()
+        self.book.journal = None
+        bookbyline.seek_row(self.database, self.book, u'Canto I', 1)
+        self.assertEqual(self.records(), [])
+        self.assertEqual(self.position(), 0)
+
+    def testJournalLocked(self):
+        """ Other processes shouldn't emit a book while it's journaled
+        """
+        self.book.get_db(self.database, journaled=True)
+        other = bookbyline.BookFromTextFile(
+            self.fname, ['Canto'], self.tmp_dir)
+        self.assertRaises(bookbyline.PositionConflict, other.get_db,
+            self.database, False, True)
+        self.assertRaises(bookbyline.PositionConflict, other.get_db,
+            self.database)
+        self.book.close()
+        other.get_db(self.database)
+
+    def testFailedPostNotJournaled(self):
+        """ A failed post should leave the journal as it was
+        """
+        def fail(payload, live):
+            raise IOError("post failed")
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        post, self.book.post = self.book.post, fail
+        self.book.get_db(self.database, journaled=True)
+        self.assertRaises(IOError, self.book.emit_tweet, True)
+        self.assertEqual(self.book.position["lastline"], 2)
+        self.assertEqual(len(self.posted()), 1)
+        self.book.post = post
+        self.book.get_db(self.database, journaled=True)
+        self.book.emit_tweet(True)
+        self.assertEqual(self.output, [u'Canto I\nl. 1: first',
+            u'Canto I\nl. 2: second'])
+
+    def testFoldedPeriodically(self):
+        """ The journal should be saved to the db every JOURNAL_FOLD tweets
+        """
+        fold = bookbyline.JOURNAL_FOLD
+        bookbyline.JOURNAL_FOLD = 2
+        try:
+            self.book.get_db(self.database, journaled=True)
+            self.assertEqual(self.book.emit_tweets(True, 3), 3)
+            self.assertEqual(self.position(), 3)
+            self.assertEqual(len(self.posted()), 1)
+        finally:
+            bookbyline.JOURNAL_FOLD = fold
+            self.book.close()
+        self.assertEqual(self.position(), 5)
+
+
+class TimingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.timer = bookbyline.StageTimer()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testNestedStagesCountedOnce(self):
+        """ A stage nested within itself should only be counted once
+        """
+        with self.timer('hash'):
+            with self.timer('hash'):
+                pass
+            with self.timer('load'):
+                pass
+        self.assertEqual(self.timer.totals['hash'][1], 1)
+        self.assertEqual(self.timer.totals['load'][1], 1)
+
+    def testPrometheusExport(self):
+        """ Totals should be written in Prometheus' text format
+        """
+        with self.timer('post'):
+            pass
+        with self.timer('post'):
+            pass
+        path = os.path.join(self.tmp_dir, 'plowman.prom')
+        self.timer.write_prometheus(path)
+        with open(path) as f:
+            text = f.read()
+        self.assertTrue('# TYPE plowman_stage_seconds gauge' in text)
+        self.assertTrue('plowman_stage_calls{stage="post"} 2\n' in text)
+        self.assertEqual(os.listdir(self.tmp_dir), ['plowman.prom'])
+
+    def testEmitRecordsStages(self):
+        """ Emitting a line should record each of its stages
+        """
+        bookbyline.TIMER.reset()
+        database = bookbyline.sync('sqlite:///')
+        book = bookbyline.BookFromTextFile(
+            'test_file.txt', ['This'], self.tmp_dir, database)
+        database.add(Position(
+            position=0, displayline=0, headers='', digest=book.sha))
+        database.commit()
+        book.get_db(database)
+        book.emit_tweet(False)
+        for stage in ('hash', 'fetch', 'load', 'format', 'post', 'commit'):
+            self.assertTrue(stage in bookbyline.TIMER.totals, stage)
+
+    def testAuthTimesSigning(self):
+        """ Pooled clients should record the time spent signing requests
+        """
+        bookbyline.TIMER.reset()
+        client = poster.POOL.get(('A', 'B', 'C', 'D'))
+        self.assertTrue(client.sign("POST", "https://api.twitter.com/",
+            {}, client.creds).startswith('OAuth '))
+        self.assertEqual(bookbyline.TIMER.totals['auth'][1], 1)
+        poster.POOL.close()
+
+
+class ProfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testProfileWritten(self):
+        """ A profiled call should return its result, and write a loadable
+        profile and a report
+        """
+        def stage(num):
+            with bookbyline.TIMER('load'):
+                return [str(x) for x in xrange(num)]
+        self.assertEqual(len(bookbyline.profile_call(
+            self.tmp_dir, stage, 1000)), 1000)
+        names = sorted(os.listdir(self.tmp_dir))
+        self.assertEqual([os.path.splitext(name)[1] for name in names],
+            ['.prof', '.txt'])
+        self.assertTrue(names[0].startswith('bookbyline-'))
+        stats = pstats.Stats(os.path.join(self.tmp_dir, names[0]))
+        self.assertTrue(any(func[2] == 'stage' for func in stats.stats))
+        with open(os.path.join(self.tmp_dir, names[1])) as f:
+            report = f.read()
+        self.assertTrue('Peak RSS' in report)
+        self.assertTrue('  load ' in report)
+
+    def testProfileWrittenOnError(self):
+        """ The profile should be written even if the run fails
+        """
+        self.assertRaises(ZeroDivisionError, bookbyline.profile_call,
+            self.tmp_dir, lambda: 1 / 0)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 2)
+
+    def testProfileDirectoryCreated(self):
+        """ A missing directory should be created before the run, rather
+        than failing once it's done
+        """
+        directory = os.path.join(self.tmp_dir, 'profiles', 'new')
+        self.assertEqual(bookbyline.profile_call(directory, lambda: 1), 1)
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def testLiveObjects(self):
+        """ Types should be counted, most common first
+        """
+        keep = [[] for _ in xrange(100000)]
+        counts = bookbyline.live_objects()
+        self.assertEqual(counts[0][0], 'list')
+        self.assertTrue(counts[0][1] >= len(keep))
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def testMakePoem(self):
+        """ Synthetic poems should be about the requested size, with
+        headers at the requested density
+        """
+        import benchmark
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'poem.txt')
+            lines = benchmark.make_poem(fname, 4096, 10)
+            self.assertTrue(4096 <= os.path.getsize(fname) < 4096 + 100)
+            text = bookbyline.gimme_lines(
+                fname, bookbyline.open_file, bookbyline.imp_file)
+            self.assertEqual(len(text), lines)
+            self.assertEqual(text[10], u'Canto 2\n')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testCompareFindsRegressions(self):
+        """ Only stages slower than the threshold should be reported
+        """
+        import benchmark
+        old = {"results": [{"size": 1, "density": 1, "stages": {
+            "a": {"best": 1.0}, "b": {"best": 1.0}}}]}
+        new = {"results": [{"size": 1, "density": 1, "stages": {
+            "a": {"best": 1.1}, "b": {"best": 2.0}, "c": {"best": 1.0}}}]}
+        self.assertEqual(benchmark.compare(old, new, 0.25), 1)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Replies to each request with the next of the server's canned
+    responses, recording the request and the connection it arrived on
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        self.server.requests.append((self.path, body, self.client_address))
+        response = self.server.responses.pop(0)
+        if response is None:
+            # drop the connection without responding
+            self.close_connection = 1
+            return
+        status, headers = response[:2]
+        if len(response) > 2:
+            data = response[2]
+        else:
+            data = '{"id": %s}' % len(self.server.requests)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class PosterTests(unittest.TestCase):
+
+    def setUp(self):
+        """ Start a local stand-in for the Twitter API
+        """
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), StandInHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/1.1/' % self.server.server_port
+        self.clock = [1000.0]
+        self.slept = []
+        self.client = poster.Client(('A', 'B', 'C', 'D'), self.url,
+            max_retries=2, sleep=self.sleep, now=lambda: self.clock[0])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sleep(self, seconds):
+        """ Pretend to sleep """
+        self.slept.append(seconds)
+        self.clock[0] += seconds
+
+    def testSignature(self):
+        """ Requests should be signed as in Twitter's OAuth example
+        """
+        creds = ('xvz1evFS4wEEPTGEFPHBog',
+            'kAcSOqF21Fu85e7zjz7ZN2U4ZRhfV3WpwPAoE3Z7kBw',
+            '370773112-GmHxMAgYyLbNEtIKZeRNFsMKPR9EyMZeS9weJAEb',
+            'LswwdoUaIvS8ltyTt5jkRh4J50vUPVVHtR2YPi5kE')
+        header = poster.sign_request('POST',
+            'https://api.twitter.com/1.1/statuses/update.json'
+            '?include_entities=true',
+            {'status': 'Hello Ladies + Gentlemen, a signed OAuth request!'},
+            creds, nonce='kYjzVBB8Y0ZFabxSWbWovY3uYSQ2pTgmZeNu2VS4cg',
+            timestamp=1318622958)
+        self.assertTrue(
+            'oauth_signature="hCtSmYh%2BiHYCEqBWrE7C7hYmtUk%3D"' in header)
+
+    def testConnectionReused(self):
+        """ Successive posts should use the same connection
+        """
+        self.server.responses = [(200, {}), (200, {})]
+        self.assertEqual(self.client.update_status(u'first'), {'id': 1})
+        self.assertEqual(self.client.update_status(u'second'), {'id': 2})
+        paths = [request[0] for request in self.server.requests]
+        self.assertEqual(paths, ['/1.1/statuses/update.json'] * 2)
+        self.assertEqual(self.server.requests[1][1], 'status=second')
+        self.assertEqual(self.server.requests[0][2],
+            self.server.requests[1][2])
+
+    def testRateLimitRetried(self):
+        """ A rate-limited post should wait until the limit resets
+        """
+        self.server.responses = [
+            (429, {'x-rate-limit-reset': '1060'}), (200, {})]
+        self.client.update_status(u'first')
+        self.assertEqual(self.slept, [61.0])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testBackoffGivesUp(self):
+        """ Twitter being over capacity should be retried, with backoff,
+        until the client runs out of retries
+        """
+        self.server.responses = [
+            (503, {}, '{"errors": [{"code": 130}]}')] * 3
+        self.assertRaises(poster.PostError, self.client.update_status, u'x')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.slept), 2)
+        # backoff is 2s, doubling, with up to 50% jitter either way
+        self.assertTrue(1 <= self.slept[0] <= 3)
+        self.assertTrue(2 <= self.slept[1] <= 6)
+
+    def testForbiddenNotRetried(self):
+        """ A rejected post shouldn't be retried
+        """
+        self.server.responses = [(403, {})]
+        with self.assertRaises(poster.PostError) as caught:
+            self.client.update_status(u'first')
+        self.assertEqual(caught.exception.status, 403)
+        self.assertEqual(self.slept, [])
+
+    def testServerErrorNotRetried(self):
+        """ A post which fails with a server error may have been published,
+        so shouldn't be sent again
+        """
+        self.server.responses = [(500, {}), (200, {})]
+        with self.assertRaises(poster.PostError) as caught:
+            self.client.update_status(u'first')
+        self.assertEqual(caught.exception.status, 500)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testDroppedAfterSendNotRetried(self):
+        """ If the connection drops once a post has been sent, the post
+        shouldn't be sent again
+        """
+        self.server.responses = [None, (200, {})]
+        self.assertRaises(poster.PostError, self.client.update_status, u'x')
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.slept, [])
+
+    def testDuplicateIsPosted(self):
+        """ A post which Twitter refuses as a duplicate was already
+        published, so should count as a success
+        """
+        self.server.responses = [
+            (403, {}, '{"errors": [{"code": 187}]}')]
+        self.assertEqual(self.client.update_status(u'first'), None)
+
+    def testIdleConnectionReopened(self):
+        """ A connection which has been idle for a while should be
+        re-opened rather than reused, as the server may have dropped it
+        """
+        self.server.responses = [(200, {}), (200, {}), (200, {})]
+        self.client.update_status(u'first')
+        self.client.update_status(u'second')
+        self.clock[0] += poster.KEEP_ALIVE + 1
+        self.client.update_status(u'third')
+        connections = [request[2] for request in self.server.requests]
+        self.assertEqual(connections[0], connections[1])
+        self.assertNotEqual(connections[1], connections[2])
+
+    def testPoolKeepsClients(self):
+        """ The pool should hand back the same client for the same
+        credentials and API location
+        """
+        pool = poster.ClientPool(self.url)
+        client = pool.get(['A', 'B', 'C', 'D'])
+        self.assertTrue(pool.get(('A', 'B', 'C', 'D')) is client)
+        self.assertFalse(pool.get(('A', 'B', 'C', 'E')) is client)
+        pool.base_url = 'http://localhost:1/'
+        self.assertFalse(pool.get(('A', 'B', 'C', 'D')) is client)
+
+
+class LoadTests(unittest.TestCase):
+
+    def setUp(self):
+        from mock_twitter import MockTwitter
+        self.server = MockTwitter(rate_limit=2, window=60).start()
+        self.slept = []
+        self.client = poster.Client(('A', 'B', 'C', 'D'), self.server.url,
+            max_retries=1, sleep=self.slept.append)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def testPercentile(self):
+        """ Percentiles should be taken by nearest rank
+        """
+        import load_test
+        times = range(1, 101)
+        self.assertEqual(load_test.percentile(times, 50), 50)
+        self.assertEqual(load_test.percentile(times, 99), 99)
+        self.assertEqual(load_test.percentile([3], 95), 3)
+        self.assertEqual(load_test.percentile([], 95), None)
+
+    def testStandInRateLimits(self):
+        """ The stand-in should refuse posts beyond its rate limit, telling
+        the client when the limit resets
+        """
+        self.client.update_status(u'first')
+        self.client.update_status(u'second')
+        self.assertRaises(poster.PostError, self.client.update_status,
+            u'third')
+        self.assertEqual(self.server.statuses, ['first', 'second'])
+        self.assertEqual(self.server.counts["limited"], 2)
+        self.assertTrue(55 < self.slept[0] <= 62)
+
+    def testBooksPostedToStandIn(self):
+        """ Live runs should post each line to the stand-in
+        """
+        import load_test
+        tmp_dir = tempfile.mkdtemp()
+        self.server.rate_limit = 0
+        poster.POOL.base_url = self.server.url
+        try:
+            sess = bookbyline.sync('sqlite:///')
+            books = load_test.make_books(tmp_dir, 2, 10, sess)
+            summary = load_test.run_multi(sess, books, 6, 2)
+            self.assertEqual(summary["posts"], 6)
+            self.assertEqual(len(self.server.statuses), 6)
+            self.assertTrue(self.server.statuses[0].startswith('Canto'))
+            self.assertEqual(sess.query(Position).filter_by(
+                digest=books[0].sha).one().position, 4)
+        finally:
+            poster.POOL.close()
+            poster.POOL.base_url = poster.API_URL
+            shutil.rmtree(tmp_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+# coding=utf-8
+"""
+End-to-end load test for the posting path
+
+Starts the local Twitter stand-in (see mock_twitter.py), points the posting
+client at it, and drives a synthetic poem through each way of posting:
+one line per run (get_db() and emit_tweet(), as cron or the daemon would),
+a catch-up run (emit_tweets()), and several books at once (run_books()).
+Formatting, posting and db commits are all included. Throughput and
+latency percentiles are reported for each, and can be written as JSON:
+
+python load_test.py --tweets 500 --latency 0.02 --error-rate 0.01
+"""
+import sys
+import os
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+import bookbyline
+import poster
+from bookbyline import Position
+from benchmark import make_poem
+from mock_twitter import MockTwitter
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(times, pct):
+    """ Return the pct percentile of a sorted list, by nearest rank
+    """
+    if not times:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(times))) - 1
+    return times[max(rank, 0)]
+
+
+def summarise(times, elapsed, posts):
+    """ Return throughput and latency percentiles for a list of timings
+    """
+    times = sorted(times)
+    summary = {
+        "posts": posts,
+        "seconds": elapsed,
+        "posts_per_second": posts / elapsed if elapsed else None,
+        "mean": sum(times) / len(times) if times else None,
+        "max": times[-1] if times else None}
+    for pct in PERCENTILES:
+        summary["p%s" % pct] = percentile(times, pct)
+    return summary
+
+
+def make_books(work_dir, count, lines, sess, mapped=False):
+    """ Write count different poems, each of at least lines lines, and give
+    each a Position row. Returns a list of book objects
+    """
+    books = []
+    kind = bookbyline.MappedBookFromTextFile if mapped else \
+        bookbyline.BookFromTextFile
+    index_dir = os.path.join(work_dir, bookbyline.INDEX_DIR)
+    for num in xrange(count):
+        fname = os.path.join(work_dir, 'poem_%s.txt' % num)
+        # vary the header density, so that each poem has its own digest
+        make_poem(fname, lines * 60, 20 + num)
+        digest = bookbyline.scan_file(fname)[0]
+        sess.add(Position(position=0, displayline=0, headers=u'',
+            digest=digest, conkey='A%s' % num, consecret='B', acckey='C',
+            accsecret='D'))
+        books.append(kind(fname, ['Canto'], index_dir, sess))
+    sess.commit()
+    return books
+
+
+def timed_posts(book, times):
+    """ Record the time taken by each of book's posts in times """
+    post = book.post
+
+    def wrapper(payload, live_tweet):
+        """ Time a single post """
+        start = default_timer()
+        try:
+            return post(payload, live_tweet)
+        finally:
+            times.append(default_timer() - start)
+    book.post = wrapper
+
+
+def run_single(sess, books, tweets):
+    """ Load and emit one line at a time, timing each run
+    """
+    book = books[0]
+    times = []
+    start = default_timer()
+    for _ in xrange(tweets):
+        began = default_timer()
+        book.get_db(sess)
+        book.emit_tweet(True)
+        times.append(default_timer() - began)
+    return summarise(times, default_timer() - start, tweets)
+
+
+def run_catch_up(sess, books, tweets, commit_every):
+    """ Emit every line in a single call, timing each post
+    """
+    book = books[0]
+    times = []
+    timed_posts(book, times)
+    start = default_timer()
+    book.get_db(sess)
+    emitted = book.emit_tweets(True, tweets, commit_every)
+    return summarise(times, default_timer() - start, emitted)
+
+
+def run_multi(sess, books, tweets, workers):
+    """ Advance several books at once until tweets have been posted,
+    timing each post
+    """
+    times = []
+    for book in books:
+        timed_posts(book, times)
+    posted = 0
+    start = default_timer()
+    while posted < tweets:
+        report = bookbyline.run_books(sess, books, True, workers)
+        done = len([err for _, err in report if err is None])
+        if not done:
+            break
+        posted += done
+    return summarise(times, default_timer() - start, posted)
+
+
+def run_scenario(name, args, server):
+    """ Run one scenario against fresh books and a fresh db. Returns its
+    summary, with the stand-in's counters
+    """
+    work_dir = tempfile.mkdtemp()
+    poster.POOL.close()
+    poster.POOL.base_url = server.url
+    before = dict(server.counts)
+    try:
+        sess = bookbyline.sync(
+            'sqlite:///%s' % os.path.join(work_dir, 'load.sl3'))
+        if name == "multi":
+            books = make_books(work_dir, args.books,
+                args.tweets // args.books + 2, sess, args.mmap)
+            summary = run_multi(sess, books, args.tweets, args.workers)
+        else:
+            books = make_books(work_dir, 1, args.tweets + 2, sess, args.mmap)
+            if name == "single":
+                summary = run_single(sess, books, args.tweets)
+            else:
+                summary = run_catch_up(sess, books, args.tweets,
+                    args.commit_every)
+        sess.close()
+    finally:
+        shutil.rmtree(work_dir)
+    summary["server"] = dict((key, value - before[key])
+        for key, value in server.counts.items())
+    return summary
+
+
+def main():
+    """ Main function, called from command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Load test the posting path against a local stand-in')
+    parser.add_argument("--tweets", type=int, default=200,
+        help="posts per scenario. Default: 200")
+    parser.add_argument("--scenarios", nargs="+",
+        choices=("single", "catch_up", "multi"),
+        default=["single", "catch_up", "multi"],
+        help="scenarios to run. Default: all of them")
+    parser.add_argument("--books", type=int, default=8,
+        help="books to advance at once, in the multi scenario. Default: 8")
+    parser.add_argument("--workers", type=int, default=8,
+        help="posting threads, in the multi scenario. Default: 8")
+    parser.add_argument("--commit-every", type=int, default=0,
+        dest="commit_every", help="claim n posts at a time, in the "
+        "catch_up scenario. Default: %s" % bookbyline.CLAIM_BLOCK)
+    parser.add_argument("--mmap", action="store_true",
+        help="memory-map the poems")
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="stand-in's mean response time, in seconds. Default: 0")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        dest="error_rate", help="fraction of requests the stand-in fails. "
+        "Default: 0")
+    parser.add_argument("--rate-limit", type=int, default=0,
+        dest="rate_limit", help="updates the stand-in accepts per window. "
+        "Default: unlimited")
+    parser.add_argument("--window", type=float, default=1.0,
+        help="stand-in's rate-limit window, in seconds. Default: 1")
+    parser.add_argument("--backoff", type=float, default=0.05,
+        help="posting client's initial retry delay, in seconds. "
+        "Default: 0.05")
+    parser.add_argument("--output", help="file to write results to, as JSON")
+    args = parser.parse_args()
+
+    poster.POOL.options['backoff'] = args.backoff
+    server = MockTwitter(latency=args.latency, error_rate=args.error_rate,
+        rate_limit=args.rate_limit, window=args.window).start()
+    results = {}
+    try:
+        for name in args.scenarios:
+            results[name] = summary = run_scenario(name, args, server)
+            print "%-9s %6s posts in %7.3fs: %8.1f/s  " \
+                "p50 %.4fs  p95 %.4fs  p99 %.4fs  " \
+                "(%s errors, %s rate-limited)" % (name, summary["posts"],
+                summary["seconds"], summary["posts_per_second"] or 0,
+                summary["p50"] or 0, summary["p95"] or 0,
+                summary["p99"] or 0, summary["server"]["errors"],
+                summary["server"]["limited"])
+    finally:
+        poster.POOL.close()
+        server.stop()
+    if args.output:
+        output = {
+            "meta": {
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": vars(args)},
+            "results": results}
+        with open(args.output, 'w') as got_file:
+            json.dump(output, got_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# coding=utf-8
+"""
+A local stand-in for Twitter's statuses/update endpoint
+
+Accepts status updates without checking their signatures, after a
+configurable delay. A fraction of requests can be failed with a temporary
+error, and requests beyond a rate limit are refused with 429 and Twitter's
+rate-limit headers, so the posting client's retries can be exercised.
+Run it on its own, and point the script at it:
+
+python mock_twitter.py --port 8099 --latency 0.05 --error-rate 0.01
+python ../bookbyline.py -l -file poem.txt -header Canto \
+    --api-url http://127.0.0.1:8099/1.1/
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+UPDATE_PATH = '/1.1/statuses/update.json'
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handle a single status update
+    """
+    protocol_version = 'HTTP/1.1'
+    # send each response in one piece, so that it isn't held up by the
+    # client's delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        server = self.server
+        if urlparse.urlsplit(self.path).path != UPDATE_PATH:
+            return self.reply(404, {"errors": [{"code": 34}]})
+        if server.latency:
+            time.sleep(max(0, random.gauss(
+                server.latency, server.latency * server.jitter)))
+        limited, headers = server.check_limit()
+        if limited:
+            server.count('limited')
+            return self.reply(429, {"errors": [{"code": 88}]}, headers)
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self.reply(503, {"errors": [{"code": 130}]}, headers)
+        status = urlparse.parse_qs(body).get('status', [''])[0]
+        posted = server.count('posted', status)
+        self.reply(200, {"id": posted, "text": status.decode('utf-8')},
+            headers)
+
+    def reply(self, status, data, headers=None):
+        """ Send a JSON response """
+        data = json.dumps(data)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockTwitter(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A threaded server, holding the stand-in's settings and counters
+
+    latency is the mean time taken to respond, in seconds, and jitter its
+    standard deviation, as a fraction of latency. error_rate is the
+    fraction of requests failed with a 503. If rate_limit is set, at most
+    rate_limit updates are accepted in each window of window seconds
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.2, error_rate=0.0,
+        rate_limit=0, window=900.0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_used = 0
+        self.counts = {"posted": 0, "errors": 0, "limited": 0}
+        self.statuses = []
+        self.thread = None
+
+    @property
+    def url(self):
+        """ The API location to give the posting client """
+        return 'http://127.0.0.1:%s/1.1/' % self.server_port
+
+    def check_limit(self):
+        """ Count a request against the rate limit. Returns True if it
+        should be refused, and the rate-limit headers to send
+        """
+        if not self.rate_limit:
+            return False, {}
+        with self.lock:
+            now = time.time()
+            if now >= self.window_start + self.window:
+                self.window_start = now
+                self.window_used = 0
+            limited = self.window_used >= self.rate_limit
+            if not limited:
+                self.window_used += 1
+            return limited, {
+                'x-rate-limit-limit': str(self.rate_limit),
+                'x-rate-limit-remaining': str(
+                    self.rate_limit - self.window_used),
+                'x-rate-limit-reset': str(
+                    int(self.window_start + self.window))}
+
+    def count(self, outcome, status=None):
+        """ Record the outcome of a request. Returns its count """
+        with self.lock:
+            self.counts[outcome] += 1
+            if status is not None:
+                self.statuses.append(status)
+            return self.counts[outcome]
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving, and close the socket """
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    """ Main function, called from command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for the Twitter posting API')
+    parser.add_argument("--port", type=int, default=8099,
+        help="port to listen on. Default: 8099")
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="mean response time, in seconds. Default: 0")
+    parser.add_argument("--jitter", type=float, default=0.2,
+        help="standard deviation of the response time, as a fraction of "
+        "--latency. Default: 0.2")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        dest="error_rate", help="fraction of requests to fail with a 503. "
+        "Default: 0")
+    parser.add_argument("--rate-limit", type=int, default=0,
+        dest="rate_limit", help="updates accepted per window. Default: "
+        "unlimited")
+    parser.add_argument("--window", type=float, default=900.0,
+        help="rate-limit window, in seconds. Default: 900")
+    args = parser.parse_args()
+    server = MockTwitter(args.port, args.latency, args.jitter,
+        args.error_rate, args.rate_limit, args.window)
+    print "Listening at %s" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print json.dumps(server.counts)
+
+
+if __name__ == "__main__":
+    sys.exit(main())